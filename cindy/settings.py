@@ -185,9 +185,74 @@ WEBPACK_LOADER = {
 # Graphene Settings
 GRAPHENE = {
     'SCHEMA': 'schema.schema',
-    'SCHEMA_OUTPUT': 'react-boilerplate/schema.json'
+    'SCHEMA_OUTPUT': 'react-boilerplate/schema.json',
+    'MIDDLEWARE': ['sui_hei.metrics.FieldMetricsMiddleware'],
 }
 
+# Per-field metrics of GraphQL operations, see sui_hei/metrics.py
+# Fraction of operations to measure
+GRAPHQL_METRICS_SAMPLE_RATE = 0.01
+# Histogram buckets of wall and SQL time, in seconds
+GRAPHQL_METRICS_TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                                0.25, 0.5, 1, 2.5)
+# Histogram buckets of SQL query counts
+GRAPHQL_METRICS_QUERY_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100)
+# Addresses allowed to read graphql/metrics, when not proxied
+INTERNAL_IPS = ["127.0.0.1", "::1"]
+
+# total_count of connections, cached in the default cache (CACHES in
+# security.py), which must be shared by all processes
+# Seconds to cache counts for
+COUNT_CACHE_TIMEOUT = 60
+# Return the planner's estimate for sets larger than this
+COUNT_ESTIMATE_THRESHOLD = 10000
+
+# Persisted GraphQL queries, generated by `make schema`
+PERSISTED_QUERIES_FILE = os.path.join(BASE_DIR, "persisted_queries.json")
+# Reject queries that are not persisted
+PERSISTED_QUERIES_ONLY = False
+# Max number of parsed and validated documents to cache
+DOCUMENT_CACHE_SIZE = 500
+
+# Static cost analysis of GraphQL operations, see sui_hei/query_cost.py
+# Reject operations costing more than this
+QUERY_COST_LIMIT = 10000
+# Reject operations nested deeper than this
+QUERY_DEPTH_LIMIT = 12
+# Assumed page size of lists and connections without first/last/limit
+QUERY_COST_PAGE_SIZE = 100
+
+# Response cache of anonymous GraphQL queries
+# Max number of cached responses
+RESPONSE_CACHE_SIZE = 1000
+# Seconds to cache responses for
+RESPONSE_CACHE_TIMEOUT = 300
+
+# Batched GraphQL requests, see sui_hei/batch.py
+# Threads running the queries of batches concurrently. Each one holds
+# its own database connection.
+GRAPHQL_BATCH_WORKERS = 4
+
+# Async GraphQL endpoint on the ASGI stack, see sui_hei/graphql_consumer.py
+# Threads executing GraphQL operations. Each one holds its own database
+# connection.
+GRAPHQL_ASGI_WORKERS = 8
+
+# GraphQL subscriptions, see sui_hei/consumers.py
+# Threads executing subscriptions. Idle subscriptions hold none.
+GRAPHQL_SUBSCRIPTION_WORKERS = 4
+
+# Instances of recent model.changed events shared by the subscriptions of
+# a worker, see sui_hei/snapshots.py
+SNAPSHOT_CACHE_SIZE = 256
+
+# Sequence-numbered model.changed events replayed to reconnecting
+# subscriptions, see sui_hei/changelog.py
+# Number of events kept
+CHANGE_LOG_SIZE = 10000
+# Subscriptions which missed more events are told to resync instead
+CHANGE_LOG_REPLAY_LIMIT = 200
+
 CHANNELS_WS_PROTOCOLS = [
     "graphql-ws",
 ]
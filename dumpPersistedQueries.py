@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+'''
+Dump the queries of the frontend as persisted queries.
+
+Queries are collected from the gql`` templates in react-boilerplate/app,
+transformed the same way apollo-cache-inmemory does before sending them
+(adding __typename, removing @connection) and printed as a JSON object
+mapping the sha256 of each query text to the text itself.
+'''
+import hashlib
+import json
+import os
+import re
+import sys
+
+from graphql import parse
+from graphql.language import ast
+from graphql.language.printer import print_ast
+
+BASE_DIR = os.path.split(os.path.abspath(__file__))[0]
+APP_DIR = os.path.join(BASE_DIR, 'react-boilerplate', 'app')
+
+gql_regex = re.compile(r'(?:(?:const|let|var)\s+(\w+)\s*=\s*)?gql`([^`]*)`')
+import_regex = re.compile(
+    r'import\s+(\w+|\{[^}]*\})\s+from\s+[\'"]([^\'"]+)[\'"]')
+default_regex = re.compile(r'export\s+default\s+(\w+)')
+interpolation_regex = re.compile(r'\$\{(\w+)\}')
+
+
+def collect_templates():
+    '''
+    Returns
+    -------
+    templates: {(path, name): template}
+    imports: {(path, localName): (path of imported module, importedName)},
+             where importedName is None for default imports
+    defaults: {path: name of default export}
+    '''
+    templates, imports, defaults = {}, {}, {}
+    for root, dirs, files in os.walk(APP_DIR):
+        dirs[:] = [d for d in dirs if d not in ('node_modules', 'tests')]
+        for filename in files:
+            if not filename.endswith('.js'):
+                continue
+            path = os.path.join(root, filename)
+            with open(path) as f:
+                source = f.read()
+            if 'gql`' not in source:
+                continue
+
+            module = os.path.splitext(path)[0]
+            for i, (name, template) in enumerate(gql_regex.findall(source)):
+                # anonymous templates are passed to graphql() directly
+                templates[(module, name or '#%d' % i)] = template
+            for names, target in import_regex.findall(source):
+                # module paths are resolved from app/ by webpack
+                target = os.path.normpath(
+                    os.path.join(root if target.startswith('.') else APP_DIR,
+                                 target))
+                if names.startswith('{'):
+                    for name in names.strip('{}').split(','):
+                        name = name.split(' as ')
+                        imports[(module, name[-1].strip())] = (
+                            target, name[0].strip())
+                else:
+                    imports[(module, names)] = (target, None)
+            default = default_regex.search(source)
+            if default:
+                defaults[module] = default.group(1)
+    return templates, imports, defaults
+
+
+def expand(module, name, templates, imports, defaults):
+    def replace(match):
+        ref = match.group(1)
+        if (module, ref) in templates:
+            return expand(module, ref, templates, imports, defaults)
+        target, imported = imports.get((module, ref), (None, None))
+        imported = imported or defaults.get(target)
+        if (target, imported) in templates:
+            return expand(target, imported, templates, imports, defaults)
+        raise KeyError("%s: cannot resolve ${%s}" % (module, ref))
+
+    return interpolation_regex.sub(replace, templates[(module, name)])
+
+
+def transform(document):
+    # graphql-tag drops duplicated fragments
+    seen = set()
+    definitions = []
+    for definition in document.definitions:
+        if isinstance(definition, ast.FragmentDefinition):
+            if definition.name.value in seen:
+                continue
+            seen.add(definition.name.value)
+        definitions.append(definition)
+    document.definitions = definitions
+
+    def visit(selection_set, is_root):
+        if selection_set is None:
+            return
+        for selection in selection_set.selections:
+            if selection.directives:
+                selection.directives = [
+                    d for d in selection.directives
+                    if d.name.value != 'connection'
+                ]
+            visit(getattr(selection, 'selection_set', None), False)
+        if not is_root and not any(
+                isinstance(s, ast.Field) and s.name.value.startswith('__')
+                for s in selection_set.selections):
+            selection_set.selections.append(
+                ast.Field(name=ast.Name(value='__typename')))
+
+    for definition in document.definitions:
+        visit(definition.selection_set,
+              isinstance(definition, ast.OperationDefinition))
+    return document
+
+
+def main():
+    templates, imports, defaults = collect_templates()
+    queries = {}
+    for module, name in sorted(templates):
+        text = expand(module, name, templates, imports, defaults)
+        document = parse(text)
+        if not any(
+                isinstance(d, ast.OperationDefinition)
+                for d in document.definitions):
+            continue
+        query = print_ast(transform(document))
+        queries[hashlib.sha256(query.encode()).hexdigest()] = query
+
+    json.dump(queries, sys.stdout, indent=2, sort_keys=True)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,8 @@ export const withCommentList = graphql(
       $orderBy: [String]
       $limit: Int
       $offset: Int
+      $after: String
+      $before: String
       $puzzle_Status_Gt: Float
       $puzzle_User: ID
       $user: ID
@@ -16,6 +18,8 @@ export const withCommentList = graphql(
         orderBy: $orderBy
         limit: $limit
         offset: $offset
+        after: $after
+        before: $before
         puzzle_Status_Gt: $puzzle_Status_Gt
         puzzle_User: $puzzle_User
         user: $user
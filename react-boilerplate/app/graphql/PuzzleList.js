@@ -6,6 +6,8 @@ export const PuzzleList = gql`
     $orderBy: [String]
     $offset: Int
     $limit: Int
+    $after: String
+    $before: String
     $status: Float
     $status__gt: Float
     $title__contains: String
@@ -18,6 +20,8 @@ export const PuzzleList = gql`
     allPuzzles(
       offset: $offset
       limit: $limit
+      after: $after
+      before: $before
       orderBy: $orderBy
       status: $status
       status_Gt: $status__gt
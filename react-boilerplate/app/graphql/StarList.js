@@ -5,6 +5,8 @@ export const StarList = gql`
   query StarList(
     $offset: Int
     $limit: Int
+    $after: String
+    $before: String
     $orderBy: [String]
     $user: ID
     $puzzle: ID
@@ -12,6 +14,8 @@ export const StarList = gql`
     allStars(
       offset: $offset
       limit: $limit
+      after: $after
+      before: $before
       orderBy: $orderBy
       user: $user
       puzzle: $puzzle
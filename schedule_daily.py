@@ -66,6 +66,11 @@ def mark_puzzle_as_dazed():
         dazed_puzzle.save()
 
 
+def reconcile_puzzle_counters():
+    fixed = Puzzle.objects.reconcile_counters()
+    logger.debug("[Puzzle]: Fixed drifted counters of %d puzzles" % fixed)
+
+
 if __name__ == "__main__":
     settings = {}
     if os.path.exists(SCHEDULE_SETTING_PATH):
@@ -84,3 +89,6 @@ if __name__ == "__main__":
 
     # mark dazed puzzles
     mark_puzzle_as_dazed()
+
+    # fix drift of denormalized puzzle counters
+    reconcile_puzzle_counters()
@@ -1,9 +1,26 @@
 from django.apps import AppConfig
-from django.db.models.signals import post_save
+from django.core import checks
+from django.db.models.signals import post_delete, post_init, post_save
 from django.utils.translation import ugettext_lazy as _
 
-from sui_hei.signals import (add_twitter_on_puzzle_created,
-                             add_twitter_on_schedule_created)
+from sui_hei.counts import invalidate_counts
+from sui_hei.signals import (
+    add_twitter_on_puzzle_created, add_twitter_on_schedule_created,
+    remember_counter_fields, remember_search_fields,
+    update_puzzle_counters_on_bookmark_deleted,
+    update_puzzle_counters_on_bookmark_saved,
+    update_puzzle_counters_on_comment_deleted,
+    update_puzzle_counters_on_comment_saved,
+    update_puzzle_counters_on_dialogue_deleted,
+    update_puzzle_counters_on_dialogue_saved,
+    update_puzzle_counters_on_star_deleted,
+    update_puzzle_counters_on_star_saved, update_rollups_on_deleted,
+    update_rollups_on_saved, update_search_index_on_puzzle_saved,
+    update_userstats_on_comment_deleted, update_userstats_on_comment_saved,
+    update_userstats_on_dialogue_deleted, update_userstats_on_dialogue_saved,
+    update_userstats_on_puzzle_deleted, update_userstats_on_puzzle_saved,
+    update_userstats_on_star_deleted, update_userstats_on_star_saved)
+from sui_hei.versions import check_shared_cache
 
 
 class SuiHeiConfig(AppConfig):
@@ -11,6 +28,71 @@ class SuiHeiConfig(AppConfig):
     verbose_name = _('Lateral Thinking')
 
     def ready(self):
-        from sui_hei.models import Puzzle, Schedule
+        from sui_hei.models import (Bookmark, ChatMessage, Comment, Dialogue,
+                                    Puzzle, Schedule, Star)
         post_save.connect(add_twitter_on_puzzle_created, sender=Puzzle)
         post_save.connect(add_twitter_on_schedule_created, sender=Schedule)
+
+        # Snapshot fields used to compute deltas of counters
+        post_init.connect(remember_counter_fields, sender=Dialogue)
+        post_init.connect(remember_counter_fields, sender=Star)
+        post_init.connect(remember_counter_fields, sender=Bookmark)
+
+        # UserStats
+        post_save.connect(update_userstats_on_puzzle_saved, sender=Puzzle)
+        post_delete.connect(update_userstats_on_puzzle_deleted, sender=Puzzle)
+        post_save.connect(update_userstats_on_dialogue_saved, sender=Dialogue)
+        post_delete.connect(
+            update_userstats_on_dialogue_deleted, sender=Dialogue)
+        post_save.connect(update_userstats_on_star_saved, sender=Star)
+        post_delete.connect(update_userstats_on_star_deleted, sender=Star)
+        post_save.connect(update_userstats_on_comment_saved, sender=Comment)
+        post_delete.connect(
+            update_userstats_on_comment_deleted, sender=Comment)
+
+        # Puzzle counters
+        post_save.connect(
+            update_puzzle_counters_on_dialogue_saved, sender=Dialogue)
+        post_delete.connect(
+            update_puzzle_counters_on_dialogue_deleted, sender=Dialogue)
+        post_save.connect(update_puzzle_counters_on_star_saved, sender=Star)
+        post_delete.connect(
+            update_puzzle_counters_on_star_deleted, sender=Star)
+        post_save.connect(
+            update_puzzle_counters_on_comment_saved, sender=Comment)
+        post_delete.connect(
+            update_puzzle_counters_on_comment_deleted, sender=Comment)
+        post_save.connect(
+            update_puzzle_counters_on_bookmark_saved, sender=Bookmark)
+        post_delete.connect(
+            update_puzzle_counters_on_bookmark_deleted, sender=Bookmark)
+
+        # Search index
+        post_init.connect(remember_search_fields, sender=Puzzle)
+        post_save.connect(update_search_index_on_puzzle_saved, sender=Puzzle)
+
+        # Rollups
+        for model in (Puzzle, Dialogue, ChatMessage, Star, Bookmark):
+            post_save.connect(update_rollups_on_saved, sender=model)
+            post_delete.connect(update_rollups_on_deleted, sender=model)
+
+        # Invalidate cached total counts
+        post_save.connect(invalidate_counts)
+        post_delete.connect(invalidate_counts)
+
+        # Refresh snapshots after every counter has been updated
+        post_save.connect(remember_counter_fields, sender=Dialogue)
+        post_save.connect(remember_counter_fields, sender=Star)
+        post_save.connect(remember_counter_fields, sender=Bookmark)
+
+        # Versions of cached counts and responses need a shared cache
+        checks.register(check_shared_cache)
+
+        # Evict cached responses and publish model changes in every
+        # process, including management commands
+        import sui_hei.consumers
+
+        # Parse and validate persisted queries
+        from schema import schema
+        from sui_hei.documents import persisted_queries, PERSISTED_QUERIES_FILE
+        persisted_queries.load(PERSISTED_QUERIES_FILE, schema)
@@ -0,0 +1,125 @@
+"""
+batch.py
+
+Concurrent execution of the operations of a batched GraphQL request.
+
+Consecutive read-only operations of a batch run concurrently, one of them
+on the request thread and the others on a shared pool of
+GRAPHQL_BATCH_WORKERS threads. Each thread uses its own database
+connection, which is closed after the operation like at the end of a
+request (subject to CONN_MAX_AGE).
+
+Any other operation, e.g. a mutation, is a barrier: it runs alone on the
+request thread once everything before it has finished, and before
+anything after it starts. Mutations thus run strictly in order, and
+later operations see their effects.
+
+`execute_batch_async` applies the same rules on the ASGI stack, where
+operations are coroutines.
+
+Usage:
+    results = execute_batch(operations, is_read_only, run)
+"""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import translation
+
+GRAPHQL_BATCH_WORKERS = settings.GRAPHQL_BATCH_WORKERS
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=GRAPHQL_BATCH_WORKERS,
+                thread_name_prefix="graphql-batch")
+        return _executor
+
+
+def run_in_worker(run, operation, language):
+    close_old_connections()
+    try:
+        # The active language is thread-local
+        with translation.override(language):
+            return run(operation)
+    finally:
+        close_old_connections()
+
+
+def _run_concurrently(run, operations):
+    '''
+    Run `operations`, the first one on the current thread.
+
+    Returns
+    -------
+    list of results, in the order of `operations`
+    '''
+    language = translation.get_language()
+    futures = [
+        get_executor().submit(run_in_worker, run, operation, language)
+        for operation in operations[1:]
+    ]
+    try:
+        first = run(operations[0])
+    finally:
+        wait(futures)
+    return [first] + [future.result() for future in futures]
+
+
+def execute_batch(operations, is_read_only, run):
+    '''
+    Parameters
+    ----------
+    operations: list of operations of the batch
+    is_read_only: function telling whether an operation may run
+                  concurrently with other read-only operations
+    run: function executing an operation and returning its result
+
+    Returns
+    -------
+    list of results, in the order of `operations`
+    '''
+    if GRAPHQL_BATCH_WORKERS <= 1 or len(operations) <= 1:
+        return [run(operation) for operation in operations]
+
+    results = []
+    pending = []
+    for operation in operations:
+        if is_read_only(operation):
+            pending.append(operation)
+            continue
+        if pending:
+            results.extend(_run_concurrently(run, pending))
+            pending = []
+        results.append(run(operation))
+    if pending:
+        results.extend(_run_concurrently(run, pending))
+    return results
+
+
+async def execute_batch_async(operations, is_read_only, run):
+    '''
+    Same as `execute_batch`, where `run` is a coroutine function.
+    '''
+    results = []
+    pending = []
+    for operation in operations:
+        if is_read_only(operation):
+            pending.append(operation)
+            continue
+        if pending:
+            results.extend(await asyncio.gather(*map(run, pending)))
+            pending = []
+        results.append(await run(operation))
+    if pending:
+        results.extend(await asyncio.gather(*map(run, pending)))
+    return results
@@ -0,0 +1,269 @@
+"""
+benchmarks.py
+
+Latency benchmarks of the GraphQL operations of the frontend.
+
+BENCHMARKS is a fixed list of operations, named after the queries
+registered in PERSISTED_QUERIES_FILE, with variables chosen from the
+database (see generate_dataset in dataset.py): the busiest puzzle, user
+and chatroom, and pages deep into long lists. Deep pages of the limit/offset
+connections are benchmarked both by offset and by the after/before cursors
+of keyset pagination (see resolvePage in schema.py), selecting the same
+rows. Each operation is executed
+like SuiheiGraphQLView does, without the response cache, and timed
+together with the number of SQL queries it runs.
+
+Reports are JSON, so that runs on different commits can be compared.
+
+Usage:
+    report = run_benchmarks(documents, rounds=20)
+"""
+
+import time
+from datetime import timedelta
+
+from django.db import connection
+from django.db.models import Count
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from graphql.utils.get_operation_ast import get_operation_ast
+from graphql_relay import to_global_id
+from graphql_relay.connection.arrayconnection import offset_to_cursor
+
+from schema import schema
+
+from .documents import execute_document
+from .models import (ChatMessage, ChatRoom, Comment, Dialogue, Puzzle, Star,
+                     User)
+from .schema import encodeCursor, resolveOrderBy, resolveOrderKeys
+
+
+# {{{1 BENCHMARKS
+def _month_ago():
+    return (timezone.now() - timedelta(days=30)).isoformat()
+
+
+# (benchmark name, operation name, function of the context returning
+# the variables)
+BENCHMARKS = [
+    ("puzzleList", "PuzzleListInitQuery",
+     lambda c: dict(orderBy=["-created"], status__gt=0, limit=20, offset=0)),
+    ("puzzleListDeep", "PuzzleListInitQuery",
+     lambda c: dict(orderBy=["-created"], status__gt=0, limit=20,
+                    offset=c["puzzlePage"][0])),
+    ("puzzleListDeepAfter", "PuzzleListInitQuery",
+     lambda c: dict(orderBy=["-created"], status__gt=0, limit=20,
+                    after=c["puzzlePage"][1])),
+    ("puzzleListDeepBefore", "PuzzleListInitQuery",
+     lambda c: dict(orderBy=["-created"], status__gt=0, limit=20,
+                    before=c["puzzlePage"][2])),
+    ("puzzleActiveList", "PuzzleActiveListQuery",
+     lambda c: dict(status=0, orderBy=["-modified"])),
+    ("puzzleShow", "PuzzleShowQuery",
+     lambda c: dict(id=c["puzzle"], userId=c["user"])),
+    ("puzzleStars", "PuzzleStars", lambda c: dict(puzzleId=c["puzzle"])),
+    ("profileShow", "ProfileShowQuery", lambda c: dict(id=c["user"])),
+    ("starList", "StarList",
+     lambda c: dict(user=c["user"], orderBy=["-id"], limit=20, offset=0)),
+    ("starListDeep", "StarList",
+     lambda c: dict(user=c["user"], orderBy=["-id"], limit=20,
+                    offset=c["starPage"][0])),
+    ("starListDeepAfter", "StarList",
+     lambda c: dict(user=c["user"], orderBy=["-id"], limit=20,
+                    after=c["starPage"][1])),
+    ("commentList", "CommentListQuery",
+     lambda c: dict(orderBy=["-id"], puzzle_Status_Gt=0, limit=20, offset=0)),
+    ("commentListDeep", "CommentListQuery",
+     lambda c: dict(orderBy=["-id"], puzzle_Status_Gt=0, limit=20,
+                    offset=c["commentPage"][0])),
+    ("commentListDeepAfter", "CommentListQuery",
+     lambda c: dict(orderBy=["-id"], puzzle_Status_Gt=0, limit=20,
+                    after=c["commentPage"][1])),
+    ("chat", "ChatQuery", lambda c: dict(chatroomName=c["chatroomName"])),
+    ("chatDeep", "ChatQuery",
+     lambda c: dict(chatroomName=c["chatroomName"],
+                    before=offset_to_cursor(c["chatmessages"] // 5))),
+    ("directmessageSession", "DirectmessageSessionQuery",
+     lambda c: dict(userId=c["user"], last=20, orderBy=["id"])),
+    ("cindyStaticByDate", "CindyStaticByDateQuery",
+     lambda c: dict(className="Puzzle", by="date", created_Gte=_month_ago())),
+    ("userStaticByDate", "UserStaticByDateQuery",
+     lambda c: dict(className="Puzzle", by="date", user=c["user"],
+                    created_Gte=_month_ago())),
+    ("starStaticsChart", "StarStaticsChartQuery",
+     lambda c: dict(className="Star", user=c["user"])),
+    ("userList", "UserListInitQuery",
+     lambda c: dict(count=20, orderBy=["-date_joined"])),
+]
+
+
+def deep_page(qs, order_by, limit=20):
+    '''
+    Locate the page of `limit` rows four fifths into ordered qs.
+
+    Returns
+    -------
+    (offset, after, before), the offset of the page and the cursors of
+    the rows right before and after it, or None at either end
+    '''
+    keys = resolveOrderKeys(order_by)
+    qs = resolveOrderBy(qs, order_by)
+    offset = qs.count() * 4 // 5
+
+    def cursor(index):
+        rows = list(qs[index:index + 1]) if index >= 0 else []
+        return encodeCursor(rows[0], keys) if rows else None
+
+    return offset, cursor(offset - 1), cursor(offset + limit)
+
+
+def get_context():
+    '''
+    Returns
+    -------
+    dict of the objects the benchmarks are run against
+    '''
+    puzzle = Dialogue.objects.values("puzzle").annotate(
+        count=Count("id")).order_by("-count").first()
+    user = Puzzle.objects.values("user").annotate(
+        count=Count("id")).order_by("-count").first()
+    chatroom = ChatMessage.objects.values("chatroom").annotate(
+        count=Count("id")).order_by("-count").first()
+    if puzzle is None or user is None or chatroom is None:
+        raise ValueError("No data to run the benchmarks against")
+    puzzle_page = deep_page(Puzzle.objects.filter(status__gt=0), ["-created"])
+    star_page = deep_page(Star.objects.filter(user_id=user["user"]), ["-id"])
+    comment_page = deep_page(
+        Comment.objects.filter(puzzle__status__gt=0), ["-id"])
+    return {
+        "puzzle": to_global_id("PuzzleNode", puzzle["puzzle"]),
+        "user": to_global_id("UserNode", user["user"]),
+        "userId": user["user"],
+        "chatroomName": ChatRoom.objects.get(id=chatroom["chatroom"]).name,
+        "chatmessages": chatroom["count"],
+        "puzzlePage": puzzle_page,
+        "starPage": star_page,
+        "commentPage": comment_page,
+    }
+
+
+def dataset_counts():
+    return {
+        model.__name__: model.objects.count()
+        for model in [User, Puzzle, Dialogue, ChatMessage]
+    }
+
+
+# {{{1 run_benchmarks
+def percentile(values, p):
+    '''
+    Nearest-rank percentile of a sorted list.
+    '''
+    rank = max(int(round(p / 100 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def _execute(document, operation_name, variables, user):
+    request = RequestFactory().post("/graphql")
+    request.user = user
+    return execute_document(
+        schema,
+        document,
+        operation_name=operation_name,
+        variable_values=variables,
+        context_value=request)
+
+
+def run_benchmark(document, operation_name, variables, user_id, rounds,
+                  warmup):
+    '''
+    Returns
+    -------
+    dict of latency statistics in milliseconds, the number of SQL
+    queries, and the errors of the last execution
+    '''
+    user = User.objects.get(id=user_id)
+    timings = []
+    for i in range(warmup + rounds):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            result = _execute(document, operation_name, variables, user)
+            elapsed = time.perf_counter() - start
+        if i >= warmup:
+            timings.append(elapsed * 1000)
+
+    timings.sort()
+    return {
+        "p50": percentile(timings, 50),
+        "p90": percentile(timings, 90),
+        "p99": percentile(timings, 99),
+        "mean": sum(timings) / len(timings),
+        "min": timings[0],
+        "max": timings[-1],
+        "queries": len(queries),
+        "errors": [str(error) for error in result.errors or []],
+    }
+
+
+def run_benchmarks(documents, names=None, rounds=20, warmup=2, log=None):
+    '''
+    Parameters
+    ----------
+    documents: iterable of parsed documents, e.g. persisted queries
+    names: names of the benchmarks to run, all of them by default
+
+    Returns
+    -------
+    {"meta": {...}, "benchmarks": {name: statistics}}
+    '''
+    log = log or (lambda message: None)
+    operations = {}
+    for document in documents:
+        operation = get_operation_ast(document)
+        if operation is not None and operation.name is not None:
+            operations[operation.name.value] = document
+
+    context = get_context()
+    results = {}
+    for name, operation_name, get_variables in BENCHMARKS:
+        if names and name not in names:
+            continue
+        document = operations.get(operation_name)
+        if document is None:
+            log("%s: %s not found, skipped" % (name, operation_name))
+            continue
+        results[name] = run_benchmark(document, operation_name,
+                                      get_variables(context),
+                                      context["userId"], rounds, warmup)
+        log("%s: p50 %.2f ms, %d queries" % (name, results[name]["p50"],
+                                             results[name]["queries"]))
+
+    return {
+        "meta": {
+            "vendor": connection.vendor,
+            "rounds": rounds,
+            "warmup": warmup,
+            "dataset": dataset_counts(),
+        },
+        "benchmarks": results,
+    }
+
+
+def compare_reports(baseline, report):
+    '''
+    Returns
+    -------
+    list of (name, baseline p50, p50, relative change, baseline queries,
+    queries) for the benchmarks in both reports
+    '''
+    rows = []
+    for name, result in report["benchmarks"].items():
+        base = baseline["benchmarks"].get(name)
+        if base is None:
+            continue
+        change = (result["p50"] - base["p50"]) / base["p50"] if base[
+            "p50"] else 0.0
+        rows.append((name, base["p50"], result["p50"], change, base["queries"],
+                     result["queries"]))
+    return rows
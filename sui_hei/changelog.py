@@ -0,0 +1,94 @@
+"""
+changelog.py
+
+Replay of model.changed events to reconnecting subscriptions.
+
+The notifier (notifier.py) writes the events it sends to ChangeLog, one
+row per group, and sends them with the id of their row as sequence
+number ("seq"). Data frames of subscriptions carry the seq of the event
+they result from.
+
+A client restarting a subscription, e.g. after losing its connection or
+a server restart, passes the last seq it received as "lastSeq" in the
+payload of the graphql-ws "start" message. The events of the groups of
+the subscription sent since then are executed again for that
+subscription alone, before any newer frame. If some of them are no
+longer in the log, or there are more than CHANGE_LOG_REPLAY_LIMIT, the
+server sends {"id": id, "type": "resync"} instead, and the client
+should refetch what it displays.
+
+Only the last CHANGE_LOG_SIZE events are kept.
+"""
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import Max, Min
+
+from .models import ChangeLog
+
+CHANGE_LOG_SIZE = settings.CHANGE_LOG_SIZE
+CHANGE_LOG_REPLAY_LIMIT = settings.CHANGE_LOG_REPLAY_LIMIT
+
+
+def log_changes(messages):
+    '''
+    Write model.changed messages to the change log, setting their 'seq',
+    and trim the log.
+
+    Parameters
+    ----------
+    messages: list of model.changed messages, in the order they are sent
+    '''
+    entries = [
+        ChangeLog(
+            group=message['group'],
+            model=message['model'],
+            object_id=message['pk'],
+            version=message['version'],
+            snapshot=message['snapshot']) for message in messages
+    ]
+    if not entries:
+        return
+
+    using = router.db_for_write(ChangeLog)
+    with transaction.atomic(using):
+        if connections[using].features.can_return_ids_from_bulk_insert:
+            ChangeLog.objects.using(using).bulk_create(entries)
+        else:
+            for entry in entries:
+                entry.save(using=using)
+    for message, entry in zip(messages, entries):
+        message['seq'] = entry.id
+
+    ChangeLog.objects.using(using).filter(id__lte=entries[-1].id -
+                                          CHANGE_LOG_SIZE).delete()
+
+
+def missed_changes(groups, last_seq):
+    '''
+    Returns
+    -------
+    list of the model.changed messages of `groups` with a seq above
+    `last_seq`, in order, or None if some of them are no longer in the
+    log or there are more than CHANGE_LOG_REPLAY_LIMIT.
+    '''
+    bounds = ChangeLog.objects.aggregate(first=Min("id"), last=Max("id"))
+    if bounds["first"] is None:
+        return None
+    if not bounds["first"] - 1 <= last_seq <= bounds["last"]:
+        return None
+
+    entries = list(
+        ChangeLog.objects.filter(group__in=groups, id__gt=last_seq)
+        .order_by("id")[:CHANGE_LOG_REPLAY_LIMIT + 1])
+    if len(entries) > CHANGE_LOG_REPLAY_LIMIT:
+        return None
+    return [{
+        'type': 'model.changed',
+        'group': entry.group,
+        'pk': entry.object_id,
+        'model': entry.model,
+        'version': entry.version,
+        'snapshot': entry.snapshot and bytes(entry.snapshot),
+        'seq': entry.id,
+    } for entry in entries]
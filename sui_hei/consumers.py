@@ -23,34 +23,52 @@ The required returned form is:
 """
 
 import asyncio
-import functools
 import json
 import logging
 import pickle
+from concurrent.futures import ThreadPoolExecutor
 
 import redis
-from asgiref.sync import AsyncToSync, async_to_sync
-from channels.consumer import SyncConsumer
+from asgiref.sync import AsyncToSync
+from channels.consumer import AsyncConsumer
 from channels.exceptions import StopConsumer
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from channels.layers import get_channel_layer
 from django.conf import settings
 from django.core.cache import cache
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch.dispatcher import receiver
+from django.utils import translation
+from graphql.execution import ExecutionResult
 from graphql_relay import from_global_id, to_global_id
+from promise import Promise, is_thenable
 from rx import Observable
 
 from schema import schema
 
-from .models import (ChatMessage, Dialogue, DirectMessage, Hint, Puzzle, User,
-                     UserAward)
+from .batch import run_in_worker
+from .changelog import missed_changes
+from .documents import InvalidDocument, execute_document, resolve_document
+from .loaders import reset_loaders
+from .models import (Award, AwardApplication, Bookmark, ChatMessage, ChatRoom,
+                     Comment, Dialogue, DirectMessage, Event, EventAward,
+                     FavoriteChatRoom, Hint, Puzzle, Schedule, Star, User,
+                     UserAward, UserStats)
+from .multiplexer import encode_frame, encode_payload, multiplexer
+from .notifier import change_notifier
+from .response_cache import response_cache
+from .snapshots import snapshot_cache, take_snapshot
+from .subscription import group_name
 
 REDIS_HOST = settings.REDIS_HOST
+GRAPHQL_SUBSCRIPTION_WORKERS = settings.GRAPHQL_SUBSCRIPTION_WORKERS
 
 rediscon = redis.Redis(host=REDIS_HOST["host"], port=REDIS_HOST["port"])
 rediscon.set("onlineUsers", pickle.dumps(set()))
 
+subscription_executor = ThreadPoolExecutor(
+    max_workers=GRAPHQL_SUBSCRIPTION_WORKERS,
+    thread_name_prefix="graphql-subscription")
+
 # {{{1 Constants
 SET_CURRENT_USER = "app/UserNavbar/SET_CURRENT_USER"
 SEND_BROADCAST = "app/Chat/SEND_BROADCAST"
@@ -136,7 +154,8 @@ class MainConsumer(AsyncJsonWebsocketConsumer):
 
 # GraphQL types might use info.context.user to access currently authenticated user.
 # When Query is called, info.context is request object,
-# however when Subscription is called, info.context is scope dict.
+# however when Subscription is called, info.context is a dict holding the
+# user of the subscription group (see multiplexer.py).
 # This is minimal wrapper around dict to mimic object behavior.
 class AttrDict:
     def __init__(self, data):
@@ -159,24 +178,61 @@ class StreamObservable:
         self.observer.on_next(value)
 
 
-class GraphqlSubcriptionConsumer(SyncConsumer):
-    def __init__(self, scope):
-        super().__init__(scope)
+def resolve_promises(result):
+    '''
+    Wait for the fields of a subscription result which completed as
+    promises, e.g. fields batched with DataLoaders, like `execute` does
+    for queries.
+    '''
+    if not isinstance(result.data, dict) or not any(
+            is_thenable(value) for value in result.data.values()):
+        return result
+    try:
+        data = {
+            key: Promise.resolve(value).get() if is_thenable(value) else value
+            for key, value in result.data.items()
+        }
+    except Exception as e:
+        return ExecutionResult(errors=(result.errors or []) + [e])
+    return ExecutionResult(data=data, errors=result.errors)
+
+
+class GraphqlSubcriptionConsumer(AsyncConsumer):
+    """
+    graphql-ws protocol on the event loop.
+
+    Idle subscriptions hold no thread. Executing documents, which may
+    query the database, runs on a pool of GRAPHQL_SUBSCRIPTION_WORKERS
+    threads, and channel layer groups are joined and left on the loop.
+
+    "start" may pass the "lastSeq" of a previous connection to replay
+    the events missed since, see changelog.py.
+    """
+
+    async def websocket_connect(self, message):
+        self.loop = asyncio.get_event_loop()
         self.subscriptions = {}
         self.groups = {}
+        # Frames held back by subscriptions being replayed, by id
+        self.replays = {}
+        # Last seq replayed, by id
+        self.watermarks = {}
+        await self.send({
+            "type": "websocket.accept",
+            "subprotocol": "graphql-ws"
+        })
 
-    def websocket_connect(self, message):
-        self.send({"type": "websocket.accept", "subprotocol": "graphql-ws"})
-
-    def websocket_disconnect(self, message):
+    async def websocket_disconnect(self, message):
         for group in self.groups.keys():
-            group_discard = async_to_sync(self.channel_layer.group_discard)
-            group_discard('django.%s' % group, self.channel_name)
+            await self.channel_layer.group_discard(group, self.channel_name)
+        for id, group in self.subscriptions.items():
+            await self._run(multiplexer.leave, self, id, group)
+        self.subscriptions = {}
 
-        self.send({"type": "websocket.close", "code": 1000})
+        await self.send({"type": "websocket.close", "code": 1000})
         raise StopConsumer()
 
-    def websocket_receive(self, message):
+    async def websocket_receive(self, message):
         request = json.loads(message['text'])
         id = request.get('id')
 
@@ -185,107 +241,254 @@ class GraphqlSubcriptionConsumer(SyncConsumer):
 
         elif request['type'] == 'start':
             payload = request['payload']
-            context = AttrDict(self.scope)
-            context.subscribe = functools.partial(self._subscribe, id)
+            last_seq = payload.get('lastSeq')
+            if id in self.subscriptions:
+                await self._unsubscribe(id)
+            if last_seq is not None:
+                self.replays[id] = []
+            group, result = await self._run(self._join, id, payload)
+            if group is None:
+                self.replays.pop(id, None)
+                await self._send_result(id, result)
+                return
+            for name in group.channel_groups:
+                await self._subscribe(id, name)
+            self.subscriptions[id] = group
+            if last_seq is not None:
+                await self._replay(id, group, last_seq)
 
-            stream = StreamObservable()
+        elif request['type'] == 'stop':
+            await self._unsubscribe(id)
 
-            result = schema.execute(
-                payload['query'],
-                operation_name=payload['operationName'],
-                variable_values=payload['variables'],
+    async def model_changed(self, message):
+        model = message['model']
+        event = (model, message['pk'], message.get('version'))
+        # Groups shared with other sockets run once per event, for the
+        # first socket receiving it
+        groups = set(self.subscriptions[id]
+                     for id in self.groups.get(message['group'], [])
+                     if id in self.subscriptions)
+        for group in groups:
+            if not group.claim(event):
+                continue
+            # Events of a group are executed in order
+            done = self.loop.create_future()
+            previous, group.tail = group.tail, done
+            try:
+                if previous is not None:
+                    await previous
+                await self._run(self._execute, group, message)
+            finally:
+                done.set_result(None)
+
+    def send_frame(self, id, seq, text):
+        """Send a text frame of the subscription `id` from any thread"""
+        self.loop.call_soon_threadsafe(self._deliver, id, seq, text)
+
+    def _deliver(self, id, seq, text):
+        if id in self.replays:
+            self.replays[id].append((seq, text))
+            return
+        # Already replayed
+        watermark = self.watermarks.get(id)
+        if watermark is not None and seq is not None and seq <= watermark:
+            return
+        self.loop.create_task(
+            self.send({
+                'type': 'websocket.send',
+                'text': text
+            }))
+
+    async def _replay(self, id, group, last_seq):
+        # Events sent meanwhile are held back in self.replays[id]
+        try:
+            frames, watermark = None, None
+            if isinstance(last_seq, int) and not isinstance(last_seq, bool):
+                frames, watermark = await self._run(self._missed_frames, id,
+                                                    group, last_seq)
+            if id not in self.subscriptions:
+                return
+            if frames is None:
+                text = json.dumps({'id': id, 'type': 'resync'})
+                await self.send({'type': 'websocket.send', 'text': text})
+            else:
+                for text in frames:
+                    await self.send({'type': 'websocket.send', 'text': text})
+                self.watermarks[id] = watermark
+        finally:
+            for seq, text in self.replays.pop(id, []):
+                self._deliver(id, seq, text)
+
+    def _missed_frames(self, id, group, last_seq):
+        '''
+        Returns
+        -------
+        (frames of the events of `group` after `last_seq`, last seq), or
+        (None, None) if the client has to resync.
+        '''
+        messages = missed_changes(group.channel_groups, last_seq)
+        if messages is None:
+            return None, None
+
+        values = []
+        events = set()
+        for message in messages:
+            # Events sent to several groups of the subscription run once
+            event = (message['model'], message['pk'], message['version'])
+            if event in events:
+                continue
+            events.add(event)
+            instance = snapshot_cache.get(message)
+            if instance is not None:
+                values.append((message['seq'], (instance, message['model'])))
+        watermark = messages[-1]['seq'] if messages else last_seq
+        return multiplexer.replay(group, id, values), watermark
+
+    async def _run(self, function, *args):
+        return await self.loop.run_in_executor(
+            subscription_executor, run_in_worker, lambda args: function(*args),
+            args, translation.get_language())
+
+    def _join(self, id, payload):
+        try:
+            query, document = resolve_document(schema, payload.get('query'),
+                                               payload.get('id'))
+        except InvalidDocument as e:
+            return None, ExecutionResult(errors=e.errors)
+
+        def execute(group, user):
+            # Identical subscriptions share one execution, see
+            # multiplexer.py
+            context = AttrDict({'user': user})
+            context.subscribe = group.channel_groups.append
+            group.stream = StreamObservable()
+            # Each event is a new execution, with loaders of its own
+            root_value = Observable.create(group.stream)\
+                    .do_action(lambda value: reset_loaders(context))\
+                    .share()
+            result = execute_document(
+                schema,
+                document,
+                operation_name=payload.get('operationName'),
+                variable_values=payload.get('variables'),
                 context_value=context,
-                root_value=Observable.create(stream).share(),
-                allow_subscriptions=True,
-            )
+                root_value=root_value,
+                allow_subscriptions=True)
             if hasattr(result, 'subscribe'):
-                result.subscribe(functools.partial(self._send_result, id))
-                self.subscriptions[id] = stream
-            else:
-                self._send_result(id, result)
-
-        elif request['type'] == 'stop':
-            self._unsubscribe(id)
-            if id in self.subscriptions:
-                del self.subscriptions[id]
+                return result.map(resolve_promises)
+            return result
 
-    def model_changed(self, message):
-        model = message['model']
-        pk = message['pk']
+        return multiplexer.join(self, id, query, document,
+                                payload.get('operationName'),
+                                payload.get('variables') or {},
+                                self.scope['user'], execute)
 
-        for id in self.groups.get(model, []):
-            stream = self.subscriptions.get(id)
-            if not stream:
-                continue
-            stream.send((pk, model))
+    def _execute(self, group, message):
+        instance = snapshot_cache.get(message)
+        if instance is not None:
+            group.send((instance, message['model']), message.get('seq'))
 
-    def _subscribe(self, id, model_name):
-        group = self.groups.setdefault(model_name, set())
+    async def _subscribe(self, id, group_name):
+        group = self.groups.setdefault(group_name, set())
         if not len(group):
-            group_add = async_to_sync(self.channel_layer.group_add)
-            group_add('django.%s' % model_name, self.channel_name)
-        self.groups[model_name].add(id)
+            await self.channel_layer.group_add(group_name, self.channel_name)
+        group.add(id)
 
-    def _unsubscribe(self, id):
-        for group, ids in self.groups.items():
+    async def _unsubscribe(self, id):
+        for group, ids in list(self.groups.items()):
             if id not in ids:
                 continue
 
             ids.remove(id)
             if not len(ids):
                 # no more subscriptions for this group
-                group_discard = async_to_sync(self.channel_layer.group_discard)
-                group_discard('django.%s' % group, self.channel_name)
-
-    def _send_result(self, id, result):
+                del self.groups[group]
+                await self.channel_layer.group_discard(group,
+                                                       self.channel_name)
+        if id in self.subscriptions:
+            # The multiplexer lock is held while executing documents
+            await self._run(multiplexer.leave, self, id,
+                            self.subscriptions.pop(id))
+        self.replays.pop(id, None)
+        self.watermarks.pop(id, None)
+
+    async def _send_result(self, id, result):
         # Don't send results if no useful data is generated
-        errors = result.errors
-        if not errors:
-            if not isinstance(result.data, dict):
-                return
-            if sum(map(lambda x: x != None, result.data.values())) == 0:
-                return
+        payload = encode_payload(result)
+        if payload is None:
+            return
 
-        self.send({
-            'type':
-            'websocket.send',
-            'text':
-            json.dumps({
-                'id': id,
-                'type': 'data',
-                'payload': {
-                    'data': result.data,
-                    'errors': list(map(str, errors)) if errors else None,
-                }
-            })
+        await self.send({
+            'type': 'websocket.send',
+            'text': encode_frame(id, payload)
         })
 
 
-def notify_on_model_changes(model):
+def _evict_cached_responses(model_label):
+    def receiver(sender, instance, **kwargs):
+        response_cache.evict(model_label)
+
+    return receiver
+
+
+def notify_on_model_changes(model, topics=()):
+    """
+    Publish changes of `model` to subscriptions of the whole model, and
+    to subscriptions of the instances whose value of each field in
+    `topics` is that of the changed instance, when the transaction
+    commits.
+    """
     from django.contrib.contenttypes.models import ContentType
     ct = ContentType.objects.get_for_model(model)
     model_label = '.'.join([ct.app_label, ct.model])
 
-    channel_layer = get_channel_layer()
-
-    def receiver(sender, instance, **kwargs):
-        payload = {
-            'type': 'model.changed',
-            'pk': instance.pk,
-            'model': model_label,
-        }
-        async_to_sync(channel_layer.group_send)('django.%s' % model_label,
-                                                payload)
+    def receiver(sender, instance, using, **kwargs):
+        response_cache.evict(model_label)
+        version, snapshot = take_snapshot(instance)
+        groups = [group_name(model_label)] + [
+            group_name(model_label, field, getattr(instance, field))
+            for field in topics
+        ]
+        # Sent once the transaction commits, see notifier.py
+        change_notifier.notify(model_label, instance.pk, version, snapshot,
+                               groups, using)
 
     post_save.connect(
         receiver,
         sender=model,
         weak=False,
         dispatch_uid='django.%s' % model_label)
+    post_delete.connect(
+        _evict_cached_responses(model_label),
+        sender=model,
+        weak=False,
+        dispatch_uid='django.%s' % model_label)
+
+
+def evict_on_model_changes(model):
+    """Evict cached responses of models without subscriptions"""
+    model_label = model._meta.label_lower
+    receiver = _evict_cached_responses(model_label)
+
+    post_save.connect(
+        receiver,
+        sender=model,
+        weak=False,
+        dispatch_uid='evict.%s' % model_label)
+    post_delete.connect(
+        receiver,
+        sender=model,
+        weak=False,
+        dispatch_uid='evict.%s' % model_label)
+
 
+notify_on_model_changes(ChatMessage, topics=['chatroom_id'])
+notify_on_model_changes(Dialogue, topics=['puzzle_id'])
+notify_on_model_changes(Hint, topics=['puzzle_id'])
+notify_on_model_changes(Puzzle, topics=['id'])
+notify_on_model_changes(DirectMessage, topics=['receiver_id'])
 
-notify_on_model_changes(ChatMessage)
-notify_on_model_changes(Dialogue)
-notify_on_model_changes(Hint)
-notify_on_model_changes(Puzzle)
-notify_on_model_changes(DirectMessage)
+for model in (Award, AwardApplication, Bookmark, ChatRoom, Comment, Event,
+              EventAward, FavoriteChatRoom, Schedule, Star, User, UserAward,
+              UserStats):
+    evict_on_model_changes(model)
@@ -0,0 +1,93 @@
+"""
+counts.py
+
+Count service for the total_count of connections.
+
+Counts are cached for COUNT_CACHE_TIMEOUT seconds, keyed by the SQL of
+the (unordered) queryset and the versions of every table it reads.
+Saving or deleting a row bumps the version of its table (see
+versions.py), so cached counts of every process are invalidated as soon
+as the relevant model changes.
+
+Before counting, the planner is asked for an estimate where the
+database supports it (PostgreSQL). Sets estimated above
+COUNT_ESTIMATE_THRESHOLD rows return the estimate instead of scanning
+the whole set, and are flagged as inexact.
+"""
+
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+from .versions import bump_version, get_versions
+
+COUNT_CACHE_TIMEOUT = settings.COUNT_CACHE_TIMEOUT
+COUNT_ESTIMATE_THRESHOLD = settings.COUNT_ESTIMATE_THRESHOLD
+
+VERSION_KEY = "count-version:%s"
+
+
+def _tables(qs):
+    tables = {qs.model._meta.db_table}
+    tables.update(
+        join.table_name for join in qs.query.alias_map.values()
+        if join.table_name)
+    return sorted(tables)
+
+
+def _cache_key(qs, sql, params):
+    tables = _tables(qs)
+    versions = get_versions([VERSION_KEY % table for table in tables])
+    digest = hashlib.md5(repr((sql, params)).encode()).hexdigest()
+    return "count:%s:%s" % (digest, ",".join(
+        str(versions[VERSION_KEY % table]) for table in tables))
+
+
+def estimate_count(qs, sql, params):
+    '''
+    Get the planner's estimate of the row count of qs.
+
+    Returns
+    -------
+    estimated number of rows, or None if the database can't estimate.
+    '''
+    connection = connections[qs.db]
+    if connection.vendor != 'postgresql':
+        return None
+
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def count_queryset(qs):
+    '''
+    Count qs with caching and estimation.
+
+    Returns
+    -------
+    (count, exact)
+    '''
+    qs = qs.order_by()
+    sql, params = qs.query.sql_with_params()
+    key = _cache_key(qs, sql, params)
+
+    result = cache.get(key)
+    if result is None:
+        estimate = estimate_count(qs, sql, params)
+        if estimate is not None and estimate > COUNT_ESTIMATE_THRESHOLD:
+            result = (estimate, False)
+        else:
+            result = (qs.count(), True)
+        cache.set(key, result, COUNT_CACHE_TIMEOUT)
+    return result
+
+
+def invalidate_counts(sender, **kwargs):
+    bump_version(VERSION_KEY % sender._meta.db_table)
@@ -0,0 +1,282 @@
+"""
+dataset.py
+
+Synthetic dataset for benchmarks.
+
+Rows are bulk inserted into the configured database, skewed the way a
+live site is: a few users write most puzzles, a few puzzles get most
+questions, and most chat happens in the lobby. Denormalized counters,
+user statistics, the search index and the rollups are rebuilt at the
+end, since bulk inserts bypass the signals maintaining them.
+
+Usage:
+    generate_dataset(DATASET_SIZES, days=730, seed=0)
+"""
+
+import random
+from bisect import bisect
+from datetime import timedelta
+from itertools import accumulate
+
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.utils import timezone
+
+from .models import (Bookmark, ChatMessage, ChatRoom, Comment, Dialogue,
+                     DirectMessage, Hint, Puzzle, Star, User, UserStats)
+from .rollups import rebuild_rollups
+from .search import rebuild_index
+
+# Default number of rows of each model
+DATASET_SIZES = {
+    "users": 1000,
+    "puzzles": 5000,
+    "dialogues": 50000,
+    "stars": 30000,
+    "comments": 8000,
+    "bookmarks": 8000,
+    "chatrooms": 20,
+    "chatmessages": 30000,
+    "directmessages": 10000,
+}
+
+BATCH_SIZE = 1000
+PASSWORD = "benchmark"
+
+# Words of the generated texts, so that they have realistic bigrams
+WORDS = [
+    "男", "女", "スープ", "ウミガメ", "レストラン", "海", "船", "島", "料理", "注文", "一口", "飲んだ",
+    "食べた", "自殺", "涙", "嘘", "本当", "死んだ", "生きて", "遭難", "仲間", "肉", "味", "店員",
+    "シェフ", "夜", "朝", "雨", "部屋", "鍵", "電話", "手紙", "写真", "時計", "病院", "医者", "子供",
+    "父", "母", "兄", "友達", "犬", "猫", "雪", "山", "森", "電車", "駅", "学校", "先生", "なぜ",
+    "どうして"
+]
+
+
+class Sampler(object):
+    '''
+    Choose items with Zipf-like weights: the n-th item is chosen
+    proportionally to 1 / (n + 1) ** exponent.
+    '''
+
+    def __init__(self, items, rng, exponent=1.0):
+        self.items = list(items)
+        self.rng = rng
+        self.cumulative = list(
+            accumulate(1 / (n + 1)**exponent for n in range(len(self.items))))
+
+    def __call__(self):
+        x = self.rng.random() * self.cumulative[-1]
+        return self.items[bisect(self.cumulative, x)]
+
+
+def _text(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def _between(rng, start, end):
+    return start + (end - start) * rng.random()
+
+
+def _pairs(rng, pick_user, pick_puzzle, count):
+    '''
+    Returns
+    -------
+    up to `count` distinct (user, puzzle) pairs
+    '''
+    pairs = set()
+    for _ in range(count * 2):
+        if len(pairs) >= count:
+            break
+        pairs.add((pick_user(), pick_puzzle()))
+    return pairs
+
+
+def _bulk_create(model, objs):
+    # Django further splits batches to fit the limits of the backend
+    with transaction.atomic():
+        for i in range(0, len(objs), BATCH_SIZE):
+            model.objects.bulk_create(objs[i:i + BATCH_SIZE])
+
+
+# {{{1 generate_dataset
+def generate_dataset(sizes=DATASET_SIZES, days=730, seed=0, log=None):
+    '''
+    Insert a synthetic dataset spanning the last `days` days.
+
+    Parameters
+    ----------
+    sizes: {name: number of rows}, with the keys of DATASET_SIZES
+    seed: seed of the random generator, for reproducible datasets
+    log: function called with progress messages
+
+    Returns
+    -------
+    {name: number of rows inserted}
+    '''
+    log = log or (lambda message: None)
+    rng = random.Random(seed)
+    now = timezone.now()
+    start = now - timedelta(days=days)
+    offset = User.objects.count()
+    created = {}
+
+    # Users
+    password = make_password(PASSWORD)
+    users = [
+        User(
+            username="bench%d" % (offset + i),
+            nickname="bench%d" % (offset + i),
+            password=password,
+            date_joined=_between(rng, start, now))
+        for i in range(sizes["users"])
+    ]
+    users.sort(key=lambda user: user.date_joined)
+    _bulk_create(User, users)
+    users = list(
+        User.objects.filter(
+            username__startswith="bench").order_by("-id")[:len(users)])
+    created["users"] = len(users)
+    log("%d users" % len(users))
+    # Most content comes from the same few users
+    pick_user = Sampler(rng.sample(users, len(users)), rng, 0.8)
+
+    # Puzzles
+    puzzles = []
+    for _ in range(sizes["puzzles"]):
+        user = pick_user()
+        puzzle_created = _between(rng, max(user.date_joined, start), now)
+        age = now - puzzle_created
+        if age < timedelta(days=7):
+            status = 0 if rng.random() < 0.8 else 1
+        else:
+            status = rng.choice([1] * 16 + [2] * 3 + [3])
+        puzzles.append(
+            Puzzle(
+                user=user,
+                title=_text(rng, 3),
+                content=_text(rng, 40),
+                solution=_text(rng, 30),
+                genre=rng.choice([0] * 6 + [1, 2, 3]),
+                yami=rng.choice([0] * 9 + [1]),
+                created=puzzle_created,
+                modified=min(
+                    puzzle_created + timedelta(days=rng.random() * 7), now),
+                dazed_on=(puzzle_created + timedelta(days=7)).date(),
+                status=status))
+    puzzles.sort(key=lambda puzzle: puzzle.created)
+    _bulk_create(Puzzle, puzzles)
+    puzzles = list(Puzzle.objects.order_by("-id")[:len(puzzles)])
+    created["puzzles"] = len(puzzles)
+    log("%d puzzles" % len(puzzles))
+    # A few popular puzzles get most questions and stars
+    pick_puzzle = Sampler(rng.sample(puzzles, len(puzzles)), rng, 0.6)
+
+    # Dialogues and hints
+    dialogues = []
+    for _ in range(sizes["dialogues"]):
+        puzzle = pick_puzzle()
+        asked = _between(rng, puzzle.created, puzzle.modified)
+        answered = puzzle.status != 0 or rng.random() < 0.7
+        dialogues.append(
+            Dialogue(
+                user=pick_user(),
+                puzzle=puzzle,
+                question=_text(rng, 8),
+                answer=_text(rng, 2) if answered else "",
+                good=rng.random() < 0.1,
+                true=puzzle.status == 1 and rng.random() < 0.05,
+                created=asked,
+                answeredtime=asked + timedelta(minutes=rng.random() * 30)
+                if answered else None))
+    dialogues.sort(key=lambda dialogue: dialogue.created)
+    _bulk_create(Dialogue, dialogues)
+    created["dialogues"] = len(dialogues)
+    hints = [
+        Hint(
+            puzzle=puzzle,
+            content=_text(rng, 10),
+            created=_between(rng, puzzle.created, puzzle.modified))
+        for puzzle in puzzles if rng.random() < 0.1
+    ]
+    _bulk_create(Hint, hints)
+    created["hints"] = len(hints)
+    log("%d dialogues, %d hints" % (len(dialogues), len(hints)))
+
+    # Stars, comments and bookmarks, at most one per user and puzzle
+    stars = [
+        Star(user=user, puzzle=puzzle, value=rng.randint(1, 5))
+        for user, puzzle in _pairs(rng, pick_user, pick_puzzle, sizes["stars"])
+    ]
+    _bulk_create(Star, stars)
+    comments = [
+        Comment(
+            user=user,
+            puzzle=puzzle,
+            content=_text(rng, 12),
+            spoiler=rng.random() < 0.3) for user, puzzle in _pairs(
+                rng, pick_user, pick_puzzle, sizes["comments"])
+    ]
+    _bulk_create(Comment, comments)
+    bookmarks = [
+        Bookmark(user=user, puzzle=puzzle,
+                 value=rng.randint(0, 10)) for user, puzzle in _pairs(
+                     rng, pick_user, pick_puzzle, sizes["bookmarks"])
+    ]
+    _bulk_create(Bookmark, bookmarks)
+    created.update(
+        stars=len(stars), comments=len(comments), bookmarks=len(bookmarks))
+    log("%d stars, %d comments, %d bookmarks" % (len(stars), len(comments),
+                                                 len(bookmarks)))
+
+    # Chat
+    chatrooms = [
+        ChatRoom(
+            user=pick_user(),
+            name="bench-%d-%d" % (offset, i),
+            description=_text(rng, 5),
+            private=i > 0 and rng.random() < 0.3,
+            created=start.date()) for i in range(sizes["chatrooms"])
+    ]
+    _bulk_create(ChatRoom, chatrooms)
+    chatrooms = list(
+        ChatRoom.objects.filter(name__startswith="bench-%d-" % offset)
+        .order_by("id"))
+    # The first room plays the lobby
+    pick_chatroom = Sampler(chatrooms, rng, 1.5)
+    chatmessages = [
+        ChatMessage(
+            user=pick_user(),
+            chatroom=pick_chatroom(),
+            content=_text(rng, 6),
+            created=_between(rng, start, now))
+        for _ in range(sizes["chatmessages"])
+    ]
+    chatmessages.sort(key=lambda message: message.created)
+    _bulk_create(ChatMessage, chatmessages)
+    directmessages = []
+    for _ in range(sizes["directmessages"]):
+        sender, receiver = pick_user(), pick_user()
+        if sender != receiver:
+            directmessages.append(
+                DirectMessage(
+                    sender=sender,
+                    receiver=receiver,
+                    content=_text(rng, 6),
+                    created=_between(rng, start, now)))
+    directmessages.sort(key=lambda message: message.created)
+    _bulk_create(DirectMessage, directmessages)
+    created.update(
+        chatrooms=len(chatrooms),
+        chatmessages=len(chatmessages),
+        directmessages=len(directmessages))
+    log("%d chatrooms, %d chat messages, %d direct messages" %
+        (len(chatrooms), len(chatmessages), len(directmessages)))
+
+    # Denormalized data
+    Puzzle.objects.reconcile_counters()
+    UserStats.objects.rebuild()
+    rebuild_index()
+    rebuild_rollups()
+    log("Rebuilt counters, user statistics, search index and rollups")
+    return created
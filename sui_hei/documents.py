@@ -0,0 +1,223 @@
+"""
+documents.py
+
+Parsed and validated GraphQL documents shared by the HTTP view and the
+websocket consumer.
+
+Persisted queries are read from PERSISTED_QUERIES_FILE, a JSON object
+mapping the sha256 hex digest of each query text to the text itself,
+which `make schema` generates with dumpPersistedQueries.py. Each query is
+parsed and validated once at startup, so clients can send
+`{id, variables}` instead of the full text and skip both steps.
+
+If PERSISTED_QUERIES_ONLY is set, queries that are not registered are
+rejected. Other queries go through a LRU of DOCUMENT_CACHE_SIZE parsed
+and validated documents keyed by the hash of the query text, so repeated
+queries are parsed and validated only once per process.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from graphql import Source, parse, validate
+from graphql.error import GraphQLError
+from graphql.execution import ExecutionResult, execute
+from graphql.utils.get_operation_ast import get_operation_ast
+
+from .query_cost import check_query_cost
+
+PERSISTED_QUERIES_FILE = settings.PERSISTED_QUERIES_FILE
+PERSISTED_QUERIES_ONLY = settings.PERSISTED_QUERIES_ONLY
+DOCUMENT_CACHE_SIZE = settings.DOCUMENT_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+def query_id(query):
+    return hashlib.sha256(query.encode()).hexdigest()
+
+
+class InvalidDocument(Exception):
+    def __init__(self, errors):
+        super(InvalidDocument, self).__init__(errors)
+        self.errors = errors
+
+
+def parse_document(schema, query):
+    '''
+    Returns
+    -------
+    (document, errors), where errors is a list of syntax or validation
+    errors, and document is None on syntax errors.
+    '''
+    try:
+        document = parse(Source(query, 'GraphQL request'))
+    except GraphQLError as e:
+        return None, [e]
+    return document, validate(schema, document)
+
+
+# {{{1 PersistedQueries
+class PersistedQueries(object):
+    def __init__(self):
+        self.documents = {}
+
+    def load(self, path, schema):
+        '''
+        Load, parse and validate persisted queries from `path`.
+        '''
+        self.documents = {}
+        if not os.path.exists(path):
+            logger.info("No persisted queries found at %s" % path)
+            return
+
+        with open(path) as f:
+            queries = json.load(f)
+
+        for id, query in queries.items():
+            if id != query_id(query):
+                logger.warning("Persisted query %s: hash mismatch" % id)
+                continue
+            document, errors = parse_document(schema, query)
+            if errors:
+                logger.warning("Persisted query %s: %s" % (id, errors))
+                continue
+            self.documents[id] = (query, document)
+
+        logger.info("Loaded %d persisted queries" % len(self.documents))
+
+    def get(self, id):
+        '''
+        Returns
+        -------
+        (query, document) of the persisted query, or None.
+        '''
+        return self.documents.get(id)
+
+
+persisted_queries = PersistedQueries()
+
+
+# {{{1 DocumentCache
+class DocumentCache(object):
+    '''
+    LRU of parsed and validated documents, keyed by `query_id`.
+
+    Invalid documents are cached along with their errors. `time_saved`
+    sums the parse and validation time of the documents served from the
+    cache.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.time_saved = 0.0
+        self.lock = threading.Lock()
+
+    def get(self, schema, query):
+        '''
+        Returns
+        -------
+        (document, errors) as returned by `parse_document`.
+        '''
+        key = query_id(query)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                self.time_saved += entry[2]
+                return entry[0], entry[1]
+            self.misses += 1
+
+        start = time.perf_counter()
+        document, errors = parse_document(schema, query)
+        elapsed = time.perf_counter() - start
+
+        with self.lock:
+            self.entries[key] = (document, errors, elapsed)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return document, errors
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRatio": self.hits / total if total else 0.0,
+            "timeSaved": self.time_saved,
+        }
+
+
+document_cache = DocumentCache(DOCUMENT_CACHE_SIZE)
+
+
+# {{{1 resolve_document
+def resolve_document(schema, query=None, id=None):
+    '''
+    Find the parsed and validated document for a request carrying either
+    `query` or `id`.
+
+    Returns
+    -------
+    (query, document)
+
+    Raises
+    ------
+    InvalidDocument if the query is unknown, malformed or invalid.
+    '''
+    if not query and id:
+        persisted = persisted_queries.get(id)
+        if persisted is None:
+            raise InvalidDocument(
+                [GraphQLError("Unknown persisted query: %s" % id)])
+        return persisted
+
+    if not query:
+        raise InvalidDocument([GraphQLError("Must provide query string.")])
+
+    persisted = persisted_queries.get(query_id(query))
+    if persisted is not None:
+        return persisted
+
+    if PERSISTED_QUERIES_ONLY:
+        raise InvalidDocument(
+            [GraphQLError("Only persisted queries are allowed")])
+
+    document, errors = document_cache.get(schema, query)
+    if errors:
+        raise InvalidDocument(errors)
+    return query, document
+
+
+# {{{1 execute_document
+def execute_document(schema, document, **kwargs):
+    '''
+    Execute a parsed and validated document, unless the operation is too
+    expensive (see query_cost.py).
+
+    Takes the same keyword arguments as `schema.execute`.
+    '''
+    kwargs['variable_values'] = kwargs.get('variable_values') or {}
+    try:
+        operation = get_operation_ast(document, kwargs.get('operation_name'))
+        if operation is not None:
+            check_query_cost(schema, document, operation,
+                             kwargs['variable_values'])
+        return execute(schema, document, **kwargs)
+    except Exception as e:
+        return ExecutionResult(errors=[e], invalid=True)
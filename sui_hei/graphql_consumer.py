@@ -0,0 +1,112 @@
+"""
+graphql_consumer.py
+
+Async GraphQL endpoint on the ASGI stack.
+
+GraphQLHttpConsumer speaks the same protocol as SuiheiGraphQLView, which
+it uses to parse and execute requests, but only holds a thread while an
+operation is executing: the request body is received and the response
+sent on the event loop. Operations run on a pool of GRAPHQL_ASGI_WORKERS
+threads, the queries of a batch concurrently and anything else in order
+(see batch.py).
+
+Sessions and users come from channels' AuthMiddlewareStack. POST requests
+are checked against CSRF like the Django view.
+"""
+
+import asyncio
+import copy
+import inspect
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from channels.generic.http import AsyncHttpConsumer
+from channels.http import AsgiHandler, AsgiRequest
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotAllowed
+from django.middleware.csrf import CsrfViewMiddleware
+from django.utils import translation
+from graphene_django.views import HttpError
+
+from .batch import execute_batch_async, run_in_worker
+from .graphql_view import SuiheiGraphQLView
+
+GRAPHQL_ASGI_WORKERS = settings.GRAPHQL_ASGI_WORKERS
+
+executor = ThreadPoolExecutor(
+    max_workers=GRAPHQL_ASGI_WORKERS, thread_name_prefix="graphql-asgi")
+
+# AsgiRequest takes the body as bytes before channels 2.3, and as a
+# stream since then
+ASGI_REQUEST_TAKES_STREAM = "stream" in inspect.signature(
+    AsgiRequest.__init__).parameters
+
+
+class GraphQLHttpConsumer(AsyncHttpConsumer):
+    # No channel layer is needed to answer plain HTTP requests
+    channel_layer_alias = None
+    view = SuiheiGraphQLView(batch=True)
+
+    async def handle(self, body):
+        request = AsgiRequest(
+            self.scope,
+            BytesIO(body) if ASGI_REQUEST_TAKES_STREAM else body)
+        request.user = self.scope["user"]
+        request.session = self.scope["session"]
+
+        csrf = CsrfViewMiddleware()
+        response = csrf.process_request(request) or csrf.process_view(
+            request, self.handle, (), {})
+        if response is None:
+            try:
+                response = await self.get_response(request)
+            except HttpError as e:
+                response = e.response
+                response['Content-Type'] = 'application/json'
+                response.content = self.view.json_encode(
+                    request, {'errors': [self.view.format_error(e)]})
+        # Sets the CSRF cookie if the token was used or rotated, e.g. on
+        # login. Sessions are saved by channels' SessionMiddleware.
+        response = csrf.process_response(request, response)
+
+        for message in AsgiHandler.encode_response(response):
+            await self.send(message)
+
+    async def get_response(self, request):
+        method = request.method.lower()
+        if method not in ('get', 'post'):
+            raise HttpError(
+                HttpResponseNotAllowed(
+                    ['GET', 'POST'],
+                    'GraphQL only supports GET and POST requests.'))
+
+        language = translation.get_language()
+        loop = asyncio.get_event_loop()
+
+        async def run(data):
+            # Each operation gets its own copy of the request as context,
+            # so that DataLoaders are not shared across threads
+            return await loop.run_in_executor(
+                executor, run_in_worker,
+                lambda data: self.view.get_response(copy.copy(request), data),
+                data, language)
+
+        if method == 'get':
+            # GET requests carry a single operation in the query string
+            result, status_code = await run({})
+            return HttpResponse(
+                status=status_code,
+                content=result,
+                content_type='application/json')
+
+        data = self.view.parse_body(request)
+        responses = await execute_batch_async(
+            data, lambda entry: self.view.is_read_only(request, entry), run)
+        result = '[{}]'.format(','.join(
+            [response[0] for response in responses]))
+        status_code = responses and max(response[1]
+                                        for response in responses) or 200
+        return HttpResponse(
+            status=status_code,
+            content=result,
+            content_type='application/json')
@@ -0,0 +1,138 @@
+import copy
+
+from django.http import (HttpResponse, HttpResponseBadRequest,
+                         HttpResponseNotAllowed)
+from django.utils import translation
+from graphene_django.views import GraphQLView, HttpError
+from graphql.execution import ExecutionResult
+from graphql.execution.middleware import MiddlewareManager
+from graphql.utils.get_operation_ast import get_operation_ast
+
+from .batch import execute_batch
+from .documents import InvalidDocument, execute_document, resolve_document
+from .response_cache import response_cache
+
+
+class SuiheiGraphQLView(GraphQLView):
+    '''
+    GraphQLView accepting persisted query ids in place of query text,
+    parsing documents through the shared document cache, and serving
+    anonymous queries from the shared response cache.
+
+    The queries of batched requests are executed concurrently (see
+    batch.py).
+    '''
+
+    def __init__(self, **kwargs):
+        super(SuiheiGraphQLView, self).__init__(**kwargs)
+        # Middleware handle promises themselves. Don't wrap the result of
+        # every resolver in one.
+        if self.middleware and not isinstance(self.middleware,
+                                              MiddlewareManager):
+            self.middleware = MiddlewareManager(
+                *self.middleware, wrap_in_promise=False)
+
+    def dispatch(self, request, *args, **kwargs):
+        if not self.batch or request.method.lower() != 'post':
+            return super(SuiheiGraphQLView, self).dispatch(
+                request, *args, **kwargs)
+
+        try:
+            data = self.parse_body(request)
+            # Load the user once, before sharing the request across threads
+            request.user.is_anonymous
+            # Each operation gets its own copy of the request as context,
+            # so that DataLoaders are not shared across threads
+            responses = execute_batch(
+                data, lambda entry: self.is_read_only(request, entry),
+                lambda entry: self.get_response(copy.copy(request), entry))
+            result = '[{}]'.format(','.join(
+                [response[0] for response in responses]))
+            status_code = responses and max(response[1]
+                                            for response in responses) or 200
+            return HttpResponse(
+                status=status_code,
+                content=result,
+                content_type='application/json')
+
+        except HttpError as e:
+            response = e.response
+            response['Content-Type'] = 'application/json'
+            response.content = self.json_encode(
+                request, {'errors': [self.format_error(e)]})
+            return response
+
+    def is_read_only(self, request, data):
+        '''
+        Tell whether the operation of a batch entry is a query, so that it
+        can run concurrently with others.
+        '''
+        try:
+            query, variables, operation_name, id = self.get_graphql_params(
+                request, data)
+            query, document = resolve_document(self.schema, query, id)
+        except (HttpError, InvalidDocument):
+            # Fails in get_response without touching the database
+            return True
+        operation_ast = get_operation_ast(document, operation_name)
+        return operation_ast is not None and operation_ast.operation == 'query'
+
+    def execute_graphql_request(self, request, data, query, variables,
+                                operation_name, show_graphiql=False):
+        id = request.GET.get('id') or data.get('id')
+        if not query and not id:
+            if show_graphiql:
+                return None
+            raise HttpError(
+                HttpResponseBadRequest('Must provide query string.'))
+
+        try:
+            query, document = resolve_document(self.schema, query, id)
+        except InvalidDocument as e:
+            return ExecutionResult(errors=e.errors, invalid=True)
+
+        if not request.user.is_anonymous:
+            return self.execute_document_request(request, data, query,
+                                                 document, variables,
+                                                 operation_name, show_graphiql)
+
+        key = response_cache.make_key(query, variables, operation_name,
+                                      translation.get_language())
+        result = response_cache.get(key)
+        if result is not None:
+            return result
+
+        versions = response_cache.versions()
+        with response_cache.track_models() as models:
+            result = self.execute_document_request(
+                request, data, query, document, variables, operation_name,
+                show_graphiql)
+
+        if result and not result.errors and not result.invalid:
+            operation_ast = get_operation_ast(document, operation_name)
+            if operation_ast and operation_ast.operation == 'query':
+                response_cache.set(key, result, models, versions)
+        return result
+
+    def execute_document_request(self, request, data, query, document,
+                                 variables, operation_name, show_graphiql):
+        if request.method.lower() == 'get':
+            operation_ast = get_operation_ast(document, operation_name)
+            if operation_ast and operation_ast.operation != 'query':
+                if show_graphiql:
+                    return None
+                raise HttpError(
+                    HttpResponseNotAllowed(
+                        ['POST'],
+                        'Can only perform a {} operation from a POST request.'.
+                        format(operation_ast.operation)))
+
+        return execute_document(
+            self.schema,
+            document,
+            root_value=self.get_root_value(request),
+            variable_values=variables,
+            operation_name=operation_name,
+            context_value=self.get_context(request),
+            middleware=self.get_middleware(request),
+            executor=self.executor)
@@ -0,0 +1,144 @@
+"""
+loaders.py
+
+Per-request DataLoaders batching the aggregate fields of nodes.
+
+Each loader collects the primary keys requested while a page is being
+resolved and fetches the aggregate of all of them with a single grouped
+query. Loaders are created lazily and stored on `info.context`, so that
+their caches last for one execution. For queries, the context is a copy
+of the request made for each operation. For subscriptions, it is the
+`AttrDict` of a subscription group, which is executed once per event, so
+the consumer calls `reset_loaders` before each event.
+
+Usage:
+    def resolve_quesCount(self, info):
+        return get_loader(info, "user.quesCount").load(self.id)
+"""
+
+from django.db.models import Count, Sum
+from promise import Promise
+from promise.dataloader import DataLoader
+
+from .metrics import instrument_loader
+from .models import Comment, Dialogue, Star, UserStats
+
+CONTEXT_ATTR = "_sui_hei_loaders"
+
+
+# {{{1 AggregateLoader
+class AggregateLoader(DataLoader):
+    '''
+    Load `aggregate` of `queryset` grouped by `key` for a batch of keys.
+
+    Parameters
+    ----------
+    queryset: QuerySet of the related model, e.g. `Dialogue.objects.all()`
+    key: name of the field to group by, e.g. "puzzle"
+    aggregate: Django aggregate expression, e.g. `Count("id")`
+    default: value for keys without any related rows
+    '''
+
+    def __init__(self, queryset, key, aggregate, default=0):
+        super(AggregateLoader, self).__init__()
+        self.queryset = queryset
+        self.key = key
+        self.aggregate = aggregate
+        self.default = default
+
+    def batch_load_fn(self, keys):
+        rows = self.queryset\
+                .filter(**{"%s__in" % self.key: keys})\
+                .order_by()\
+                .values(self.key)\
+                .annotate(result=self.aggregate)\
+                .values_list(self.key, "result")
+        results = dict(rows)
+        return Promise.resolve([
+            results.get(key) if results.get(key) is not None else self.default
+            for key in keys
+        ])
+
+
+# {{{1 UserStatsLoader
+class UserStatsLoader(DataLoader):
+    '''
+    Load `UserStats` rows for a batch of user ids. Statistics of users
+    without a row are computed, but left to the signals to save.
+    '''
+
+    def batch_load_fn(self, keys):
+        stats = {s.user_id: s for s in UserStats.objects.filter(user__in=keys)}
+        missing = [key for key in keys if key not in stats]
+        if missing:
+            stats.update({
+                s.user_id: s
+                for s in UserStats.objects.compute(users=missing)
+            })
+        return Promise.resolve([stats.get(key) for key in keys])
+
+
+# {{{1 SolvedPuzzleLoader
+class SolvedPuzzleLoader(DataLoader):
+    '''
+    Load whether a user has a true question on a puzzle, for a batch of
+    (user_id, puzzle_id) keys.
+    '''
+
+    def batch_load_fn(self, keys):
+        solved = set(
+            Dialogue.objects\
+                    .filter(true=True,
+                            user__in={user for user, puzzle in keys},
+                            puzzle__in={puzzle for user, puzzle in keys})\
+                    .order_by()\
+                    .values_list("user", "puzzle")\
+                    .distinct())
+        return Promise.resolve([key in solved for key in keys])
+
+
+# {{{1 Registry
+LOADERS = {
+    # {{{2 User
+    "user.quesCount":
+    lambda: AggregateLoader(Dialogue.objects.all(), "user", Count("id")),
+    "user.commentCount":
+    lambda: AggregateLoader(Comment.objects.all(), "user", Count("id")),
+    "user.starCount":
+    lambda: AggregateLoader(Star.objects.all(), "user", Count("id")),
+    "user.starSum":
+    lambda: AggregateLoader(Star.objects.all(), "user", Sum("value")),
+    "user.stats":
+    UserStatsLoader,
+    # {{{2 Puzzle
+    "puzzle.solvedBy":
+    SolvedPuzzleLoader,
+} # yapf: disable
+
+
+# {{{1 get_loader
+def get_loader(info, name):
+    '''
+    Get the loader registered as `name`, creating it on first use.
+
+    Loaders are cached on `info.context`, so every node resolved in the
+    same operation shares one batch.
+    '''
+    context = info.context
+    loaders = getattr(context, CONTEXT_ATTR, None)
+    if loaders is None:
+        loaders = {}
+        setattr(context, CONTEXT_ATTR, loaders)
+
+    loader = loaders.get(name)
+    if loader is None:
+        loader = loaders[name] = LOADERS[name]()
+        instrument_loader(info, name, loader)
+    return loader
+
+
+def reset_loaders(context):
+    '''
+    Forget the loaders cached on `context`, before executing again with it.
+    '''
+    setattr(context, CONTEXT_ATTR, {})
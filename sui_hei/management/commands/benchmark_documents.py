@@ -0,0 +1,48 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from schema import schema
+from sui_hei.documents import DocumentCache, parse_document
+
+
+class Command(BaseCommand):
+    help = "Measure the per-request cost of parsing and validating queries, with and without the document cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "file",
+            help="JSON object of queries, e.g. persisted_queries.json")
+        parser.add_argument(
+            "-n",
+            "--rounds",
+            type=int,
+            default=100,
+            help="number of times to resolve each query")
+
+    def handle(self, *args, **options):
+        with open(options["file"]) as f:
+            queries = list(json.load(f).values())
+        rounds = options["rounds"]
+        requests = len(queries) * rounds
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for query in queries:
+                parse_document(schema, query)
+        uncached = time.perf_counter() - start
+
+        cache = DocumentCache(len(queries))
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for query in queries:
+                cache.get(schema, query)
+        cached = time.perf_counter() - start
+
+        self.stdout.write("%d queries x %d rounds" % (len(queries), rounds))
+        self.stdout.write("uncached: %.3f ms/request" %
+                          (uncached * 1000 / requests))
+        self.stdout.write("cached:   %.3f ms/request" %
+                          (cached * 1000 / requests))
+        self.stdout.write("stats: %s" % cache.stats())
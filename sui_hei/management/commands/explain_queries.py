@@ -0,0 +1,138 @@
+import json
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from sui_hei.models import (ChatMessage, Comment, DailyActivity, Dialogue,
+                            DirectMessage, Hint, Puzzle, Star, ValueRollup)
+from sui_hei.search import search_puzzles
+
+# Representative querysets of the hot resolvers, by name.
+# Each one should be answered from an index, whatever the size of the
+# tables.
+QUERY_CATALOGUE = [
+    ("allPuzzles(status)",
+     lambda: Puzzle.objects.filter(status=0).order_by("-created")[:20]),
+    ("allPuzzles(status__gt)",
+     lambda: Puzzle.objects.filter(status__gt=0).order_by("-created")[:20]),
+    ("markPuzzleAsDazed",
+     lambda: Puzzle.objects.filter(status=0, dazed_on__lte=timezone.now().date())),
+    ("puzzleShowUnion.dialogues",
+     lambda: Dialogue.objects.filter(puzzle_id=1).order_by("created")),
+    ("puzzleShowUnion.hints",
+     lambda: Hint.objects.filter(puzzle_id=1).order_by("created")),
+    ("PuzzleNode.solution",
+     lambda: Dialogue.objects.filter(
+         true=True, user_id__in=[1], puzzle_id__in=[1, 2])\
+             .values_list("user_id", "puzzle_id").distinct()),
+    ("allChatmessages(chatroomName)",
+     lambda: ChatMessage.objects.filter(chatroom_id=1).order_by("-id")[:50]),
+    ("allDirectmessages(userId)",
+     lambda: DirectMessage.objects.filter(Q(sender_id=1) | Q(receiver_id=1))\
+             .order_by("-created")[:20]),
+    ("allStars(puzzle)", lambda: Star.objects.filter(puzzle_id=1)),
+    ("allStars(user, puzzle)",
+     lambda: Star.objects.filter(user_id=1, puzzle_id=1)),
+    ("allComments(puzzle)", lambda: Comment.objects.filter(puzzle_id=1)),
+    ("searchPuzzles",
+     lambda: search_puzzles("ウミガメのスープ").order_by("-rank")[:20]),
+    ("truncDateGroups",
+     lambda: DailyActivity.objects.filter(model="Puzzle", user_id=1)),
+    ("truncValueGroups",
+     lambda: ValueRollup.objects.filter(model="Star", field="value")),
+]
+
+
+def explain_postgresql(cursor, sql, params):
+    '''
+    Returns
+    -------
+    (plan text, names of sequentially scanned tables)
+    '''
+    # Make the planner prefer any usable index, so that small tables
+    # don't hide missing ones
+    cursor.execute("SET LOCAL enable_seqscan = off")
+    cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    scanned = []
+
+    def walk(node):
+        if node["Node Type"] == "Seq Scan":
+            scanned.append(node["Relation Name"])
+        for child in node.get("Plans", []):
+            walk(child)
+
+    walk(plan[0]["Plan"])
+    return json.dumps(plan, indent=2), scanned
+
+
+def explain_sqlite(cursor, sql, params):
+    '''
+    Returns
+    -------
+    (plan text, names of sequentially scanned tables)
+    '''
+    cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+    details = [row[-1] for row in cursor.fetchall()]
+    tables = set(connection.introspection.table_names(cursor))
+
+    scanned = []
+    for detail in details:
+        match = re.match(r"SCAN (?:TABLE )?(\w+)", detail)
+        if match and match.group(1) in tables and "INDEX" not in detail:
+            scanned.append(match.group(1))
+    return "\n".join(details), scanned
+
+
+EXPLAINERS = {
+    "postgresql": explain_postgresql,
+    "sqlite": explain_sqlite,
+}
+
+
+class Command(BaseCommand):
+    help = "EXPLAIN representative resolver querysets and flag sequential scans"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "names",
+            nargs="*",
+            help="names of the queries to explain (default: all queries)")
+        parser.add_argument(
+            "--plans",
+            action="store_true",
+            help="print the plan of every query")
+
+    def handle(self, *args, **options):
+        explain = EXPLAINERS.get(connection.vendor)
+        if explain is None:
+            raise CommandError(
+                "EXPLAIN is not supported on %s" % connection.vendor)
+
+        catalogue = [(name, queryset) for name, queryset in QUERY_CATALOGUE
+                     if not options["names"] or name in options["names"]]
+
+        flagged = []
+        for name, queryset in catalogue:
+            sql, params = queryset().query.sql_with_params()
+            with transaction.atomic(), connection.cursor() as cursor:
+                plan, scanned = explain(cursor, sql, params)
+
+            if scanned:
+                flagged.append(name)
+                self.stdout.write(
+                    "SEQ SCAN %s: %s" % (name, ", ".join(scanned)))
+            else:
+                self.stdout.write("OK       %s" % name)
+            if options["plans"] or scanned:
+                self.stdout.write(plan)
+
+        if flagged:
+            raise CommandError("%d of %d queries scan tables sequentially" %
+                               (len(flagged), len(catalogue)))
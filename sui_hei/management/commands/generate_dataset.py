@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from sui_hei.dataset import DATASET_SIZES, generate_dataset
+
+
+class Command(BaseCommand):
+    help = "Insert a synthetic dataset of users, puzzles, dialogues, stars, comments, chat and direct messages for benchmarks"
+
+    def add_arguments(self, parser):
+        for name, default in sorted(DATASET_SIZES.items()):
+            parser.add_argument(
+                "--%s" % name,
+                type=int,
+                default=default,
+                help="number of %s (default: %d)" % (name, default))
+        parser.add_argument(
+            "--scale",
+            type=float,
+            default=1.0,
+            help="multiply every number of rows by SCALE")
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=730,
+            help="spread the data over the last DAYS days")
+        parser.add_argument(
+            "--seed", type=int, default=0, help="seed of the random data")
+
+    def handle(self, *args, **options):
+        sizes = {
+            name: int(options[name] * options["scale"])
+            for name in DATASET_SIZES
+        }
+        start = time.perf_counter()
+        generate_dataset(
+            sizes,
+            days=options["days"],
+            seed=options["seed"],
+            log=self.stdout.write)
+        self.stdout.write("Done in %.1f s" % (time.perf_counter() - start))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from sui_hei.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = "Backfill the rollups behind truncDateGroups and truncValueGroups"
+
+    def handle(self, *args, **options):
+        activities, values = rebuild_rollups()
+        self.stdout.write("Rebuilt %d daily activities and %d value rollups" %
+                          (activities, values))
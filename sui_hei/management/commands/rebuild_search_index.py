@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from sui_hei.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the bigram search index of puzzles"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "puzzles",
+            nargs="*",
+            type=int,
+            help="ids of puzzles to reindex (default: all puzzles)")
+
+    def handle(self, *args, **options):
+        puzzles = options["puzzles"] or None
+        indexed = rebuild_index(puzzles=puzzles)
+        self.stdout.write("Indexed %d puzzles" % indexed)
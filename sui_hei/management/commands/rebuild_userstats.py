@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from sui_hei.models import UserStats
+
+
+class Command(BaseCommand):
+    help = "Rebuild the materialized UserStats table from scratch"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "users",
+            nargs="*",
+            type=int,
+            help="ids of users to rebuild (default: all users)")
+
+    def handle(self, *args, **options):
+        users = options["users"] or None
+        stats = UserStats.objects.rebuild(users=users)
+        self.stdout.write("Rebuilt statistics of %d users" % len(stats))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from sui_hei.models import Puzzle
+
+
+class Command(BaseCommand):
+    help = "Recount the denormalized counters of puzzles and fix drift"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "puzzles",
+            nargs="*",
+            type=int,
+            help="ids of puzzles to reconcile (default: all puzzles)")
+
+    def handle(self, *args, **options):
+        puzzles = options["puzzles"] or None
+        fixed = Puzzle.objects.reconcile_counters(puzzles=puzzles)
+        self.stdout.write("Fixed counters of %d puzzles" % fixed)
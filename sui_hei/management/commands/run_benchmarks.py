@@ -0,0 +1,78 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from schema import schema
+from sui_hei.benchmarks import compare_reports, run_benchmarks
+from sui_hei.documents import PersistedQueries
+
+
+class Command(BaseCommand):
+    help = "Time the GraphQL operations of the frontend and report latency percentiles and query counts as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "names", nargs="*", help="benchmarks to run, all by default")
+        parser.add_argument(
+            "--queries",
+            default=settings.PERSISTED_QUERIES_FILE,
+            help="JSON object of queries (default: PERSISTED_QUERIES_FILE)")
+        parser.add_argument(
+            "-n",
+            "--rounds",
+            type=int,
+            default=20,
+            help="number of timed executions of each operation")
+        parser.add_argument(
+            "--warmup",
+            type=int,
+            default=2,
+            help="number of untimed executions of each operation")
+        parser.add_argument(
+            "--label", help="label of the report, e.g. a commit")
+        parser.add_argument(
+            "-o", "--output", help="write the report to OUTPUT")
+        parser.add_argument(
+            "--compare", help="print the changes from a previous report")
+
+    def handle(self, *args, **options):
+        queries = PersistedQueries()
+        queries.load(options["queries"], schema)
+        if not queries.documents:
+            raise CommandError(
+                "No queries found in %s, run `make schema` first" %
+                options["queries"])
+
+        try:
+            report = run_benchmarks(
+                [document for query, document in queries.documents.values()],
+                names=options["names"],
+                rounds=options["rounds"],
+                warmup=options["warmup"],
+                log=self.stderr.write)
+        except ValueError as e:
+            raise CommandError(e)
+        report["meta"]["label"] = options["label"]
+
+        errors = [
+            name for name, result in report["benchmarks"].items()
+            if result["errors"]
+        ]
+        if errors:
+            self.stderr.write("Benchmarks with errors: %s" % ", ".join(errors))
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                baseline = json.load(f)
+            for row in compare_reports(baseline, report):
+                self.stderr.write(
+                    "%-24s p50 %8.2f -> %8.2f ms (%+6.1f%%), queries %d -> %d"
+                    % (row[0], row[1], row[2], row[3] * 100, row[4], row[5]))
@@ -0,0 +1,238 @@
+"""
+metrics.py
+
+Per-field timing of GraphQL operations, exposed in the Prometheus text
+format.
+
+FieldMetricsMiddleware samples GRAPHQL_METRICS_SAMPLE_RATE of the
+operations. For each field resolved in a sampled operation, it records
+the wall time until the value is available, and the number and total time
+of the SQL queries run by its resolver. Measurements are aggregated in
+histograms keyed by operation name and field path, with list indices
+left out (e.g. "allPuzzles.edges.node.user").
+
+DataLoader batches run apart from the fields requesting them, so they are
+recorded on their own under the name of the loader, e.g.
+"loader:user.stats".
+
+Histograms live in the memory of each process, and are served at
+graphql/metrics to INTERNAL_IPS.
+"""
+
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from promise import is_thenable
+
+GRAPHQL_METRICS_SAMPLE_RATE = settings.GRAPHQL_METRICS_SAMPLE_RATE
+GRAPHQL_METRICS_TIME_BUCKETS = settings.GRAPHQL_METRICS_TIME_BUCKETS
+GRAPHQL_METRICS_QUERY_BUCKETS = settings.GRAPHQL_METRICS_QUERY_BUCKETS
+
+CONTEXT_ATTR = "_sui_hei_metrics"
+
+
+# {{{1 Histogram
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        '''
+        Returns
+        -------
+        list of (le, cumulative count), ending with "+Inf"
+        '''
+        samples = []
+        total = 0
+        for le, count in zip(list(self.buckets) + ["+Inf"], self.counts):
+            total += count
+            samples.append((le, total))
+        return samples
+
+
+# {{{1 FieldMetrics
+class FieldMetrics(object):
+    '''
+    Histograms of the wall time, SQL query count and SQL time of fields,
+    by (operation name, field path).
+    '''
+    HISTOGRAMS = [
+        ("graphql_field_duration_seconds",
+         "Wall time of resolving GraphQL fields", "time"),
+        ("graphql_field_sql_queries",
+         "Number of SQL queries run by GraphQL resolvers", "queries"),
+        ("graphql_field_sql_duration_seconds",
+         "Time spent in SQL queries by GraphQL resolvers", "time"),
+    ]
+
+    def __init__(self, time_buckets, query_buckets):
+        self.buckets = {"time": time_buckets, "queries": query_buckets}
+        self.fields = {}
+        self.operations = {}
+        self.lock = threading.Lock()
+
+    def record_operation(self, operation):
+        with self.lock:
+            self.operations[operation] = self.operations.get(operation, 0) + 1
+
+    def record_field(self, operation, path, duration, queries, sql_duration):
+        key = (operation, path)
+        with self.lock:
+            histograms = self.fields.get(key)
+            if histograms is None:
+                histograms = self.fields[key] = [
+                    Histogram(self.buckets[kind])
+                    for name, help, kind in self.HISTOGRAMS
+                ]
+            for histogram, value in zip(histograms,
+                                        [duration, queries, sql_duration]):
+                histogram.observe(value)
+
+    def clear(self):
+        with self.lock:
+            self.fields.clear()
+            self.operations.clear()
+
+    def render(self):
+        '''
+        Returns
+        -------
+        the metrics in the Prometheus text exposition format
+        '''
+        with self.lock:
+            lines = [
+                "# HELP graphql_sampled_operations_total Number of sampled GraphQL operations",
+                "# TYPE graphql_sampled_operations_total counter",
+            ]
+            for operation, count in sorted(self.operations.items()):
+                lines.append('graphql_sampled_operations_total{%s} %d' %
+                             (_labels(operation=operation), count))
+
+            for i, (name, help, kind) in enumerate(self.HISTOGRAMS):
+                lines.append("# HELP %s %s" % (name, help))
+                lines.append("# TYPE %s histogram" % name)
+                for key, histograms in sorted(self.fields.items()):
+                    operation, path = key
+                    histogram = histograms[i]
+                    labels = _labels(operation=operation, path=path)
+                    for le, count in histogram.samples():
+                        lines.append('%s_bucket{%s,le="%s"} %d' %
+                                     (name, labels, le, count))
+                    lines.append(
+                        "%s_sum{%s} %s" % (name, labels, repr(histogram.sum)))
+                    lines.append("%s_count{%s} %d" %
+                                 (name, labels, histogram.samples()[-1][1]))
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels):
+    return ",".join('%s="%s"' % (key, _escape(value))
+                    for key, value in sorted(labels.items()))
+
+
+field_metrics = FieldMetrics(GRAPHQL_METRICS_TIME_BUCKETS,
+                             GRAPHQL_METRICS_QUERY_BUCKETS)
+
+
+# {{{1 Sampling
+def get_sample(info):
+    '''
+    Decide whether to sample the operation being executed, once per
+    operation.
+
+    Returns
+    -------
+    (operation name, sampled)
+    '''
+    sample = getattr(info.context, CONTEXT_ATTR, None)
+    if sample is None or sample[0] is not info.operation:
+        operation = info.operation.name.value if info.operation.name else ""
+        sample = (info.operation, operation,
+                  random.random() < GRAPHQL_METRICS_SAMPLE_RATE)
+        setattr(info.context, CONTEXT_ATTR, sample)
+        if sample[2]:
+            field_metrics.record_operation(operation)
+    return sample[1:]
+
+
+@contextmanager
+def sql_timer():
+    '''
+    Collect the durations of the SQL queries run in this block.
+    '''
+    queries = []
+
+    def wrapper(execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            queries.append(time.perf_counter() - start)
+
+    with connection.execute_wrapper(wrapper):
+        yield queries
+
+
+def instrument_loader(info, name, loader):
+    '''
+    Record the batches of `loader` if the operation is sampled.
+    '''
+    operation, sampled = get_sample(info)
+    if not sampled:
+        return
+    batch_load_fn = loader.batch_load_fn
+    path = "loader:%s" % name
+
+    def timed_batch_load_fn(keys):
+        start = time.perf_counter()
+        with sql_timer() as queries:
+            result = batch_load_fn(keys)
+        field_metrics.record_field(operation, path,
+                                   time.perf_counter() - start, len(queries),
+                                   sum(queries))
+        return result
+
+    loader.batch_load_fn = timed_batch_load_fn
+
+
+# {{{1 FieldMetricsMiddleware
+class FieldMetricsMiddleware(object):
+    '''
+    Graphene middleware recording field metrics of sampled operations
+    into `field_metrics`.
+    '''
+
+    def resolve(self, next, root, info, **args):
+        operation, sampled = get_sample(info)
+        if not sampled:
+            return next(root, info, **args)
+
+        path = ".".join(key for key in info.path if isinstance(key, str))
+        start = time.perf_counter()
+        with sql_timer() as queries:
+            result = next(root, info, **args)
+
+        def record(value):
+            field_metrics.record_field(operation, path,
+                                       time.perf_counter() - start,
+                                       len(queries), sum(queries))
+            return value
+
+        if is_thenable(result):
+            return result.then(record)
+        return record(result)
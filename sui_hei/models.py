@@ -3,7 +3,7 @@ import re
 from django.contrib.auth.models import (AbstractBaseUser, AbstractUser,
                                         BaseUserManager)
 from django.db import connections, models
-from django.db.models import CASCADE, DO_NOTHING, SET_NULL, Q
+from django.db.models import CASCADE, DO_NOTHING, SET_NULL, Count, Q, Sum
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
@@ -127,6 +127,55 @@ class UserAward(models.Model):
         return "[%s] owns [%s]" % (self.user.nickname, self.award)
 
 
+class PuzzleManager(models.Manager):
+    def reconcile_counters(self, puzzles=None):
+        '''
+        Fix drift of the denormalized counters by recounting them.
+
+        Parameters
+        ----------
+        puzzles: iterable of puzzle ids to check. Check all puzzles if None.
+
+        Returns
+        -------
+        number of puzzles whose counters were corrected.
+        '''
+        puzzle_qs = self.all()
+        if puzzles is not None:
+            puzzle_qs = puzzle_qs.filter(id__in=list(puzzles))
+
+        def grouped(qs, **aggregates):
+            qs = qs.filter(puzzle__in=puzzle_qs).order_by()
+            return {
+                row["puzzle"]: row
+                for row in qs.values("puzzle").annotate(**aggregates)
+            }
+
+        questions = grouped(Dialogue.objects, count=Count("id"))
+        uaquestions = grouped(
+            Dialogue.objects.filter(Q(answer__isnull=True) | Q(answer="")),
+            count=Count("id"))
+        stars = grouped(Star.objects, count=Count("id"), sum=Sum("value"))
+        comments = grouped(Comment.objects, count=Count("id"))
+        bookmarks = grouped(Bookmark.objects, count=Count("id"))
+
+        fixed = 0
+        for puzzle in puzzle_qs.only(*PUZZLE_COUNTER_FIELDS.values()):
+            counters = {
+                "ques_count": questions.get(puzzle.id, {}).get("count", 0),
+                "uaques_count": uaquestions.get(puzzle.id, {}).get("count", 0),
+                "star_count": stars.get(puzzle.id, {}).get("count", 0),
+                "star_sum": stars.get(puzzle.id, {}).get("sum") or 0,
+                "comment_count": comments.get(puzzle.id, {}).get("count", 0),
+                "bookmark_count": bookmarks.get(puzzle.id, {}).get("count", 0),
+            }
+            if any(getattr(puzzle, field) != value
+                   for field, value in counters.items()):
+                self.filter(id=puzzle.id).update(**counters)
+                fixed += 1
+        return fixed
+
+
 class Puzzle(models.Model):
     '''
     genre:
@@ -157,12 +206,56 @@ class Puzzle(models.Model):
     grotesque = models.BooleanField(_('grotesque'), default=False)
     dazed_on = models.DateField(_('dazed_on'))
 
+    # Denormalized counters, maintained by signals
+    ques_count = models.IntegerField(
+        _('question count'), default=0, db_index=True)
+    uaques_count = models.IntegerField(
+        _('unanswered question count'), default=0, db_index=True)
+    star_count = models.IntegerField(_('star count'), default=0, db_index=True)
+    star_sum = models.FloatField(_('star sum'), default=0, db_index=True)
+    comment_count = models.IntegerField(
+        _('comment count'), default=0, db_index=True)
+    bookmark_count = models.IntegerField(
+        _('bookmark count'), default=0, db_index=True)
+
+    objects = PuzzleManager()
+
     class Meta:
         verbose_name = _("Puzzle")
+        indexes = [
+            # Listing puzzles by status, newest first
+            models.Index(
+                fields=["status", "created"],
+                name="sui_hei_puzzle_status_created"),
+            # Finding unsolved puzzles to daze (schedule_daily.py)
+            models.Index(
+                fields=["status", "dazed_on"],
+                name="sui_hei_puzzle_status_dazed"),
+        ]
 
     def __str__(self):
         return self.title
 
+    def save(self,
+             force_insert=False,
+             force_update=False,
+             using=None,
+             update_fields=None):
+        # Counters are written by signals with F() increments only. Writing
+        # back the loaded values would undo concurrent increments.
+        if update_fields is None and not (force_insert or self._state.adding):
+            deferred = self.get_deferred_fields()
+            update_fields = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.attname not in deferred
+                and field.attname not in PUZZLE_COUNTER_FIELDS.values()
+            ]
+        super(Puzzle, self).save(
+            force_insert=force_insert,
+            force_update=force_update,
+            using=using,
+            update_fields=update_fields)
+
 
 puzzle_genre_enum = {
     0: _("Albatross"),
@@ -181,6 +274,16 @@ puzzle_status_enum = {
 
 puzzle_yami_enum = {0: _("Normal"), 1: _("Yami"), 2: _("Long-term Yami")}
 
+# GraphQL field name -> denormalized counter column
+PUZZLE_COUNTER_FIELDS = {
+    "quesCount": "ques_count",
+    "uaquesCount": "uaques_count",
+    "starCount": "star_count",
+    "starSum": "star_sum",
+    "commentCount": "comment_count",
+    "bookmarkCount": "bookmark_count",
+}
+
 
 class Dialogue(models.Model):
     id = models.AutoField(max_length=11, primary_key=True)
@@ -198,6 +301,16 @@ class Dialogue(models.Model):
 
     class Meta:
         verbose_name = _("Question")
+        indexes = [
+            # Dialogues of a puzzle in chronological order
+            models.Index(
+                fields=["puzzle", "created"],
+                name="sui_hei_dialogue_puzzle_ctime"),
+            # Looking up whether users solved puzzles
+            models.Index(
+                fields=["user", "puzzle", "true"],
+                name="sui_hei_dialogue_solved_idx"),
+        ]
 
     def __str__(self):
         return "[%s]%s: {%s} puts {%s}" % (self.puzzle.id, self.puzzle,
@@ -228,6 +341,11 @@ class ChatMessage(models.Model):
 
     class Meta:
         verbose_name = _("ChatMessage")
+        indexes = [
+            # Paging through the messages of a chatroom
+            models.Index(
+                fields=["chatroom", "id"], name="sui_hei_chatmsg_room_id"),
+        ]
 
     def __str__(self):
         return "[%s]: {%s} puts {%50s}" % (self.chatroom, self.user,
@@ -244,6 +362,16 @@ class DirectMessage(models.Model):
 
     class Meta:
         verbose_name = _("DirectMessage")
+        indexes = [
+            # Conversations of a user, newest first. Both sides are
+            # indexed so that `sender OR receiver` can combine them.
+            models.Index(
+                fields=["receiver", "created"],
+                name="sui_hei_dm_receiver_created"),
+            models.Index(
+                fields=["sender", "created"],
+                name="sui_hei_dm_sender_created"),
+        ]
 
     def __str__(self):
         return "[%s] sends a DM to [%s]" % (self.sender, self.receiver)
@@ -302,11 +430,191 @@ class Star(models.Model):
 
     class Meta:
         verbose_name = _("Star")
+        indexes = [
+            # Looking up the star of a user on a puzzle. Stars of a
+            # puzzle use the index of the puzzle foreign key.
+            models.Index(
+                fields=["user", "puzzle"], name="sui_hei_star_user_puzzle"),
+        ]
 
     def __str__(self):
         return "%s -- %.1f --> %s" % (self.user, self.value, self.puzzle)
 
 
+class UserStatsManager(models.Manager):
+    def compute(self, users=None):
+        '''
+        Compute statistics from scratch, without saving them.
+
+        Parameters
+        ----------
+        users: iterable of user ids to compute. Compute all users if None.
+
+        Returns
+        -------
+        list of unsaved UserStats, one for each existing user
+        '''
+        user_qs = User.objects.all()
+        if users is not None:
+            user_qs = user_qs.filter(id__in=list(users))
+        user_ids = list(user_qs.values_list("id", flat=True))
+
+        def grouped(qs, key, **aggregates):
+            qs = qs.filter(**{"%s__in" % key: user_ids}).order_by()
+            return {
+                row[key]: row
+                for row in qs.values(key).annotate(**aggregates)
+            }
+
+        puzzles = grouped(Puzzle.objects, "user", count=Count("id"))
+        good_ques = grouped(
+            Dialogue.objects.filter(good=True), "user", count=Count("id"))
+        true_ques = grouped(
+            Dialogue.objects.filter(true=True), "user", count=Count("id"))
+        rcomments = grouped(Comment.objects, "puzzle__user", count=Count("id"))
+        rstars = grouped(
+            Star.objects, "puzzle__user", count=Count("id"), sum=Sum("value"))
+
+        stats = [
+            self.model(
+                user_id=user_id,
+                puzzle_count=puzzles.get(user_id, {}).get("count", 0),
+                good_ques_count=good_ques.get(user_id, {}).get("count", 0),
+                true_ques_count=true_ques.get(user_id, {}).get("count", 0),
+                rcomment_count=rcomments.get(user_id, {}).get("count", 0),
+                rstar_count=rstars.get(user_id, {}).get("count", 0),
+                rstar_sum=rstars.get(user_id, {}).get("sum") or 0,
+            ) for user_id in user_ids
+        ]
+        return stats
+
+    def rebuild(self, users=None):
+        '''
+        Recompute statistics from scratch, replacing the saved ones.
+
+        Parameters
+        ----------
+        users: iterable of user ids to rebuild. Rebuild all users if None.
+        '''
+        stats = self.compute(users=users)
+        self.filter(user_id__in=[s.user_id for s in stats]).delete()
+        self.bulk_create(stats)
+        return stats
+
+
+class UserStats(models.Model):
+    '''
+    Materialized statistics of a user, kept up to date by signals.
+    Rebuild with `manage.py rebuild_userstats` if it drifts.
+    '''
+    user = models.OneToOneField(
+        User, primary_key=True, on_delete=CASCADE, related_name="stats")
+    puzzle_count = models.IntegerField(_("puzzle count"), default=0)
+    good_ques_count = models.IntegerField(_("good question count"), default=0)
+    true_ques_count = models.IntegerField(_("true question count"), default=0)
+    rcomment_count = models.IntegerField(
+        _("received comment count"), default=0)
+    rstar_count = models.IntegerField(_("received star count"), default=0)
+    rstar_sum = models.FloatField(_("received star sum"), default=0)
+
+    objects = UserStatsManager()
+
+    class Meta:
+        verbose_name = _("User Statistics")
+
+    def __str__(self):
+        return "Statistics of %s" % self.user
+
+
+class PuzzleNgram(models.Model):
+    '''
+    Bigram inverted index of the text fields of puzzles, kept up to date
+    by signals. Rebuild with `manage.py rebuild_search_index` if it
+    drifts. See sui_hei/search.py.
+    '''
+    puzzle = models.ForeignKey(
+        Puzzle, on_delete=CASCADE, related_name="ngrams")
+    field = models.CharField(_("field"), max_length=8)
+    gram = models.CharField(_("gram"), max_length=2)
+    count = models.IntegerField(_("count"), default=0)
+
+    class Meta:
+        verbose_name = _("Puzzle Search Index")
+        unique_together = ("gram", "field", "puzzle")
+
+    def __str__(self):
+        return "%s in %s of %s" % (self.gram, self.field, self.puzzle_id)
+
+
+class DailyActivity(models.Model):
+    '''
+    Number of rows of `model` created by `user` on `date`, kept up to date
+    by signals. Backfill with `manage.py rebuild_rollups`.
+    See sui_hei/rollups.py.
+    '''
+    model = models.CharField(_("model"), max_length=32)
+    user = models.ForeignKey(User, on_delete=CASCADE)
+    date = models.DateField(_("date"))
+    count = models.IntegerField(_("count"), default=0)
+
+    class Meta:
+        verbose_name = _("Daily Activity")
+        unique_together = ("model", "user", "date")
+        indexes = [
+            models.Index(
+                fields=["model", "date"], name="sui_hei_dailyact_model_date"),
+        ]
+
+    def __str__(self):
+        return "%s: %d %s by %s" % (self.date, self.count, self.model,
+                                    self.user_id)
+
+
+class ValueRollup(models.Model):
+    '''
+    Number of rows of `model` by `user` with `field` equal to `value`,
+    kept up to date by signals. Backfill with `manage.py rebuild_rollups`.
+    See sui_hei/rollups.py.
+    '''
+    model = models.CharField(_("model"), max_length=32)
+    field = models.CharField(_("field"), max_length=32)
+    user = models.ForeignKey(User, on_delete=CASCADE)
+    value = models.FloatField(_("value"))
+    count = models.IntegerField(_("count"), default=0)
+
+    class Meta:
+        verbose_name = _("Value Rollup")
+        unique_together = ("model", "field", "user", "value")
+
+    def __str__(self):
+        return "%s.%s=%s: %d by %s" % (self.model, self.field, self.value,
+                                       self.count, self.user_id)
+
+
+class ChangeLog(models.Model):
+    '''
+    model.changed events sent to a channel layer group, in the order they
+    were sent. The id is the sequence number of the event, and only the
+    last CHANGE_LOG_SIZE events are kept. See sui_hei/changelog.py.
+    '''
+    group = models.CharField(_("group"), max_length=255)
+    model = models.CharField(_("model"), max_length=64)
+    object_id = models.IntegerField(_("object id"))
+    version = models.CharField(_("version"), max_length=32)
+    snapshot = models.BinaryField(_("snapshot"), null=True)
+
+    class Meta:
+        verbose_name = _("Change Log")
+        indexes = [
+            models.Index(
+                fields=["group", "id"], name="sui_hei_changelog_group_id"),
+        ]
+
+    def __str__(self):
+        return "%d: %s %s in %s" % (self.id, self.model, self.object_id,
+                                    self.group)
+
+
 class Schedule(models.Model):
     user = models.ForeignKey(User, on_delete=CASCADE)
     content = models.TextField(_("content"))
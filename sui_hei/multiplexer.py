@@ -0,0 +1,261 @@
+"""
+multiplexer.py
+
+Shared execution of identical GraphQL subscriptions.
+
+Live subscriptions of a worker are grouped by query hash, variables,
+operation name and permission class. Each group executes its document
+once, with a context of its own, and the result of every event is
+encoded once and written to all member sockets as the same frame, with
+only the subscription id differing. Per-event work thus scales with the
+number of distinct subscriptions rather than with the number of viewers.
+
+Every member socket receives the events of the group (see
+`GraphqlSubcriptionConsumer.model_changed`), and the first one to claim
+an event executes the group for it. The others skip the event, which is
+recognized by its (model, pk, version). Frames are handed to member
+consumers with `send_frame`, which may be called from any thread, along
+with the seq of the event in the change log (see changelog.py).
+
+The permission class is "public" unless the document selects one of
+USER_FIELDS, whose resolvers depend on the current user. Those documents
+are grouped by user.
+"""
+
+import json
+import threading
+from collections import OrderedDict
+
+from django.contrib.auth.models import AnonymousUser
+from graphql.language.visitor import TypeInfoVisitor, Visitor, visit
+from graphql.utils.type_info import TypeInfo
+
+from schema import schema
+
+from .documents import query_id
+
+# Fields whose resolvers read info.context.user, by "TypeName.fieldName"
+USER_FIELDS = {
+    "PuzzleNode.solution",
+}
+
+# Number of recent events remembered by each group to skip duplicates
+RECENT_EVENTS = 64
+
+
+class _UserFieldFinder(Visitor):
+    def __init__(self, type_info):
+        self.type_info = type_info
+        self.found = False
+
+    def enter_Field(self, node, *args):
+        parent_type = self.type_info.get_parent_type()
+        if parent_type and "%s.%s" % (parent_type.name,
+                                      node.name.value) in USER_FIELDS:
+            self.found = True
+
+
+def reads_user(document):
+    '''
+    Returns
+    -------
+    whether `document` selects a field depending on the current user.
+    '''
+    type_info = TypeInfo(schema)
+    finder = _UserFieldFinder(type_info)
+    visit(document, TypeInfoVisitor(type_info, finder))
+    return finder.found
+
+
+def encode_payload(result):
+    '''
+    Returns
+    -------
+    JSON payload of a graphql-ws "data" message, or None if the result
+    carries no useful data.
+    '''
+    errors = result.errors
+    if not errors:
+        if not isinstance(result.data, dict):
+            return None
+        if sum(map(lambda x: x != None, result.data.values())) == 0:
+            return None
+
+    return json.dumps({
+        'data': result.data,
+        'errors': list(map(str, errors)) if errors else None,
+    })
+
+
+def encode_frame(id, payload, seq=None):
+    if seq is None:
+        return '{"id": %s, "type": "data", "payload": %s}' % (json.dumps(id),
+                                                              payload)
+    return '{"id": %s, "type": "data", "seq": %d, "payload": %s}' % (
+        json.dumps(id), seq, payload)
+
+
+class _Frames(object):
+    '''
+    Consumer collecting the frames sent to it.
+    '''
+
+    def __init__(self):
+        self.frames = []
+
+    def send_frame(self, id, seq, text):
+        self.frames.append(text)
+
+
+# {{{1 SubscriptionGroup
+class SubscriptionGroup(object):
+    '''
+    Subscriptions of several sockets sharing one execution.
+
+    `channel_groups` are the channel layer groups the document subscribed
+    to, which every member socket must join. `execute` and `user` execute
+    the document again, see `SubscriptionMultiplexer.replay`.
+    '''
+
+    def __init__(self, key):
+        self.key = key
+        self.members = set()
+        self.channel_groups = []
+        self.stream = None
+        self.subscription = None
+        self.execute = None
+        self.user = None
+        # Seq of the event being published
+        self.seq = None
+        self.recent = OrderedDict()
+        # Taken on the event loop, so never held for long
+        self.recent_lock = threading.Lock()
+        # Future of the last event being executed, on the event loop
+        self.tail = None
+        # Held while executing
+        self.lock = threading.Lock()
+
+    def publish(self, result):
+        payload = encode_payload(result)
+        if payload is None:
+            return
+        for (consumer, id) in list(self.members):
+            consumer.send_frame(id, self.seq,
+                                encode_frame(id, payload, self.seq))
+
+    def claim(self, event):
+        '''
+        Returns
+        -------
+        whether `event` is new to the group, marking it as handled.
+        '''
+        with self.recent_lock:
+            if event in self.recent:
+                return False
+            self.recent[event] = True
+            while len(self.recent) > RECENT_EVENTS:
+                self.recent.popitem(last=False)
+            return True
+
+    def send(self, value, seq=None):
+        '''
+        Execute the group for `value` and publish the result.
+        '''
+        with self.lock:
+            self.seq = seq
+            self.stream.send(value)
+
+
+# {{{1 SubscriptionMultiplexer
+class SubscriptionMultiplexer(object):
+    def __init__(self):
+        self.groups = {}
+        self.lock = threading.Lock()
+
+    def join(self, consumer, id, query, document, operation_name, variables,
+             user, execute):
+        '''
+        Add the subscription `id` of `consumer` to the group executing
+        the same document, creating the group if needed.
+
+        `execute(group, user)` executes the document for a new group as
+        `user`, sets `group.stream` to the stream of its root value, and
+        returns an observable, or an ExecutionResult on errors.
+
+        Returns
+        -------
+        (group, None), or (None, ExecutionResult) if the document did not
+        start a subscription, e.g. because of errors.
+        '''
+        if reads_user(document):
+            permission_class = ("user", user.pk)
+        else:
+            permission_class = ("public", )
+            user = AnonymousUser()
+        key = (query_id(query), json.dumps(variables, sort_keys=True),
+               operation_name, permission_class)
+
+        with self.lock:
+            group = self.groups.get(key)
+            if group is None:
+                group = SubscriptionGroup(key)
+                result = execute(group, user)
+                if not hasattr(result, 'subscribe'):
+                    return None, result
+                group.subscription = result.subscribe(group.publish)
+                group.execute = execute
+                group.user = user
+                self.groups[key] = group
+            group.members.add((consumer, id))
+        return group, None
+
+    def leave(self, consumer, id, group):
+        '''
+        Remove the subscription `id` of `consumer` from `group`.
+
+        Waits for `join` executing a new group, so it must not be called
+        from the event loop.
+        '''
+        with self.lock:
+            group.members.discard((consumer, id))
+            if not group.members and self.groups.get(group.key) is group:
+                del self.groups[group.key]
+                group.subscription.dispose()
+
+    def replay(self, group, id, values):
+        '''
+        Execute the document of `group` for the subscription `id` alone.
+
+        Parameters
+        ----------
+        values: list of (seq, value sent to the group)
+
+        Returns
+        -------
+        list of the frames of the subscription
+        '''
+        replay = SubscriptionGroup(group.key)
+        result = group.execute(replay, group.user)
+        if not hasattr(result, 'subscribe'):
+            return []
+        frames = _Frames()
+        replay.members.add((frames, id))
+        subscription = result.subscribe(replay.publish)
+        try:
+            for seq, value in values:
+                replay.send(value, seq)
+        finally:
+            subscription.dispose()
+        return frames.frames
+
+    def stats(self):
+        with self.lock:
+            return {
+                "groups":
+                len(self.groups),
+                "subscriptions":
+                sum(len(group.members) for group in self.groups.values()),
+            }
+
+
+multiplexer = SubscriptionMultiplexer()
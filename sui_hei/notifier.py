@@ -0,0 +1,172 @@
+"""
+notifier.py
+
+Transaction-aware publishing of model.changed events.
+
+Events of `notify_on_model_changes` (consumers.py) are queued on the
+database connection saving the row, and sent once its transaction
+commits, so that subscribers never see changes that are rolled back.
+Saves of the same (model, pk) in a transaction are collapsed into one
+event, carrying the snapshot of the last save, sent to the groups of all
+the saves. Outside of atomic blocks, each save is sent right away.
+
+Committed batches are written to the change log (changelog.py) and sent
+by a thread of their own, in commit order, so that mutations do not wait
+for the channel layer. Within a batch, groups are sent to concurrently,
+and the events of each group in order.
+
+Usage:
+    change_notifier.notify(model_label, pk, version, snapshot, groups)
+"""
+
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import (DEFAULT_DB_ALIAS, close_old_connections, connections,
+                       transaction)
+
+from .changelog import log_changes
+
+logger = logging.getLogger(__name__)
+
+
+# {{{1 ChangeBatch
+class ChangeBatch(object):
+    '''
+    Events saved in the same savepoint of a transaction, by (model, pk).
+    '''
+
+    def __init__(self):
+        self.events = OrderedDict()
+        self.saves = 0
+        self.callback = None
+
+    def add(self, model_label, pk, version, snapshot, groups):
+        key = (model_label, pk)
+        previous = self.events.pop(key, None)
+        if previous is not None:
+            groups = previous[2] + [
+                group for group in groups if group not in previous[2]
+            ]
+        # Ordered by the last save
+        self.events[key] = (version, snapshot, groups)
+        self.saves += 1
+
+    def messages(self):
+        '''
+        Returns
+        -------
+        list of model.changed messages, in the order of the events
+        '''
+        messages = []
+        for (model_label, pk), (version, snapshot,
+                                groups) in self.events.items():
+            for group in groups:
+                messages.append({
+                    'type': 'model.changed',
+                    'group': group,
+                    'pk': pk,
+                    'model': model_label,
+                    'version': version,
+                    'snapshot': snapshot,
+                })
+        return messages
+
+
+# {{{1 ChangeNotifier
+class ChangeNotifier(object):
+    def __init__(self):
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="model-changes")
+        self.saves = 0
+        self.events = 0
+        self.lock = threading.Lock()
+
+    def notify(self,
+               model_label,
+               pk,
+               version,
+               snapshot,
+               groups,
+               using=DEFAULT_DB_ALIAS):
+        '''
+        Queue a model.changed event for `groups` until the transaction
+        of `using` on this thread commits.
+        '''
+        connection = connections[using]
+        batches = self.local.__dict__.setdefault(using, {})
+        key = tuple(connection.savepoint_ids)
+        batch = batches.get(key)
+        if batch is not None and self._is_pending(batch, connection):
+            batch.add(model_label, pk, version, snapshot, groups)
+            return
+
+        # Forget the batches of savepoints which were committed or
+        # rolled back
+        for sids, pending in list(batches.items()):
+            if not self._is_pending(pending, connection):
+                del batches[sids]
+        batch = batches[key] = ChangeBatch()
+        batch.add(model_label, pk, version, snapshot, groups)
+        batch.callback = lambda: self.flush(batch)
+        # Called right away outside of atomic blocks
+        transaction.on_commit(batch.callback, using)
+
+    def _is_pending(self, batch, connection):
+        # Callbacks are dropped on rollback, and run once on commit
+        return connection.in_atomic_block and any(
+            callback is batch.callback
+            for sids, callback in connection.run_on_commit)
+
+    def flush(self, batch):
+        with self.lock:
+            self.saves += batch.saves
+            self.events += len(batch.events)
+        # Created here to send on the event loop of the committing thread,
+        # if any
+        send = async_to_sync(self._send)
+        self.executor.submit(self._run, send, batch.messages())
+
+    def _run(self, send, messages):
+        close_old_connections()
+        try:
+            log_changes(messages)
+        except Exception:
+            # Sent anyway, without seq
+            logger.exception("Failed to log %d model changes" % len(messages))
+        finally:
+            close_old_connections()
+
+        groups = OrderedDict()
+        for message in messages:
+            groups.setdefault(message['group'], []).append(message)
+        try:
+            send(groups)
+        except Exception:
+            logger.exception(
+                "Failed to send model changes to %d groups" % len(groups))
+
+    async def _send(self, groups):
+        channel_layer = get_channel_layer()
+
+        async def send_group(group, group_messages):
+            for message in group_messages:
+                await channel_layer.group_send(group, message)
+
+        await asyncio.gather(*[
+            send_group(group, group_messages)
+            for group, group_messages in groups.items()
+        ])
+
+    def stats(self):
+        with self.lock:
+            return {"saves": self.saves, "events": self.events}
+
+
+change_notifier = ChangeNotifier()
@@ -0,0 +1,230 @@
+"""
+optimizer.py
+
+Queryset optimizer driven by the GraphQL selection set.
+
+Before a connection is evaluated, the selections of its `edges.node` are
+walked alongside the DjangoObjectTypes and their models:
+
+- forward ForeignKey/OneToOne fields with sub-selections are joined with
+  `select_related`, recursively;
+- reverse relations and many-to-many fields are fetched with
+  `prefetch_related`, using an optimized queryset for the nested node;
+- only the columns of selected model fields, plus those listed in
+  FIELD_DEPENDENCIES for custom resolvers, are loaded with `only()`.
+  Models with selected fields of unknown dependencies load every column.
+
+Usage:
+    def resolve_all_comments(self, info, **kwargs):
+        return optimize_queryset(Comment.objects.all(), info)
+"""
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from graphene.utils.str_converters import to_camel_case
+from graphql.language import ast
+from graphql.type import GraphQLList, GraphQLNonNull
+
+from .models import PUZZLE_COUNTER_FIELDS
+
+# Model fields read by custom resolvers, by "TypeName.fieldName".
+# "*.fieldName" applies to every type.
+FIELD_DEPENDENCIES = {
+    "*.rowid": ["id"],
+    "PuzzleNode.solution": ["solution", "user", "status", "yami"],
+    "UserNode.canVote": ["date_joined"],
+}
+FIELD_DEPENDENCIES.update({
+    "PuzzleNode.%s" % name: [column]
+    for name, column in PUZZLE_COUNTER_FIELDS.items()
+})
+# Fields resolved through loaders only need the primary key
+FIELD_DEPENDENCIES.update({
+    "UserNode.%s" % name: []
+    for name in [
+        "puzzleCount", "quesCount", "goodQuesCount", "trueQuesCount",
+        "commentCount", "rcommentCount", "starCount", "starSum", "rstarCount",
+        "rstarSum", "canReviewAwardApplication", "canSendGlobalNotification"
+    ]
+})
+
+
+def _unwrap(type_):
+    while isinstance(type_, (GraphQLNonNull, GraphQLList)):
+        type_ = type_.of_type
+    return type_
+
+
+# {{{1 QueryOptimizer
+class QueryOptimizer(object):
+    def __init__(self, info):
+        self.fragments = info.fragments
+
+    def collect_fields(self, field_asts, parent_type):
+        '''
+        Merge the sub-selections of `field_asts`, expanding fragments.
+
+        Returns
+        -------
+        {fieldName: [Field]}
+        '''
+        fields = {}
+
+        def collect(selection_set):
+            for selection in selection_set.selections:
+                if isinstance(selection, ast.Field):
+                    fields.setdefault(selection.name.value,
+                                      []).append(selection)
+                    continue
+                if isinstance(selection, ast.FragmentSpread):
+                    selection = self.fragments[selection.name.value]
+                condition = selection.type_condition
+                if condition is None or condition.name.value in type_names:
+                    collect(selection.selection_set)
+
+        type_names = [parent_type.name] + [
+            interface.name
+            for interface in getattr(parent_type, "interfaces", [])
+        ]
+
+        for field_ast in field_asts:
+            if field_ast.selection_set is not None:
+                collect(field_ast.selection_set)
+        return fields
+
+    def node_fields(self, field_asts, connection_type, node_type=None):
+        '''
+        Parameters
+        ----------
+        node_type: member type to collect fields of, if the nodes of the
+                   connection are a union
+
+        Returns
+        -------
+        (node type, {fieldName: [Field]} of `edges.node`)
+        '''
+        edges = self.collect_fields(field_asts, connection_type).get(
+            "edges", [])
+        edge_type = _unwrap(connection_type.fields["edges"].type)
+        nodes = self.collect_fields(edges, edge_type).get("node", [])
+        node_type = node_type or _unwrap(edge_type.fields["node"].type)
+        return node_type, self.collect_fields(nodes, node_type)
+
+    def optimize(self, qs, node_type, fields, required=()):
+        '''
+        Parameters
+        ----------
+        qs: QuerySet of the nodes
+        node_type: GraphQL type of the nodes
+        fields: {fieldName: [Field]} selected on the nodes
+        required: names of model fields to load in any case
+        '''
+        only = {name for name in required if name not in qs.query.annotations}
+        select_related, prefetch_related = [], []
+        self._plan(qs.model, node_type, fields, "", only, select_related,
+                   prefetch_related)
+        if select_related:
+            qs = qs.select_related(*select_related)
+        if prefetch_related:
+            qs = qs.prefetch_related(*prefetch_related)
+        # Lookups spanning relations can't be loaded with only()
+        if any("__" in name for name in required):
+            return qs
+        return qs.only(*only)
+
+    def _plan(self, model, gql_type, fields, prefix, only, select_related,
+              prefetch_related):
+        graphene_type = getattr(gql_type, "graphene_type", None)
+        if graphene_type is None or getattr(graphene_type._meta, "model",
+                                            None) is not model:
+            only.update(prefix + f.name for f in model._meta.concrete_fields)
+            return
+
+        names = {
+            getattr(field, "name", None) or to_camel_case(name): name
+            for name, field in graphene_type._meta.fields.items()
+        }
+        accessors = {
+            rel.get_accessor_name(): rel
+            for rel in model._meta.related_objects
+        }
+
+        complete = True
+        only.add(prefix + model._meta.pk.name)
+        for name, field_asts in fields.items():
+            if name.startswith("__"):
+                continue
+            dependencies = FIELD_DEPENDENCIES.get(
+                "%s.%s" % (gql_type.name, name),
+                FIELD_DEPENDENCIES.get("*.%s" % name))
+            if dependencies is not None:
+                only.update(prefix + dep for dep in dependencies)
+                continue
+
+            attname = names.get(name)
+            try:
+                model_field = model._meta.get_field(attname)
+            except FieldDoesNotExist:
+                model_field = accessors.get(attname)
+            if model_field is None:
+                complete = False
+                continue
+
+            field_type = _unwrap(gql_type.fields[name].type)
+            if not model_field.is_relation:
+                only.add(prefix + model_field.name)
+            elif model_field.many_to_one or model_field.one_to_one:
+                if model_field.concrete:
+                    only.add(prefix + model_field.name)
+                if field_asts[0].selection_set is None:
+                    continue
+                path = prefix + (model_field.name
+                                 if model_field.concrete else attname)
+                select_related.append(path)
+                self._plan(model_field.related_model, field_type,
+                           self.collect_fields(field_asts, field_type),
+                           path + "__", only, select_related, prefetch_related)
+            # Filtered or paginated relations are queried separately
+            elif len(field_asts) == 1 and not field_asts[0].arguments:
+                related_model = model_field.related_model
+                queryset = related_model._default_manager.all()
+                if "edges" in getattr(field_type, "fields", {}):
+                    node_type, node_fields = self.node_fields(
+                        field_asts, field_type)
+                else:
+                    node_type, node_fields = field_type, self.collect_fields(
+                        field_asts, field_type)
+                # prefetch_related joins reverse relations on their
+                # foreign key
+                queryset = self.optimize(queryset, node_type, node_fields,
+                                         [model_field.field.name]
+                                         if model_field.one_to_many else [])
+                prefetch_related.append(
+                    Prefetch(prefix + attname, queryset=queryset))
+
+        if not complete:
+            only.update(prefix + f.name for f in model._meta.concrete_fields)
+
+
+# {{{1 optimize_queryset
+def optimize_queryset(qs, info, required=(), node_type=None):
+    '''
+    Apply select_related, prefetch_related and only() to `qs` according to
+    the selections of the connection being resolved in `info`.
+
+    Parameters
+    ----------
+    required: names of model fields to load in any case, e.g. the fields
+              cursors are built from
+    node_type: name of the member type qs holds, if the nodes of the
+               connection are a union
+    '''
+    optimizer = QueryOptimizer(info)
+    connection_type = _unwrap(info.return_type)
+    if "edges" not in connection_type.fields:
+        return qs
+    if node_type is not None:
+        node_type = info.schema.get_type(node_type)
+    node_type, fields = optimizer.node_fields(info.field_asts, connection_type,
+                                              node_type)
+    return optimizer.optimize(qs, node_type, fields, required)
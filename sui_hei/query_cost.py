@@ -0,0 +1,195 @@
+"""
+query_cost.py
+
+Static cost and depth analysis of GraphQL operations, run before they
+are executed.
+
+The cost of a field is its weight plus the cost of its selections,
+multiplied by the page size for lists and connections. Scalars are free,
+objects cost 1 and the expensive fields listed in FIELD_COSTS cost more.
+The page size is taken from the `first`, `last` or `limit` argument, or
+QUERY_COST_PAGE_SIZE if none is given.
+
+Operations costing more than QUERY_COST_LIMIT or nested deeper than
+QUERY_DEPTH_LIMIT are rejected.
+"""
+
+import logging
+
+from django.conf import settings
+from graphql.error import GraphQLError
+from graphql.language import ast
+from graphql.type import (GraphQLInterfaceType, GraphQLList, GraphQLNonNull,
+                          GraphQLObjectType)
+
+QUERY_COST_LIMIT = settings.QUERY_COST_LIMIT
+QUERY_DEPTH_LIMIT = settings.QUERY_DEPTH_LIMIT
+QUERY_COST_PAGE_SIZE = settings.QUERY_COST_PAGE_SIZE
+
+PAGE_SIZE_ARGS = ("first", "last", "limit")
+
+# Weights of fields with expensive resolvers, by "TypeName.fieldName"
+FIELD_COSTS = {
+    # {{{2 UserNode
+    "UserNode.quesCount": 10,
+    "UserNode.commentCount": 10,
+    "UserNode.starCount": 10,
+    "UserNode.starSum": 10,
+    "UserNode.puzzleCount": 2,
+    "UserNode.goodQuesCount": 2,
+    "UserNode.trueQuesCount": 2,
+    "UserNode.rcommentCount": 2,
+    "UserNode.rstarCount": 2,
+    "UserNode.rstarSum": 2,
+    "UserNode.canVote": 3,
+    # {{{2 Connections
+    "PuzzleConnection.totalCount": 5,
+    "BookmarkConnection.totalCount": 5,
+    "ChatMessageConnection.totalCount": 5,
+    "StarConnection.totalCount": 5,
+    "ChatRoomConnection.totalCount": 5,
+    "CommentConnection.totalCount": 5,
+    # {{{2 Query
+    "Query.truncDateGroups": 20,
+    "Query.truncValueGroups": 20,
+    "Query.puzzleShowUnion": 10,
+    "Query.searchPuzzles": 10,
+} # yapf: disable
+
+logger = logging.getLogger(__name__)
+
+
+class QueryTooComplex(GraphQLError):
+    pass
+
+
+def _unwrap(type_):
+    '''
+    Returns
+    -------
+    (named type, whether type_ is a list)
+    '''
+    is_list = False
+    while isinstance(type_, (GraphQLNonNull, GraphQLList)):
+        is_list = is_list or isinstance(type_, GraphQLList)
+        type_ = type_.of_type
+    return type_, is_list
+
+
+def _is_plumbing(parent_type):
+    # edges, node, pageInfo and cursor of connections are free
+    return parent_type.name.endswith(("Connection", "Edge"))
+
+
+# {{{1 QueryCostAnalyzer
+class QueryCostAnalyzer(object):
+    def __init__(self, schema, document, variables=None):
+        self.schema = schema
+        self.variables = variables or {}
+        self.fragments = {
+            definition.name.value: definition
+            for definition in document.definitions
+            if isinstance(definition, ast.FragmentDefinition)
+        }
+
+    def analyze(self, operation):
+        '''
+        Returns
+        -------
+        (cost, depth) of `operation`
+        '''
+        root_type = {
+            "query": self.schema.get_query_type,
+            "mutation": self.schema.get_mutation_type,
+            "subscription": self.schema.get_subscription_type,
+        }[operation.operation]()
+        return self._selection_set(operation.selection_set, root_type)
+
+    def _selection_set(self, selection_set, parent_type):
+        cost, depth = 0, 0
+        for selection in selection_set.selections:
+            if isinstance(selection, ast.Field):
+                field_cost, field_depth = self._field(selection, parent_type)
+            else:
+                if isinstance(selection, ast.FragmentSpread):
+                    fragment = self.fragments[selection.name.value]
+                else:
+                    fragment = selection
+                fragment_type = parent_type
+                if fragment.type_condition is not None:
+                    fragment_type = self.schema.get_type(
+                        fragment.type_condition.name.value)
+                field_cost, field_depth = self._selection_set(
+                    fragment.selection_set, fragment_type)
+            cost += field_cost
+            depth = max(depth, field_depth)
+        return cost, depth
+
+    def _field(self, field, parent_type):
+        name = field.name.value
+        if name.startswith("__") or not isinstance(
+                parent_type, (GraphQLObjectType, GraphQLInterfaceType)):
+            return 0, 0
+        definition = parent_type.fields.get(name)
+        if definition is None:
+            return 0, 0
+
+        field_type, is_list = _unwrap(definition.type)
+        weight = FIELD_COSTS.get("%s.%s" % (parent_type.name, name))
+        if weight is None:
+            weight = 0 if field.selection_set is None or _is_plumbing(
+                parent_type) else 1
+
+        if field.selection_set is None:
+            return weight, 1
+
+        cost, depth = self._selection_set(field.selection_set, field_type)
+        if field_type.name.endswith("Connection") or (
+                is_list and not _is_plumbing(parent_type)):
+            cost *= self._page_size(field)
+        return weight + cost, depth + 1
+
+    def _page_size(self, field):
+        for argument in field.arguments or []:
+            if argument.name.value not in PAGE_SIZE_ARGS:
+                continue
+            value = argument.value
+            if isinstance(value, ast.Variable):
+                value = self.variables.get(value.name.value)
+            elif isinstance(value, ast.IntValue):
+                value = int(value.value)
+            else:
+                value = None
+            if value is not None:
+                return max(int(value), 1)
+        return QUERY_COST_PAGE_SIZE
+
+
+# {{{1 check_query_cost
+def check_query_cost(schema, document, operation, variables=None):
+    '''
+    Analyze `operation` of `document` and log its cost.
+
+    Returns
+    -------
+    (cost, depth)
+
+    Raises
+    ------
+    QueryTooComplex if the operation is over QUERY_COST_LIMIT or
+    QUERY_DEPTH_LIMIT.
+    '''
+    cost, depth = QueryCostAnalyzer(schema, document,
+                                    variables).analyze(operation)
+    name = operation.name.value if operation.name else "<anonymous>"
+    logger.info("GraphQL %s %s: cost %d, depth %d" %
+                (operation.operation, name, cost, depth))
+
+    if cost > QUERY_COST_LIMIT:
+        raise QueryTooComplex(
+            "Query cost %d exceeds the limit of %d; request smaller pages or fewer fields"
+            % (cost, QUERY_COST_LIMIT))
+    if depth > QUERY_DEPTH_LIMIT:
+        raise QueryTooComplex("Query depth %d exceeds the limit of %d" %
+                              (depth, QUERY_DEPTH_LIMIT))
+    return cost, depth
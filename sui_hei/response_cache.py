@@ -0,0 +1,177 @@
+"""
+response_cache.py
+
+Shared cache of GraphQL responses for anonymous reads.
+
+Entries are keyed by the normalized query text, variables, operation name
+and language, and tagged by the models whose tables were read while
+executing them. Each process keeps its entries in a LRU bounded by
+RESPONSE_CACHE_SIZE entries, each living for at most RESPONSE_CACHE_TIMEOUT
+seconds.
+
+Model changes bump the version of their tag in the shared cache (see
+versions.py and `notify_on_model_changes` in consumers.py), once when
+saved and once when committed. Entries record the versions of their tags
+taken before executing, are not stored if any of them changed meanwhile,
+and are dropped on read once any of them changed, by any process.
+
+Usage:
+    versions = response_cache.versions()
+    with response_cache.track_models() as models:
+        result = execute()
+    response_cache.set(key, result, models, versions)
+"""
+
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection, transaction
+
+from .versions import bump_version, get_versions
+
+RESPONSE_CACHE_SIZE = settings.RESPONSE_CACHE_SIZE
+RESPONSE_CACHE_TIMEOUT = settings.RESPONSE_CACHE_TIMEOUT
+
+VERSION_KEY = "response-version:%s"
+
+table_regex = re.compile(r'\b(?:FROM|JOIN)\s+"?(\w+)"?', re.IGNORECASE)
+
+
+class ResponseCache(object):
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self._table_labels = None
+
+    @staticmethod
+    def make_key(query, variables, operation_name, language):
+        normalized = json.dumps(
+            [" ".join(query.split()), variables, operation_name, language],
+            sort_keys=True)
+        return hashlib.sha1(normalized.encode()).hexdigest()
+
+    def versions(self, tags=None):
+        '''
+        Get the current versions of `tags`, or of every model if None.
+
+        Returns
+        -------
+        dict of tag -> version
+        '''
+        if tags is None:
+            tags = self._get_table_labels().values()
+        keys = {tag: VERSION_KEY % tag for tag in tags}
+        versions = get_versions(list(keys.values()))
+        return {tag: versions[key] for tag, key in keys.items()}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+        # Out of the lock, as versions are read from the shared cache
+        if entry is None or entry[0] < time.time() or \
+                self.versions(entry[3]) != entry[3]:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, tags, versions):
+        '''
+        Store `value`, unless a model tagged by `tags` changed since
+        `versions` were taken.
+
+        Parameters
+        ----------
+        versions: versions of every model, taken with `versions()`
+                  before computing `value`
+        '''
+        versions = {tag: versions[tag] for tag in tags if tag in versions}
+        if self.versions(versions) != versions:
+            return
+
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (time.time() + self.timeout, value, tags,
+                                 versions)
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.size:
+                self._remove(next(iter(self.entries)))
+
+    def evict(self, tag):
+        with self.lock:
+            for key in self.tags.pop(tag, set()):
+                self._remove(key)
+
+        bump_version(VERSION_KEY % tag)
+        # Again on commit, for entries computed meanwhile from the data
+        # before the change
+        transaction.on_commit(lambda: bump_version(VERSION_KEY % tag))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tags.clear()
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    def _get_table_labels(self):
+        if self._table_labels is None:
+            self._table_labels = {
+                model._meta.db_table: model._meta.label_lower
+                for model in apps.get_models()
+            }
+        return self._table_labels
+
+    @contextmanager
+    def track_models(self):
+        '''
+        Collect labels of models whose tables are queried in this block.
+        '''
+        table_labels = self._get_table_labels()
+        labels = set()
+
+        def wrapper(execute, sql, params, many, context):
+            labels.update(
+                table_labels.get(table, table)
+                for table in table_regex.findall(sql))
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(wrapper):
+            yield labels
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TIMEOUT)
@@ -0,0 +1,191 @@
+"""
+rollups.py
+
+Rollup tables behind truncDateGroups and truncValueGroups.
+
+DailyActivity counts the rows of each model in ROLLUP_DATE_MODELS created
+by each user on each (local) date, and ValueRollup counts the rows of
+each model in ROLLUP_VALUE_FIELDS by user and value. Signals keep them
+up to date on insert, update and delete, and `manage.py rebuild_rollups`
+backfills them from the existing data. Month and year groups are
+derived from the daily rows.
+
+Groups of other models or fields are still computed from the model
+tables.
+"""
+
+import datetime
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate, TruncMonth, TruncYear
+from django.utils import timezone
+
+import sui_hei.models
+from .models import DailyActivity, ValueRollup
+
+# Models with `user` and `created` fields
+ROLLUP_DATE_MODELS = ("Puzzle", "Dialogue", "ChatMessage")
+# Models with `user`, and their fields to count by value
+ROLLUP_VALUE_FIELDS = {
+    "Star": ("value", ),
+    "Bookmark": ("value", ),
+}
+
+
+def local_date(value):
+    if isinstance(value, datetime.datetime):
+        return timezone.localtime(value).date()
+    return value
+
+
+def _increment(rollup, delta, **key):
+    '''
+    Add `delta` to the count of the `rollup` row identified by `key`,
+    creating the row if needed.
+
+    Rows are never created for a negative `delta`: the row is already
+    deleted when the deletion of a user cascades to it before the
+    counted rows.
+    '''
+    qs = rollup.objects.filter(**key)
+    if qs.update(count=F("count") + delta) or delta < 0:
+        return
+    try:
+        with transaction.atomic():
+            rollup.objects.create(count=delta, **key)
+    except IntegrityError:
+        # Created concurrently
+        qs.update(count=F("count") + delta)
+
+
+# {{{1 Recording
+def record_activity(model_name, user_id, created, delta=1):
+    if created is None:
+        return
+    _increment(
+        DailyActivity,
+        delta,
+        model=model_name,
+        user_id=user_id,
+        date=local_date(created))
+
+
+def record_value(model_name, field, user_id, value, delta=1):
+    if value is None:
+        return
+    _increment(
+        ValueRollup,
+        delta,
+        model=model_name,
+        field=field,
+        user_id=user_id,
+        value=value)
+
+
+# {{{1 Rebuilding
+def rebuild_rollups():
+    '''
+    Recompute every rollup from the model tables.
+
+    Returns
+    -------
+    (number of DailyActivity rows, number of ValueRollup rows)
+    '''
+    activities = []
+    for model_name in ROLLUP_DATE_MODELS:
+        cls = getattr(sui_hei.models, model_name)
+        rows = cls.objects.filter(created__isnull=False)\
+                .annotate(day=TruncDate("created"))\
+                .order_by()\
+                .values("user", "day")\
+                .annotate(count=Count("pk"))
+        activities.extend(
+            DailyActivity(
+                model=model_name,
+                user_id=row["user"],
+                date=row["day"],
+                count=row["count"]) for row in rows)
+
+    values = []
+    for model_name, fields in ROLLUP_VALUE_FIELDS.items():
+        cls = getattr(sui_hei.models, model_name)
+        for field in fields:
+            rows = cls.objects.filter(**{field + "__isnull": False})\
+                    .order_by()\
+                    .values("user", field)\
+                    .annotate(count=Count("pk"))
+            values.extend(
+                ValueRollup(
+                    model=model_name,
+                    field=field,
+                    user_id=row["user"],
+                    value=row[field],
+                    count=row["count"]) for row in rows)
+
+    with transaction.atomic():
+        DailyActivity.objects.all().delete()
+        DailyActivity.objects.bulk_create(activities)
+        ValueRollup.objects.all().delete()
+        ValueRollup.objects.bulk_create(values)
+    return len(activities), len(values)
+
+
+# {{{1 Querying
+def trunc_date_groups(model_name,
+                      by,
+                      user_id=None,
+                      created__gte=None,
+                      created__lte=None):
+    '''
+    Returns
+    -------
+    list of {"timestop", "count"} ordered by timestop, or None if
+    `model_name` is not rolled up.
+    '''
+    if model_name not in ROLLUP_DATE_MODELS:
+        return None
+
+    qs = DailyActivity.objects.filter(model=model_name, count__gt=0)
+    if user_id is not None:
+        qs = qs.filter(user_id=user_id)
+    if created__gte is not None:
+        qs = qs.filter(date__gte=local_date(created__gte))
+    if created__lte is not None:
+        qs = qs.filter(date__lte=local_date(created__lte))
+
+    if by == "date":
+        qs = qs.annotate(timestop=F("date"))
+    else:
+        Trunc = {"month": TruncMonth, "year": TruncYear}[by]
+        qs = qs.annotate(timestop=Trunc("date"))
+    rows = qs.order_by("timestop")\
+            .values("timestop")\
+            .annotate(count=Sum("count"))
+
+    groups = []
+    for row in rows:
+        timestop = row["timestop"]
+        if by != "date":
+            # The same local midnight TruncMonth/TruncYear would give
+            timestop = timezone.make_aware(
+                datetime.datetime.combine(timestop, datetime.time()))
+        groups.append({"timestop": timestop, "count": row["count"]})
+    return groups
+
+
+def trunc_value_groups(model_name, field, user_id=None):
+    '''
+    Returns
+    -------
+    list of {"value", "count"} ordered by value, or None if `field` of
+    `model_name` is not rolled up.
+    '''
+    if field not in ROLLUP_VALUE_FIELDS.get(model_name, ()):
+        return None
+
+    qs = ValueRollup.objects.filter(model=model_name, field=field, count__gt=0)
+    if user_id is not None:
+        qs = qs.filter(user_id=user_id)
+    return list(
+        qs.order_by("value").values("value").annotate(count=Sum("count")))
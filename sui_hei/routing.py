@@ -1,12 +1,23 @@
 from channels.auth import AuthMiddlewareStack
+from channels.http import AsgiHandler
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.staticfiles import StaticFilesWrapper
+from django.conf import settings
 from django.conf.urls import url
 
 from .consumers import GraphqlSubcriptionConsumer, MainConsumer
+from .graphql_consumer import GraphQLHttpConsumer
+
+http_routes = [url("", AsgiHandler)]
+if not settings.DEBUG:
+    # GraphiQL is served by the Django view in DEBUG
+    http_routes.insert(
+        0, url("^graphql$", AuthMiddlewareStack(GraphQLHttpConsumer)))
 
 application = StaticFilesWrapper(
     ProtocolTypeRouter({
+        "http":
+        URLRouter(http_routes),
         "websocket":
         AuthMiddlewareStack(
             URLRouter([
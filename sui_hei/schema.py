@@ -1,13 +1,16 @@
+import base64
+import json
+import operator
 import os
 from collections import Counter
-from itertools import chain
+from functools import reduce
 
 import django_filters
 import graphene
 from dateutil.parser import parse
 from django.contrib.auth import authenticate, login, logout
-from django.core.exceptions import ValidationError
-from django.db.models import Count, F, Q, Sum
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import CharField, Count, F, Q, Value
 from django.db.models.functions import TruncDate, TruncMonth, TruncYear
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
@@ -25,7 +28,12 @@ from six import get_unbound_function
 
 import sui_hei.models
 
+from .counts import count_queryset
+from .loaders import get_loader
 from .models import *
+from .optimizer import optimize_queryset
+from .rollups import trunc_date_groups, trunc_value_groups
+from .search import search_puzzles
 from .subscription import Subscription as SubscriptionType
 
 MIN_CONTENT_SAFE_CREDIT = 1000
@@ -64,6 +72,18 @@ def resolveFilter(qs, args, filters=[], filter_fields=None):
     return qs
 
 
+# {{{1 resolveUserId
+def resolveUserId(userId):
+    '''
+    Convert the global id of a UserNode to a primary key, or None.
+    '''
+    if userId is None:
+        return None
+    className, pk = from_global_id(userId)
+    assert className == 'UserNode'
+    return pk
+
+
 # {{{1 resolveOrderBy
 def resolveOrderBy(qs, order_by):
     '''
@@ -95,6 +115,250 @@ def resolveOrderBy(qs, order_by):
         return qs.all()
 
 
+# {{{1 resolveKeyset
+def resolveOrderKeys(order_by):
+    '''
+    Parse order_by into a list of (fieldName, desc) sort keys,
+    with the same `-id` tiebreaker appended as in resolveOrderBy.
+    '''
+    keys = [(re.sub("^-", "", field), field[0] == '-')
+            for field in order_by or []]
+    if not any(fieldName in ("id", "pk") for fieldName, desc in keys):
+        keys.append(("id", True))
+    return keys
+
+
+def encodeCursor(obj, keys):
+    values = []
+    for fieldName, desc in keys:
+        value = obj
+        for name in fieldName.split("__"):
+            try:
+                name = value._meta.get_field(name).attname
+            except (AttributeError, FieldDoesNotExist):
+                pass
+            value = getattr(value, name, None)
+        values.append(value)
+    # isoformat keeps microseconds, which DjangoJSONEncoder truncates
+    cursor = json.dumps(values, default=lambda value: value.isoformat())
+    return base64.b64encode(cursor.encode()).decode()
+
+
+def decodeCursor(cursor, keys):
+    try:
+        values = json.loads(base64.b64decode(cursor).decode())
+        assert isinstance(values, list) and len(values) == len(keys)
+        return values
+    except Exception:
+        raise ValidationError(_("Invalid cursor"))
+
+
+def resolveKeyset(qs, order_by, limit, after=None, before=None):
+    '''
+    Slice qs by the sort keys of the row at `after` or `before`
+    instead of OFFSET, so that deep pages cost the same as the first one.
+
+    Parameters
+    ----------
+    qs: QuerySet
+    order_by: the same order_by passed to resolveOrderBy
+    limit: max number of rows
+    after/before: cursors encoded by encodeCursor
+
+    Returns
+    -------
+    (rows, has_more)
+    '''
+    keys = resolveOrderKeys(order_by)
+    backward = not after
+    values = decodeCursor(after or before, keys)
+
+    def nullable(fieldName):
+        try:
+            return qs.model._meta.get_field(fieldName).null
+        except FieldDoesNotExist:
+            return True
+
+    # (k1 > v1) OR (k1 = v1 AND k2 > v2) OR ..., with nulls put at last
+    conditions = []
+    equal = Q()
+    for (fieldName, desc), value in zip(keys, values):
+        if value is None:
+            if backward:
+                conditions.append(equal & Q(**{fieldName + "__isnull": False}))
+            equal &= Q(**{fieldName + "__isnull": True})
+            continue
+        lookup = "lt" if desc != backward else "gt"
+        condition = Q(**{"%s__%s" % (fieldName, lookup): value})
+        if not backward and nullable(fieldName):
+            condition |= Q(**{fieldName + "__isnull": True})
+        conditions.append(equal & condition)
+        equal &= Q(**{fieldName: value})
+
+    fieldQueries = []
+    for fieldName, desc in keys:
+        if desc != backward:
+            fieldQueries.append(F(fieldName).desc(nulls_last=not backward,
+                                                  nulls_first=backward))
+        else:
+            fieldQueries.append(F(fieldName).asc(nulls_last=not backward,
+                                                 nulls_first=backward))
+
+    qs = qs.filter(reduce(operator.or_, conditions)).order_by(*fieldQueries)
+    if isinstance(limit, int):
+        rows = list(qs[:limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+    else:
+        rows = list(qs)
+        has_more = False
+    if backward:
+        rows.reverse()
+    return rows, has_more
+
+
+# {{{1 resolvePage
+def resolvePage(connection, qs, order_by, kwargs, info):
+    '''
+    Paginate ordered qs into `connection`.
+
+    Use keyset pagination if `after` or `before` is given,
+    else use `limit` and `offset`.
+    '''
+    limit = kwargs.get("limit", None)
+    offset = kwargs.get("offset", None)
+    after = kwargs.get("after", None)
+    before = kwargs.get("before", None)
+    keys = resolveOrderKeys(order_by)
+    if not qs.ordered:
+        qs = qs.order_by("-id")
+    qs = optimize_queryset(
+        qs, info, required=[fieldName for fieldName, desc in keys])
+
+    total_count, total_count_exact = count_queryset(qs)
+    if after or before:
+        rows, has_more = resolveKeyset(qs, order_by, limit, after, before)
+        has_next_page = has_more if after else True
+        has_previous_page = has_more if before else True
+    elif isinstance(limit, int):
+        rows = list(resolveLimitOffset(qs, limit + 1, offset))
+        has_next_page = len(rows) > limit
+        has_previous_page = bool(offset)
+        rows = rows[:limit]
+    else:
+        rows = list(resolveLimitOffset(qs, limit, offset))
+        has_next_page = False
+        has_previous_page = bool(offset)
+
+    edges = [
+        connection.Edge(node=row, cursor=encodeCursor(row, keys))
+        for row in rows
+    ]
+    return connection(
+        total_count=total_count,
+        total_count_exact=total_count_exact,
+        edges=edges,
+        page_info=relay.PageInfo(
+            start_cursor=edges[0].cursor if edges else None,
+            end_cursor=edges[-1].cursor if edges else None,
+            has_next_page=has_next_page,
+            has_previous_page=has_previous_page))
+
+
+# {{{1 resolveTimeline
+TIMELINE_KEYS = [("created", False), ("kind", False), ("id", False)]
+
+
+def timelineKeyset(kind, cursor, lookup):
+    '''
+    Condition on the rows of `kind` sorting after (lookup="gt") or before
+    (lookup="lt") the timeline row at `cursor`.
+    '''
+    created, cursorKind, id = decodeCursor(cursor, TIMELINE_KEYS)
+    condition = Q(**{"created__" + lookup: created})
+    if kind == cursorKind:
+        condition |= Q(created=created, **{"id__" + lookup: id})
+    elif (kind > cursorKind) == (lookup == "gt"):
+        condition |= Q(created=created)
+    return condition
+
+
+def resolveTimeline(connection, puzzle, kwargs, info):
+    '''
+    Merge the dialogues and hints of `puzzle` into one timeline ordered by
+    `created`, as an ordered UNION in the database.
+
+    Supports the relay `first`/`last`/`after`/`before` arguments, and
+    `since` to only return hints created and dialogues created or
+    answered after that time.
+    '''
+    first = kwargs.get("first", None)
+    last = kwargs.get("last", None)
+    after = kwargs.get("after", None)
+    before = kwargs.get("before", None)
+    since = kwargs.get("since", None)
+
+    models = {"dialogue": Dialogue, "hint": Hint}
+    branches = []
+    for kind, model in models.items():
+        qs = model.objects.filter(puzzle=puzzle)
+        if since and model is Dialogue:
+            qs = qs.filter(Q(created__gt=since) | Q(answeredtime__gt=since))
+        elif since:
+            qs = qs.filter(created__gt=since)
+        if after:
+            qs = qs.filter(timelineKeyset(kind, after, "gt"))
+        if before:
+            qs = qs.filter(timelineKeyset(kind, before, "lt"))
+        branches.append(
+            qs.annotate(kind=Value(kind, output_field=CharField()))\
+                    .values_list("created", "kind", "id")\
+                    .order_by())
+
+    keys = [fieldName for fieldName, desc in TIMELINE_KEYS]
+    timeline = branches[0].union(*branches[1:], all=True)
+    has_next_page = has_previous_page = False
+    if isinstance(first, int):
+        rows = list(timeline.order_by(*keys)[:first + 1])
+        has_next_page = len(rows) > first
+        rows = rows[:first]
+        if isinstance(last, int):
+            has_previous_page = len(rows) > last
+            rows = rows[-last:] if last else []
+    elif isinstance(last, int):
+        rows = list(timeline.order_by(*["-" + key for key in keys])[:last + 1])
+        has_previous_page = len(rows) > last
+        rows = rows[:last]
+        rows.reverse()
+    else:
+        rows = list(timeline.order_by(*keys))
+
+    objects = {}
+    for kind, model in models.items():
+        ids = [id for created, rowKind, id in rows if rowKind == kind]
+        if ids:
+            qs = optimize_queryset(
+                model.objects.filter(id__in=ids),
+                info,
+                node_type="%sNode" % model.__name__)
+            objects.update({(kind, obj.id): obj for obj in qs})
+
+    edges = [
+        connection.Edge(
+            node=objects[(kind, id)],
+            cursor=base64.b64encode(
+                json.dumps([created.isoformat(), kind, id]).encode()).decode())
+        for created, kind, id in rows
+    ]
+    return connection(
+        edges=edges,
+        page_info=relay.PageInfo(
+            start_cursor=edges[0].cursor if edges else None,
+            end_cursor=edges[-1].cursor if edges else None,
+            has_next_page=has_next_page,
+            has_previous_page=has_previous_page))
+
+
 # {{{1 Nodes
 # {{{2 UserNode
 class UserNode(DjangoObjectType):
@@ -127,45 +391,43 @@ class UserNode(DjangoObjectType):
         return self.id
 
     def resolve_puzzleCount(self, info):
-        return self.puzzle_set.count()
+        return get_loader(info, "user.stats").load(self.id)\
+                .then(lambda stats: stats.puzzle_count)
 
     def resolve_quesCount(self, info):
-        return self.dialogue_set.count()
+        return get_loader(info, "user.quesCount").load(self.id)
 
     def resolve_goodQuesCount(self, info):
-        return self.dialogue_set.filter(good=True).count()
+        return get_loader(info, "user.stats").load(self.id)\
+                .then(lambda stats: stats.good_ques_count)
 
     def resolve_trueQuesCount(self, info):
-        return self.dialogue_set.filter(true=True).count()
+        return get_loader(info, "user.stats").load(self.id)\
+                .then(lambda stats: stats.true_ques_count)
 
     def resolve_commentCount(self, info):
-        return self.comment_set.count()
+        return get_loader(info, "user.commentCount").load(self.id)
 
     def resolve_rcommentCount(self, info):
-        return self.puzzle_set.annotate(Count('comment__id'))\
-                .aggregate(rcommentCount=Sum('comment__id__count'))\
-                .get('rcommentCount', 0)
+        return get_loader(info, "user.stats").load(self.id)\
+                .then(lambda stats: stats.rcomment_count)
 
     def resolve_dmCount(self, info):
         return self.dm_count
 
     def resolve_starCount(self, info):
-        return self.star_set.aggregate(Count('star__value'))\
-                .get('star__count__count', 0)
+        return get_loader(info, "user.starCount").load(self.id)
 
     def resolve_starSum(self, info):
-        return self.star_set.aggregate(Sum('star__count'))\
-                .get('star__count__sum', 0)
+        return get_loader(info, "user.starSum").load(self.id)
 
     def resolve_rstarCount(self, info):
-        return self.puzzle_set.annotate(Count('star__value'))\
-                .aggregate(rstarCount=Sum('star__value__count'))\
-                .get('rstarCount', 0)
+        return get_loader(info, "user.stats").load(self.id)\
+                .then(lambda stats: stats.rstar_count)
 
     def resolve_rstarSum(self, info):
-        return self.puzzle_set.annotate(Sum('star__value'))\
-                .aggregate(rstarSum=Sum('star__value__sum'))\
-                .get('rstarSum', 0)
+        return get_loader(info, "user.stats").load(self.id)\
+                .then(lambda stats: stats.rstar_sum)
 
     def resolve_can_review_award_application(self, info):
         return self.has_perm("sui_hei.can_review_award_application")
@@ -209,6 +471,7 @@ class AwardApplicationNode(DjangoObjectType):
 class PuzzleNode(DjangoObjectType):
     class Meta:
         model = Puzzle
+        exclude_fields = list(PUZZLE_COUNTER_FIELDS.values())
         filter_fields = []
         interfaces = (relay.Node, )
 
@@ -224,49 +487,37 @@ class PuzzleNode(DjangoObjectType):
         return self.id
 
     def resolve_quesCount(self, info):
-        return self.dialogue_set.count()
+        return self.ques_count
 
     def resolve_uaquesCount(self, info):
-        return self.dialogue_set.filter(
-            Q(answer__isnull=True) | Q(answer__exact="")).count()
+        return self.uaques_count
 
     def resolve_starCount(self, info):
-        try:
-            return self.starCount
-        except:
-            return self.star_set.count()
+        return self.star_count
 
     def resolve_starSum(self, info):
-        try:
-            return self.StarSum
-        except:
-            return self.star_set.aggregate(Sum("value")).get("value__sum", 0)
+        return self.star_sum
 
     def resolve_commentCount(self, info):
-        try:
-            return self.commentCount
-        except:
-            return self.comment_set.count()
+        return self.comment_count
 
     def resolve_bookmarkCount(self, info):
-        try:
-            return self.bookmarkCount
-        except:
-            return self.bookmark_set.count()
+        return self.bookmark_count
 
     # Prevent sending answer to un-privileged users
     def resolve_solution(self, info):
         user = info.context.user
 
-        if user == self.user or self.status == 1 or self.status == 2:
+        if user.id == self.user_id or self.status == 1 or self.status == 2:
             return self.solution
 
         # Long-term yami
-        if self.status == 0 and\
-                self.yami == 2 and\
-                (user.is_anonymous or\
-                 {'true': True} in self.dialogue_set.filter(user=user).values("true")):
-            return self.solution
+        if self.status == 0 and self.yami == 2:
+            if user.is_anonymous:
+                return self.solution
+            solved = get_loader(info, "puzzle.solvedBy").load(
+                (user.id, self.id))
+            return solved.then(lambda solved: self.solution if solved else "")
         return ""
 
 
@@ -482,6 +733,7 @@ class WikiNode(graphene.ObjectType):
 # {{{2 PuzzleConnection
 class PuzzleConnection(graphene.Connection):
     total_count = graphene.Int()
+    total_count_exact = graphene.Boolean()
 
     class Meta:
         node = PuzzleNode
@@ -490,6 +742,7 @@ class PuzzleConnection(graphene.Connection):
 # {{{2 BookmarkConnection
 class BookmarkConnection(graphene.Connection):
     total_count = graphene.Int()
+    total_count_exact = graphene.Boolean()
 
     class Meta:
         node = BookmarkNode
@@ -498,6 +751,7 @@ class BookmarkConnection(graphene.Connection):
 # {{{2 ChatMessageConnection
 class ChatMessageConnection(graphene.Connection):
     total_count = graphene.Int()
+    total_count_exact = graphene.Boolean()
 
     class Meta:
         node = ChatMessageNode
@@ -506,6 +760,7 @@ class ChatMessageConnection(graphene.Connection):
 # {{{2 StarConnection
 class StarConnection(graphene.Connection):
     total_count = graphene.Int()
+    total_count_exact = graphene.Boolean()
 
     class Meta:
         node = StarNode
@@ -514,6 +769,7 @@ class StarConnection(graphene.Connection):
 # {{{2 ChatRoomConnection
 class ChatRoomConnection(graphene.Connection):
     total_count = graphene.Int()
+    total_count_exact = graphene.Boolean()
 
     class Meta:
         node = ChatRoomNode
@@ -522,6 +778,7 @@ class ChatRoomConnection(graphene.Connection):
 # {{{2 CommentConnection
 class CommentConnection(graphene.Connection):
     total_count = graphene.Int()
+    total_count_exact = graphene.Boolean()
 
     class Meta:
         node = CommentNode
@@ -553,6 +810,19 @@ class PuzzleShowUnionConnection(relay.Connection):
 
 
 # {{{1 Subscriptions
+def resolveTopicId(globalId, nodeName):
+    '''
+    Convert the global id of a node to an integer primary key, or None if
+    it is not one.
+    '''
+    try:
+        className, pk = from_global_id(globalId)
+        if className == nodeName:
+            return int(pk)
+    except (TypeError, ValueError, UnicodeDecodeError):
+        pass
+
+
 # {{{2 PuzzleSubscription
 class PuzzleSubscription(SubscriptionType):
     class Meta:
@@ -562,14 +832,16 @@ class PuzzleSubscription(SubscriptionType):
         id = graphene.String()
 
     @classmethod
-    def subscribe(cls, info):
-        return [Puzzle]
+    def subscribe(cls, info, *, id=None):
+        if id is None:
+            return [Puzzle]
+        pk = resolveTopicId(id, 'PuzzleNode')
+        return [] if pk is None else [(Puzzle, 'id', pk)]
 
     @classmethod
-    def next(cls, pk_model, info, *, id=None):
-        pk, model_label = pk_model
+    def next(cls, instance_model, info, *, id=None):
+        obj, model_label = instance_model
         if model_label == 'sui_hei.puzzle':
-            obj = Puzzle.objects.get(id=pk)
             if id:
                 if id == to_global_id('PuzzleNode', obj.id):
                     return obj
@@ -583,14 +855,13 @@ class DialogueSubscription(SubscriptionType):
         output = DialogueNode
 
     @classmethod
-    def subscribe(cls, info):
+    def subscribe(cls, info, **kwargs):
         return [Dialogue]
 
     @classmethod
-    def next(cls, pk_model, info):
-        pk, model_label = pk_model
+    def next(cls, instance_model, info):
+        obj, model_label = instance_model
         if model_label == 'sui_hei.dialogue':
-            obj = Dialogue.objects.get(id=pk)
             return obj
 
 
@@ -603,21 +874,22 @@ class PuzzleShowUnionSubscription(SubscriptionType):
         id = graphene.String()
 
     @classmethod
-    def subscribe(cls, info):
-        return [Dialogue, Hint]
+    def subscribe(cls, info, *, id=None):
+        if id is None:
+            return [Dialogue, Hint]
+        pk = resolveTopicId(id, 'PuzzleNode')
+        if pk is None:
+            return []
+        return [(Dialogue, 'puzzle_id', pk), (Hint, 'puzzle_id', pk)]
 
     @classmethod
-    def next(cls, pk_model, info, *, id=None):
-        pk, model_label = pk_model
-        if model_label == 'sui_hei.hint':
-            obj = Hint.objects.get(id=pk)
-        elif model_label == 'sui_hei.dialogue':
-            obj = Dialogue.objects.get(id=pk)
-        else:
+    def next(cls, instance_model, info, *, id=None):
+        obj, model_label = instance_model
+        if model_label not in ('sui_hei.hint', 'sui_hei.dialogue'):
             return
 
         if id:
-            if id == to_global_id('PuzzleNode', obj.puzzle.id):
+            if id == to_global_id('PuzzleNode', obj.puzzle_id):
                 return obj
             return
         return obj
@@ -632,14 +904,18 @@ class ChatMessageSubscription(SubscriptionType):
         chatroomName = graphene.String()
 
     @classmethod
-    def subscribe(cls, info):
-        return [ChatMessage]
+    def subscribe(cls, info, *, chatroomName=None):
+        if chatroomName is None:
+            return [ChatMessage]
+        chatroom = ChatRoom.objects.filter(name=chatroomName).first()
+        if chatroom is None:
+            return []
+        return [(ChatMessage, 'chatroom_id', chatroom.id)]
 
     @classmethod
-    def next(cls, pk_model, info, *, chatroomName=None):
-        pk, model_label = pk_model
+    def next(cls, instance_model, info, *, chatroomName=None):
+        obj, model_label = instance_model
         if model_label == 'sui_hei.chatmessage':
-            obj = ChatMessage.objects.get(id=pk)
             if chatroomName:
                 if chatroomName == obj.chatroom.name:
                     return obj
@@ -656,19 +932,19 @@ class DirectMessageSubscription(SubscriptionType):
         receiver = graphene.ID()
 
     @classmethod
-    def subscribe(cls, info):
-        return [DirectMessage]
+    def subscribe(cls, info, *, receiver=None):
+        pk = resolveTopicId(receiver, 'UserNode')
+        return [] if pk is None else [(DirectMessage, 'receiver_id', pk)]
 
     @classmethod
-    def next(cls, pk_model, info, *, receiver=None):
+    def next(cls, instance_model, info, *, receiver=None):
         if receiver == None:
             return
 
-        pk, model_label = pk_model
+        obj, model_label = instance_model
         if model_label == 'sui_hei.directmessage':
-            obj = DirectMessage.objects.get(id=pk)
             className, receiver_id = from_global_id(receiver)
-            if receiver_id == str(obj.receiver.id):
+            if receiver_id == str(obj.receiver_id):
                 return obj
             return
 
@@ -1576,6 +1852,12 @@ class Query(object):
         created__month=graphene.Int(),
         limit=graphene.Int(),
         offset=graphene.Int())
+    search_puzzles = graphene.ConnectionField(
+        PuzzleConnection,
+        query=graphene.String(required=True),
+        fields=graphene.List(of_type=graphene.String),
+        limit=graphene.Int(),
+        offset=graphene.Int())
     all_chatmessages_lo = graphene.ConnectionField(
         ChatMessageConnection,
         limit=graphene.Int(),
@@ -1644,37 +1926,41 @@ class Query(object):
 
     # {{{2 unions
     puzzle_show_union = relay.ConnectionField(
-        PuzzleShowUnionConnection, id=graphene.ID(required=True))
+        PuzzleShowUnionConnection,
+        id=graphene.ID(required=True),
+        since=graphene.DateTime())
 
     # {{{2 resolves
     # {{{3 resolve all
     def resolve_all_users(self, info, **kwargs):
         orderBy = kwargs.get("orderBy", None)
-        return resolveOrderBy(User.objects, orderBy)
+        qs = resolveOrderBy(User.objects, orderBy)
+        return optimize_queryset(qs, info)
 
     def resolve_all_awards(self, info, **kwargs):
         orderBy = kwargs.get("orderBy", None)
-        return resolveOrderBy(Award.objects, orderBy)
+        qs = resolveOrderBy(Award.objects, orderBy)
+        return optimize_queryset(qs, info)
 
     def resolve_all_award_applications(self, info, **kwargs):
         orderBy = kwargs.get("orderBy", None)
-        return resolveOrderBy(AwardApplication.objects, orderBy)
+        qs = resolveOrderBy(AwardApplication.objects, orderBy)
+        return optimize_queryset(qs, info)
 
     def resolve_all_userawards(self, info, **kwargs):
         orderBy = kwargs.get("orderBy", None)
-        return resolveOrderBy(UserAward.objects, orderBy)
+        qs = resolveOrderBy(UserAward.objects, orderBy)
+        return optimize_queryset(qs, info)
 
     def resolve_all_puzzles(self, info, **kwargs):
         orderBy = kwargs.get("orderBy", [])
-        limit = kwargs.get("limit", None)
-        offset = kwargs.get("offset", None)
         qs = Puzzle.objects.all()
-        if "starCount" in orderBy or "-starCount" in orderBy:
-            qs = qs.annotate(starCount=Count("star"))
-        if "starSum" in orderBy or "-starSum" in orderBy:
-            qs = qs.annotate(starSum=Sum("star__value"))
-        if "commentCount" in orderBy or "-commentCount" in orderBy:
-            qs = qs.annotate(commentCount=Count("comment"))
+        # Order by the denormalized counter columns
+        orderBy = [
+            re.sub(r"\w+$",
+                   lambda m: PUZZLE_COUNTER_FIELDS.get(m.group(), m.group()),
+                   field) for field in orderBy
+        ]
         qs = resolveOrderBy(qs, orderBy)
         qs = resolveFilter(
             qs,
@@ -1691,37 +1977,26 @@ class Query(object):
                 "yami__exact",
             ],
             filter_fields={"user": User})
-        total_count = qs.count()
-        qs = resolveLimitOffset(qs, limit, offset)
-        qs = list(qs)
-        return PuzzleConnection(
-            total_count=total_count,
-            edges=[
-                PuzzleConnection.Edge(node=qs[i], ) for i in range(len(qs))
-            ])
+        return resolvePage(PuzzleConnection, qs, orderBy, kwargs, info)
+
+    def resolve_search_puzzles(self, info, **kwargs):
+        fields = kwargs.get("fields", None) or ["title", "content"]
+        qs = search_puzzles(kwargs["query"], fields)
+        return resolvePage(PuzzleConnection, qs, ["-rank"], kwargs, info)
 
     def resolve_all_dialogues(self, info, **kwargs):
         orderBy = kwargs.get("orderBy", None)
-        return resolveOrderBy(Dialogue.objects, orderBy)
+        qs = resolveOrderBy(Dialogue.objects, orderBy)
+        return optimize_queryset(qs, info)
 
     def resolve_all_chatmessages_lo(self, info, **kwargs):
         orderBy = kwargs.get("orderBy", None)
         chatroomName = kwargs.get("chatroomName", None)
-        limit = kwargs.get("limit", None)
-        offset = kwargs.get("offset", None)
         qs = resolveOrderBy(ChatMessage.objects, orderBy)
         if chatroomName:
             chatroom = ChatRoom.objects.get(name=chatroomName)
             qs = qs.filter(chatroom=chatroom)
-        total_count = qs.count()
-        qs = resolveLimitOffset(qs, limit, offset)
-        qs = list(qs)
-        return ChatMessageConnection(
-            total_count=total_count,
-            edges=[
-                ChatMessageConnection.Edge(node=qs[i], )
-                for i in range(len(qs))
-            ])
+        return resolvePage(ChatMessageConnection, qs, orderBy, kwargs, info)
 
     def resolve_all_chatmessages(self, info, **kwargs):
         orderBy = kwargs.get("orderBy", None)
@@ -1729,13 +2004,11 @@ class Query(object):
         qs = resolveOrderBy(ChatMessage.objects, orderBy)
         if chatroomName:
             chatroom = ChatRoom.objects.get(name=chatroomName)
-            return qs.filter(chatroom=chatroom)
-        return qs
+            qs = qs.filter(chatroom=chatroom)
+        return optimize_queryset(qs, info)
 
     def resolve_all_chatrooms_lo(self, info, **kwargs):
         orderBy = kwargs.get("orderBy", None)
-        limit = kwargs.get("limit", None)
-        offset = kwargs.get("offset", None)
         qs = resolveOrderBy(ChatRoom.objects, orderBy)
         qs = resolveFilter(
             qs,
@@ -1745,14 +2018,7 @@ class Query(object):
                 "user": User,
                 "puzzle": Puzzle
             })
-        total_count = qs.count()
-        qs = resolveLimitOffset(qs, limit, offset)
-        qs = list(qs)
-        return ChatRoomConnection(
-            total_count=total_count,
-            edges=[
-                ChatRoomConnection.Edge(node=qs[i], ) for i in range(len(qs))
-            ])
+        return resolvePage(ChatRoomConnection, qs, orderBy, kwargs, info)
 
     def resolve_all_directmessages(self, info, **kwargs):
         userId = kwargs.get("userId", None)
@@ -1763,16 +2029,15 @@ class Query(object):
             assert className == 'UserNode'
             qs = qs.filter(Q(sender_id=userId) | Q(receiver_id=userId))
         qs = resolveOrderBy(qs, orderBy)
-        return qs
+        return optimize_queryset(qs, info)
 
     def resolve_all_comments(self, info, **kwargs):
         orderBy = kwargs.get("orderBy", None)
-        return resolveOrderBy(Comment.objects, orderBy)
+        qs = resolveOrderBy(Comment.objects, orderBy)
+        return optimize_queryset(qs, info)
 
     def resolve_all_stars(self, info, **kwargs):
         orderBy = kwargs.get("orderBy", [])
-        limit = kwargs.get("limit", None)
-        offset = kwargs.get("offset", None)
         qs = Star.objects.all()
         qs = resolveOrderBy(qs, orderBy)
         qs = resolveFilter(
@@ -1783,19 +2048,10 @@ class Query(object):
                 "user": User,
                 "puzzle": Puzzle,
             })
-        total_count = qs.count()
-        qs = resolveLimitOffset(qs, limit, offset)
-        qs = list(qs)
-        return StarConnection(
-            total_count=total_count,
-            edges=[
-                PuzzleConnection.Edge(node=qs[i], ) for i in range(len(qs))
-            ])
+        return resolvePage(StarConnection, qs, orderBy, kwargs, info)
 
     def resolve_all_bookmarks(self, info, **kwargs):
         orderBy = kwargs.get("orderBy", [])
-        limit = kwargs.get("limit", None)
-        offset = kwargs.get("offset", None)
         qs = Bookmark.objects.all()
         qs = resolveOrderBy(qs, orderBy)
         qs = resolveFilter(
@@ -1806,31 +2062,25 @@ class Query(object):
                 "user": User,
                 "puzzle": Puzzle
             })
-        total_count = qs.count()
-        qs = resolveLimitOffset(qs, limit, offset)
-        qs = list(qs)
-        return BookmarkConnection(
-            total_count=total_count,
-            edges=[
-                PuzzleConnection.Edge(node=qs[i], ) for i in range(len(qs))
-            ])
+        return resolvePage(BookmarkConnection, qs, orderBy, kwargs, info)
 
     def resolve_all_award_applications(self, info, **kwargs):
         orderBy = kwargs.get("orderBy", None)
-        return resolveOrderBy(AwardApplication.objects, orderBy)
+        qs = resolveOrderBy(AwardApplication.objects, orderBy)
+        return optimize_queryset(qs, info)
 
     def resolve_all_schedules(self, info, **kwargs):
         orderBy = kwargs.get("orderBy", None)
-        return resolveOrderBy(Schedule.objects, orderBy)
+        qs = resolveOrderBy(Schedule.objects, orderBy)
+        return optimize_queryset(qs, info)
 
     def resolve_all_events(self, info, **kwargs):
         orderBy = kwargs.get("orderBy", None)
-        return resolveOrderBy(Event.objects, orderBy)
+        qs = resolveOrderBy(Event.objects, orderBy)
+        return optimize_queryset(qs, info)
 
     def resolve_all_comments_lo(self, info, **kwargs):
         orderBy = kwargs.get("orderBy", None)
-        limit = kwargs.get("limit", None)
-        offset = kwargs.get("offset", None)
         qs = resolveOrderBy(Comment.objects, orderBy)
         qs = resolveFilter(
             qs,
@@ -1840,23 +2090,14 @@ class Query(object):
                 "user": User,
                 "puzzle__user": User,
             })
-        total_count = qs.count()
-        qs = resolveLimitOffset(qs, limit, offset)
-        qs = list(qs)
-        return CommentConnection(
-            total_count=total_count,
-            edges=[
-                CommentConnection.Edge(node=qs[i], ) for i in range(len(qs))
-            ])
+        return resolvePage(CommentConnection, qs, orderBy, kwargs, info)
 
     # {{{3 resolve union
     def resolve_puzzle_show_union(self, info, **kwargs):
         className, puzzleId = from_global_id(kwargs["id"])
         assert className == 'PuzzleNode'
-        puzzle = Puzzle.objects.get(id=puzzleId)
-        dialogue_list = Dialogue.objects.filter(puzzle__exact=puzzle)
-        hint_list = Hint.objects.filter(puzzle__exact=puzzle)
-        return sorted(chain(dialogue_list, hint_list), key=lambda x: x.created)
+        return resolveTimeline(PuzzleShowUnionConnection, puzzleId, kwargs,
+                               info)
 
     # {{{3 custom resolves
     def resolve_trunc_date_groups(self, info, **kwargs):
@@ -1865,6 +2106,15 @@ class Query(object):
         cls = getattr(sui_hei.models, className)
 
         assert by in ['date', 'month', 'year']
+        groups = trunc_date_groups(
+            className,
+            by,
+            user_id=resolveUserId(kwargs.get('user')),
+            created__gte=kwargs.get('created__gte'),
+            created__lte=kwargs.get('created__lte'))
+        if groups is not None:
+            return groups
+
         if by == 'date':
             TruncMethod = TruncDate
         elif by == 'month':
@@ -1888,6 +2138,11 @@ class Query(object):
         value = kwargs.get('value', 'value')
         cls = getattr(sui_hei.models, className)
 
+        groups = trunc_value_groups(
+            className, value, user_id=resolveUserId(kwargs.get('user')))
+        if groups is not None:
+            return groups
+
         qs = cls.objects
         qs = resolveFilter(qs, kwargs, filter_fields={'user': User})
         qs = qs.values(value).annotate(count=Count(value))
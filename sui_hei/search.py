@@ -0,0 +1,138 @@
+"""
+search.py
+
+Full-text search of puzzles with a bigram inverted index.
+
+Text is normalized with NFKC and lowercased, split on whitespace, and
+every pair of adjacent characters of each token is stored as a gram in
+PuzzleNgram along with its number of occurrences. The last character of
+each token is also stored followed by a space, so that single characters
+can be searched by prefix.
+
+A puzzle matches a query if its searched fields contain every bigram of
+every term of the query. Matches are ranked by the occurrences of those
+grams, weighted by SEARCH_FIELD_WEIGHTS.
+
+Usage:
+    search_puzzles("ウミガメ スープ").order_by("-rank")
+"""
+
+import unicodedata
+from collections import Counter
+from functools import reduce
+
+from django.db.models import (Case, Count, F, IntegerField, OuterRef, Q,
+                              Subquery, Sum, When)
+
+from .models import Puzzle, PuzzleNgram
+
+SEARCH_FIELDS = ("title", "content", "solution")
+SEARCH_FIELD_WEIGHTS = {"title": 5, "content": 1, "solution": 1}
+
+
+def tokenize(text):
+    return unicodedata.normalize("NFKC", text or "").lower().split()
+
+
+def bigrams(text):
+    '''
+    Returns
+    -------
+    Counter of the grams of `text` for indexing
+    '''
+    grams = Counter()
+    for token in tokenize(text):
+        grams.update(token[i:i + 2] for i in range(len(token) - 1))
+        grams[token[-1] + " "] += 1
+    return grams
+
+
+# {{{1 Indexing
+def index_puzzles(puzzles):
+    '''
+    Replace the index entries of `puzzles`.
+
+    Parameters
+    ----------
+    puzzles: iterable of Puzzle instances
+    '''
+    puzzles = list(puzzles)
+    PuzzleNgram.objects.filter(puzzle__in=puzzles).delete()
+    PuzzleNgram.objects.bulk_create(
+        PuzzleNgram(puzzle=puzzle, field=field, gram=gram, count=count)
+        for puzzle in puzzles for field in SEARCH_FIELDS
+        for gram, count in bigrams(getattr(puzzle, field)).items())
+
+
+def rebuild_index(puzzles=None, batch_size=500):
+    '''
+    Rebuild the index from scratch.
+
+    Parameters
+    ----------
+    puzzles: iterable of puzzle ids to rebuild. Rebuild all puzzles if None.
+
+    Returns
+    -------
+    number of puzzles indexed
+    '''
+    qs = Puzzle.objects.order_by("id").only("id", *SEARCH_FIELDS)
+    if puzzles is not None:
+        qs = qs.filter(id__in=list(puzzles))
+    else:
+        PuzzleNgram.objects.all().delete()
+
+    indexed = 0
+    last_id = 0
+    while True:
+        batch = list(qs.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            return indexed
+        index_puzzles(batch)
+        indexed += len(batch)
+        last_id = batch[-1].id
+
+
+# {{{1 Searching
+def search_puzzles(query, fields=("title", "content")):
+    '''
+    Find puzzles matching `query` in `fields`.
+
+    Returns
+    -------
+    QuerySet of Puzzle annotated with `rank`. Empty if `query` has no
+    searchable terms.
+    '''
+    fields = [field for field in fields if field in SEARCH_FIELDS]
+    terms = tokenize(query)
+    grams = {term[i:i + 2] for term in terms for i in range(len(term) - 1)}
+    chars = {term for term in terms if len(term) == 1}
+    if not fields or not (grams or chars):
+        return Puzzle.objects.none()
+
+    ngrams = PuzzleNgram.objects.filter(field__in=fields)
+    conditions = [Q(gram__in=grams)] if grams else []
+    conditions.extend(Q(gram__startswith=char) for char in chars)
+    matched = ngrams.filter(reduce(lambda a, b: a | b, conditions))\
+            .order_by()\
+            .values("puzzle")\
+            .annotate(rank=Sum(
+                Case(*[When(field=field, then=F("count") * weight)
+                       for field, weight in SEARCH_FIELD_WEIGHTS.items()],
+                     output_field=IntegerField())))
+
+    qs = Puzzle.objects.all()
+    if grams:
+        qs = qs.filter(id__in=ngrams.filter(gram__in=grams)\
+                .order_by()\
+                .values("puzzle")\
+                .annotate(matched=Count("gram", distinct=True))\
+                .filter(matched=len(grams))\
+                .values("puzzle"))
+    for char in chars:
+        qs = qs.filter(id__in=ngrams.filter(gram__startswith=char)\
+                .values("puzzle"))
+    return qs.annotate(
+        rank=Subquery(
+            matched.filter(puzzle=OuterRef("pk")).values("rank")[:1],
+            output_field=IntegerField()))
@@ -2,10 +2,14 @@ import logging
 from datetime import timedelta
 
 from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from twitter import OAuth, Twitter
 
+from sui_hei.response_cache import response_cache
+
 ENABLE_TWITTERBOT = settings.ENABLE_TWITTERBOT
 TOKEN = settings.TOKEN
 TOKEN_SECRET = settings.TOKEN_SECRET
@@ -115,3 +119,210 @@ def add_twitter_on_schedule_created(sender, instance, created, **kwargs):
 
     except Exception as e:
         logger.warning("Error update twitter status: %s" % e)
+
+
+# {{{1 UserStats
+def _update_userstats(user_id, **deltas):
+    from sui_hei.models import UserStats
+
+    deltas = {field: delta for field, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    def apply():
+        return UserStats.objects.filter(user_id=user_id).update(
+            **{field: F(field) + delta
+               for field, delta in deltas.items()})
+
+    # Without a row, decrements are left to the next computation: the row
+    # is already deleted when the deletion of a user cascades to it
+    # before the counted rows.
+    if not apply() and all(delta > 0 for delta in deltas.values()):
+        # No statistics for this user yet: create them from scratch,
+        # which already includes the current change. If a concurrent save
+        # created them first, its row misses this change, so apply it.
+        created = UserStats.objects.compute(users=[user_id])
+        try:
+            with transaction.atomic():
+                for stats in created:
+                    stats.save(force_insert=True)
+        except IntegrityError:
+            apply()
+    response_cache.evict(UserStats._meta.label_lower)
+
+
+def remember_counter_fields(sender, instance, **kwargs):
+    # Only read loaded fields to avoid querying deferred ones.
+    instance._counter_snapshot = {
+        field: instance.__dict__.get(field)
+        for field in ("good", "true", "value", "answer")
+    }
+
+
+def update_userstats_on_puzzle_saved(sender, instance, created, **kwargs):
+    if created:
+        _update_userstats(instance.user_id, puzzle_count=1)
+
+
+def update_userstats_on_puzzle_deleted(sender, instance, **kwargs):
+    _update_userstats(instance.user_id, puzzle_count=-1)
+
+
+def update_userstats_on_dialogue_saved(sender, instance, created, **kwargs):
+    snapshot = {} if created else instance._counter_snapshot
+    _update_userstats(
+        instance.user_id,
+        good_ques_count=int(instance.good) - int(bool(snapshot.get("good"))),
+        true_ques_count=int(instance.true) - int(bool(snapshot.get("true"))))
+
+
+def update_userstats_on_dialogue_deleted(sender, instance, **kwargs):
+    _update_userstats(
+        instance.user_id,
+        good_ques_count=-int(instance.good),
+        true_ques_count=-int(instance.true))
+
+
+def update_userstats_on_star_saved(sender, instance, created, **kwargs):
+    snapshot = {} if created else instance._counter_snapshot
+    _update_userstats(
+        instance.puzzle.user_id,
+        rstar_count=1 if created else 0,
+        rstar_sum=instance.value - (snapshot.get("value") or 0))
+
+
+def update_userstats_on_star_deleted(sender, instance, **kwargs):
+    _update_userstats(
+        instance.puzzle.user_id, rstar_count=-1, rstar_sum=-instance.value)
+
+
+def update_userstats_on_comment_saved(sender, instance, created, **kwargs):
+    if created:
+        _update_userstats(instance.puzzle.user_id, rcomment_count=1)
+
+
+def update_userstats_on_comment_deleted(sender, instance, **kwargs):
+    _update_userstats(instance.puzzle.user_id, rcomment_count=-1)
+
+
+# {{{1 Puzzle counters
+def _update_puzzle_counters(puzzle_id, **deltas):
+    from sui_hei.models import Puzzle
+
+    deltas = {field: delta for field, delta in deltas.items() if delta}
+    if deltas:
+        Puzzle.objects.filter(id=puzzle_id).update(
+            **{field: F(field) + delta
+               for field, delta in deltas.items()})
+        response_cache.evict(Puzzle._meta.label_lower)
+
+
+def update_puzzle_counters_on_dialogue_saved(sender, instance, created,
+                                             **kwargs):
+    if created:
+        _update_puzzle_counters(
+            instance.puzzle_id,
+            ques_count=1,
+            uaques_count=int(not instance.answer))
+    else:
+        snapshot = instance._counter_snapshot
+        _update_puzzle_counters(
+            instance.puzzle_id,
+            uaques_count=int(not instance.answer) -
+            int(not snapshot.get("answer")))
+
+
+def update_puzzle_counters_on_dialogue_deleted(sender, instance, **kwargs):
+    _update_puzzle_counters(
+        instance.puzzle_id,
+        ques_count=-1,
+        uaques_count=-int(not instance.answer))
+
+
+def update_puzzle_counters_on_star_saved(sender, instance, created,
+                                         **kwargs):
+    snapshot = {} if created else instance._counter_snapshot
+    _update_puzzle_counters(
+        instance.puzzle_id,
+        star_count=1 if created else 0,
+        star_sum=instance.value - (snapshot.get("value") or 0))
+
+
+def update_puzzle_counters_on_star_deleted(sender, instance, **kwargs):
+    _update_puzzle_counters(
+        instance.puzzle_id, star_count=-1, star_sum=-instance.value)
+
+
+def update_puzzle_counters_on_comment_saved(sender, instance, created,
+                                            **kwargs):
+    if created:
+        _update_puzzle_counters(instance.puzzle_id, comment_count=1)
+
+
+def update_puzzle_counters_on_comment_deleted(sender, instance, **kwargs):
+    _update_puzzle_counters(instance.puzzle_id, comment_count=-1)
+
+
+def update_puzzle_counters_on_bookmark_saved(sender, instance, created,
+                                             **kwargs):
+    if created:
+        _update_puzzle_counters(instance.puzzle_id, bookmark_count=1)
+
+
+def update_puzzle_counters_on_bookmark_deleted(sender, instance, **kwargs):
+    _update_puzzle_counters(instance.puzzle_id, bookmark_count=-1)
+
+
+# {{{1 Search index
+def remember_search_fields(sender, instance, **kwargs):
+    from sui_hei.search import SEARCH_FIELDS
+
+    instance._search_snapshot = {
+        field: instance.__dict__.get(field)
+        for field in SEARCH_FIELDS
+    }
+
+
+def update_search_index_on_puzzle_saved(sender, instance, created, **kwargs):
+    from sui_hei.search import SEARCH_FIELDS, index_puzzles
+
+    snapshot = {} if created else instance._search_snapshot
+    if any(
+            instance.__dict__.get(field) != snapshot.get(field)
+            for field in SEARCH_FIELDS):
+        index_puzzles([instance])
+    remember_search_fields(sender, instance)
+
+
+# {{{1 Rollups
+def update_rollups_on_saved(sender, instance, created, **kwargs):
+    from sui_hei.rollups import (ROLLUP_DATE_MODELS, ROLLUP_VALUE_FIELDS,
+                                 record_activity, record_value)
+
+    name = sender.__name__
+    if created and name in ROLLUP_DATE_MODELS:
+        record_activity(name, instance.user_id, instance.created)
+
+    fields = ROLLUP_VALUE_FIELDS.get(name, ())
+    # Only models with value rollups remember their counter fields
+    snapshot = {} if created or not fields else instance._counter_snapshot
+    for field in fields:
+        value = getattr(instance, field)
+        if not created:
+            # Unknown (deferred) or unchanged
+            if snapshot.get(field) in (None, value):
+                continue
+            record_value(name, field, instance.user_id, snapshot[field], -1)
+        record_value(name, field, instance.user_id, value)
+
+
+def update_rollups_on_deleted(sender, instance, **kwargs):
+    from sui_hei.rollups import (ROLLUP_DATE_MODELS, ROLLUP_VALUE_FIELDS,
+                                 record_activity, record_value)
+
+    name = sender.__name__
+    if name in ROLLUP_DATE_MODELS:
+        record_activity(name, instance.user_id, instance.created, -1)
+    for field in ROLLUP_VALUE_FIELDS.get(name, ()):
+        record_value(name, field, instance.user_id, getattr(instance, field),
+                     -1)
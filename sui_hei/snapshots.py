@@ -0,0 +1,114 @@
+"""
+snapshots.py
+
+Snapshots of changed rows shipped in model.changed events.
+
+`notify_on_model_changes` (consumers.py) attaches to each event a pickled
+snapshot of the concrete field values of the saved instance, and a
+version unique to the event. Subscription consumers turn the event back
+into a model instance with `snapshot_cache.get`, which keeps the instance
+of recent events by (model, pk, version). Every subscriber in a worker
+thus receives the same instance without querying the row, and related
+objects its fields load (e.g. `chatmessage.user`) are fetched once per
+worker rather than once per subscriber.
+
+Instances with deferred fields or pending expressions are sent without a
+snapshot, and the row is read once per worker instead.
+"""
+
+import pickle
+import threading
+import uuid
+from collections import OrderedDict
+
+from django.apps import apps
+from django.conf import settings
+from django.db import router
+
+SNAPSHOT_CACHE_SIZE = settings.SNAPSHOT_CACHE_SIZE
+
+_missing = object()
+
+
+def take_snapshot(instance):
+    '''
+    Returns
+    -------
+    (version, snapshot), where snapshot is None if the field values of
+    `instance` are not all loaded.
+    '''
+    version = uuid.uuid4().hex
+    values = []
+    for field in instance._meta.concrete_fields:
+        value = instance.__dict__.get(field.attname, _missing)
+        if value is _missing or hasattr(value, "resolve_expression"):
+            return version, None
+        values.append(value)
+    return version, pickle.dumps(values, pickle.HIGHEST_PROTOCOL)
+
+
+def load_snapshot(model, pk, snapshot):
+    '''
+    Returns
+    -------
+    instance of `model` from the snapshot, or from the database if there
+    is no snapshot. None if the row no longer exists.
+    '''
+    if snapshot is None:
+        return model.objects.filter(pk=pk).first()
+    field_names = [field.attname for field in model._meta.concrete_fields]
+    return model.from_db(
+        router.db_for_read(model), field_names, pickle.loads(snapshot))
+
+
+# {{{1 SnapshotCache
+class SnapshotCache(object):
+    '''
+    LRU of the instances of the last `size` model.changed events.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, message):
+        '''
+        Returns
+        -------
+        the instance changed in a model.changed event, shared by every
+        caller, or None if the row no longer exists.
+        '''
+        key = (message['model'], message['pk'], message.get('version'))
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+            # Loaded under the lock, so that the row is read at most once
+            self.misses += 1
+            instance = load_snapshot(
+                apps.get_model(message['model']), message['pk'],
+                message.get('snapshot'))
+            if key[2] is not None:
+                self.entries[key] = instance
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+            return instance
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+snapshot_cache = SnapshotCache(SNAPSHOT_CACHE_SIZE)
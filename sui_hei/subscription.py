@@ -10,6 +10,18 @@ from rx import Observable
 from six import get_unbound_function
 
 
+def group_name(model_label, field=None, value=None):
+    '''
+    Returns
+    -------
+    name of the channel layer group receiving the changes of instances
+    of `model_label`, or only of those whose `field` equals `value`.
+    '''
+    if field is None:
+        return 'django.%s' % model_label
+    return 'django.%s.%s.%s' % (model_label, field, value)
+
+
 class SubscriptionOptions(ObjectTypeOptions):
     arguments = None
     output = None
@@ -63,21 +75,31 @@ class Subscription(graphene.ObjectType):
             _meta=_meta, **options)
 
     @classmethod
-    def subscribe(cls, info):
+    def subscribe(cls, info, **kwargs):
+        '''
+        Returns
+        -------
+        list of models, or of (model, field, value) to only receive
+        changes of instances of model whose `field` equals `value`. Fields
+        must be published as topics by `notify_on_model_changes`.
+        '''
         return cls._meta.output._meta.model
 
     @classmethod
     def resolver(cls, obj, info, **kwargs):
         subscribe = info.context.subscribe
         if subscribe:
-            models = cls.subscribe(info)
+            models = cls.subscribe(info, **kwargs)
             if not isinstance(models, list):
                 models = [models]
 
             for model in models:
+                topic = ()
+                if isinstance(model, tuple):
+                    model, topic = model[0], model[1:]
                 ct = ContentType.objects.get_for_model(model)
                 model_label = '.'.join([ct.app_label, ct.model])
-                subscribe(model_label)
+                subscribe(group_name(model_label, *topic))
 
         observable = info.root_value
         return observable.map(lambda obj: cls.next(obj, info, **kwargs))
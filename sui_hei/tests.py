@@ -1,3 +1,501 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.db import transaction
+from django.test import (RequestFactory, TestCase, TransactionTestCase,
+                         override_settings)
+from django.utils import timezone
+from graphql.execution import ExecutionResult
+from promise import Promise
+
+from schema import schema
+
+from . import changelog
+from .changelog import log_changes, missed_changes
+from .consumers import GraphqlSubcriptionConsumer, resolve_promises
+from .counts import VERSION_KEY, count_queryset
+from .models import (DailyActivity, Dialogue, Puzzle, Star, User, UserStats,
+                     UserStatsManager, ValueRollup)
+from .notifier import ChangeNotifier
+from .response_cache import VERSION_KEY as RESPONSE_VERSION_KEY
+from .response_cache import ResponseCache
+from .versions import bump_version, check_shared_cache
+
+
+class BatchedFieldsTestCase(TestCase):
+    '''
+    Aggregate fields of PuzzleNode and UserNode are batched with
+    DataLoaders (see loaders.py), so the number of queries of a page does
+    not depend on its size.
+    '''
+    QUERY = '''
+    query {
+      allPuzzles(orderBy: ["id"], limit: 20) {
+        edges {
+          node {
+            quesCount
+            starCount
+            starSum
+            solution
+            user {
+              puzzleCount
+              quesCount
+              goodQuesCount
+              trueQuesCount
+              commentCount
+              rcommentCount
+              starCount
+              starSum
+              rstarCount
+              rstarSum
+            }
+          }
+        }
+      }
+    }
+    '''
+
+    def setUp(self):
+        self.viewer = User.objects.create(username="viewer", nickname="viewer")
+
+    def create_puzzles(self, count):
+        now = timezone.now()
+        offset = User.objects.count()
+        for i in range(count):
+            user = User.objects.create(
+                username="user%d" % (offset + i),
+                nickname="user%d" % (offset + i))
+            # Unsolved long-term yami: solution depends on the viewer
+            puzzle = Puzzle.objects.create(
+                user=user,
+                title="title%d" % i,
+                content="content",
+                solution="solution",
+                genre=0,
+                yami=2,
+                status=0,
+                created=now,
+                modified=now,
+                dazed_on=now.date())
+            Dialogue.objects.create(
+                user=self.viewer,
+                puzzle=puzzle,
+                question="question",
+                true=i % 2 == 0,
+                created=now)
+            Star.objects.create(user=self.viewer, puzzle=puzzle, value=i % 5)
+
+    def execute(self):
+        request = RequestFactory().post("/graphql")
+        request.user = self.viewer
+        result = schema.execute(self.QUERY, context_value=request)
+        self.assertIsNone(result.errors)
+        return result.data["allPuzzles"]["edges"]
+
+    def test_queries_do_not_grow_with_page_size(self):
+        for count in [1, 5]:
+            with self.subTest(count=count):
+                Puzzle.objects.all().delete()
+                self.create_puzzles(count)
+                with self.assertNumQueries(8):
+                    edges = self.execute()
+                self.assertEqual(len(edges), count)
+
+    def test_batched_values(self):
+        self.create_puzzles(4)
+        edges = self.execute()
+        self.assertEqual([edge["node"]["solution"] for edge in edges],
+                         ["solution", "", "solution", ""])
+        for i, edge in enumerate(edges):
+            node = edge["node"]
+            self.assertEqual(node["quesCount"], 1)
+            self.assertEqual(node["starCount"], 1)
+            self.assertEqual(node["starSum"], i % 5)
+            self.assertEqual(node["user"]["puzzleCount"], 1)
+            self.assertEqual(node["user"]["quesCount"], 0)
+            self.assertEqual(node["user"]["rstarCount"], 1)
+            self.assertEqual(node["user"]["rstarSum"], i % 5)
+
+
+class ResolvePromisesTestCase(TestCase):
+    '''
+    Subscriptions wait for fields completing as promises before their
+    results are encoded.
+    '''
+
+    def test_resolve_promises(self):
+        result = resolve_promises(
+            ExecutionResult(data={
+                "puzzleSub": Promise.resolve({
+                    "solution": ""
+                }),
+            }))
+        self.assertEqual(result.data, {"puzzleSub": {"solution": ""}})
+        self.assertIsNone(result.errors)
+
+    def test_rejected_promise(self):
+        result = resolve_promises(
+            ExecutionResult(data={
+                "puzzleSub": Promise.reject(ValueError("failed")),
+            }))
+        self.assertIsNone(result.data)
+        self.assertEqual(list(map(str, result.errors)), ["failed"])
+
+
+class PuzzleCountersTestCase(TestCase):
+    '''
+    Saving a puzzle leaves the denormalized counters to the signals.
+    '''
+
+    def test_save_keeps_concurrent_increments(self):
+        now = timezone.now()
+        user = User.objects.create(username="user", nickname="user")
+        puzzle = Puzzle.objects.create(
+            user=user,
+            title="title",
+            content="content",
+            solution="solution",
+            created=now,
+            modified=now,
+            dazed_on=now.date())
+        stale = Puzzle.objects.get(id=puzzle.id)
+        Dialogue.objects.create(
+            user=user, puzzle=puzzle, question="question", created=now)
+        Star.objects.create(user=user, puzzle=puzzle, value=3)
+
+        stale.status = 2
+        stale.save()
+
+        puzzle.refresh_from_db()
+        self.assertEqual(puzzle.status, 2)
+        self.assertEqual(puzzle.ques_count, 1)
+        self.assertEqual(puzzle.star_count, 1)
+        self.assertEqual(puzzle.star_sum, 3)
+
+
+class UserStatsTestCase(TestCase):
+    '''
+    Missing statistics are created by the signals, never by the loaders.
+    '''
+
+    def create_puzzle(self, user):
+        now = timezone.now()
+        return Puzzle.objects.create(
+            user=user,
+            title="title",
+            content="content",
+            solution="solution",
+            created=now,
+            modified=now,
+            dazed_on=now.date())
+
+    def test_loader_does_not_write(self):
+        user = User.objects.create(username="user", nickname="user")
+        self.create_puzzle(user)
+        UserStats.objects.all().delete()
+
+        request = RequestFactory().post("/graphql")
+        request.user = user
+        result = schema.execute(
+            "query { allPuzzles { edges { node { user { puzzleCount } } } } }",
+            context_value=request)
+        self.assertIsNone(result.errors)
+        self.assertEqual(result.data["allPuzzles"]["edges"][0]["node"]["user"],
+                         {"puzzleCount": 1})
+        self.assertFalse(UserStats.objects.exists())
+
+    def test_concurrent_creation(self):
+        user = User.objects.create(username="user", nickname="user")
+        UserStats.objects.all().delete()
+        compute = UserStatsManager.compute
+
+        def compute_after_concurrent_save(manager, users=None):
+            # Computed before the other save, created after it
+            stats = compute(manager, users=users)
+            UserStats.objects.create(user=user, puzzle_count=0)
+            return stats
+
+        with mock.patch.object(UserStatsManager, "compute",
+                               compute_after_concurrent_save):
+            self.create_puzzle(user)
+        self.assertEqual(UserStats.objects.get(user=user).puzzle_count, 1)
+
+
+class CountsTestCase(TestCase):
+    '''
+    Cached counts are invalidated by model changes, even if the version
+    of their table is culled from the cache.
+    '''
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username="user", nickname="user")
+
+    def create_puzzle(self):
+        now = timezone.now()
+        Puzzle.objects.create(
+            user=self.user,
+            title="title",
+            content="content",
+            solution="solution",
+            created=now,
+            modified=now,
+            dazed_on=now.date())
+
+    def test_invalidated_on_save(self):
+        self.assertEqual(count_queryset(Puzzle.objects.all()), (0, True))
+        self.create_puzzle()
+        self.assertEqual(count_queryset(Puzzle.objects.all()), (1, True))
+
+    def test_culled_version(self):
+        self.assertEqual(count_queryset(Puzzle.objects.all()), (0, True))
+        self.create_puzzle()
+        cache.delete(VERSION_KEY % Puzzle._meta.db_table)
+        self.assertEqual(count_queryset(Puzzle.objects.all()), (1, True))
+
+
+class ResponseCacheTestCase(TestCase):
+    '''
+    Cached responses are invalidated by changes of any process, including
+    changes made while they were computed.
+    '''
+
+    def setUp(self):
+        cache.clear()
+        self.cache = ResponseCache(10, 60)
+        self.tags = {"sui_hei.puzzle"}
+
+    def test_hit(self):
+        self.cache.set("key", "value", self.tags, self.cache.versions())
+        self.assertEqual(self.cache.get("key"), "value")
+
+    def test_changed_while_computing(self):
+        versions = self.cache.versions()
+        bump_version(RESPONSE_VERSION_KEY % "sui_hei.puzzle")
+        self.cache.set("key", "value", self.tags, versions)
+        self.assertIsNone(self.cache.get("key"))
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+    def test_changed_by_another_process(self):
+        self.cache.set("key", "value", self.tags, self.cache.versions())
+        # Bumped without evicting the entries of this process
+        bump_version(RESPONSE_VERSION_KEY % "sui_hei.puzzle")
+        self.assertIsNone(self.cache.get("key"))
+
+
+class UserDeletionTestCase(TestCase):
+    '''
+    Deleting a user cascades to its content without recreating the rows
+    kept up to date by the signals.
+    '''
+
+    def test_delete_user(self):
+        now = timezone.now()
+        user = User.objects.create(username="user", nickname="user")
+        other = User.objects.create(username="other", nickname="other")
+        puzzle = Puzzle.objects.create(
+            user=user,
+            title="title",
+            content="content",
+            solution="solution",
+            created=now,
+            modified=now,
+            dazed_on=now.date())
+        for questioner in (user, other):
+            Dialogue.objects.create(
+                user=questioner,
+                puzzle=puzzle,
+                question="question",
+                created=now)
+        Star.objects.create(user=user, puzzle=puzzle, value=3)
+        Star.objects.create(user=other, puzzle=puzzle, value=4)
+
+        user_id = user.id
+        user.delete()
+
+        self.assertFalse(
+            DailyActivity.objects.filter(user_id=user_id).exists())
+        self.assertFalse(ValueRollup.objects.filter(user_id=user_id).exists())
+        self.assertFalse(UserStats.objects.filter(user_id=user_id).exists())
+        self.assertEqual(
+            DailyActivity.objects.get(user=other, model="Dialogue").count, 0)
+
+
+class ChangeNotifierTestCase(TransactionTestCase):
+    '''
+    model.changed events are sent once their transaction commits, one per
+    (model, pk), and never for rolled back saves.
+    '''
+
+    def setUp(self):
+        self.notifier = ChangeNotifier()
+        self.batches = []
+        self.notifier.flush = lambda batch: self.batches.append(batch.messages())
+
+    def notify(self, pk, version, groups):
+        self.notifier.notify("sui_hei.puzzle", pk, version, {"v": version},
+                             groups)
+
+    def sent(self):
+        return [[(message["group"], message["pk"], message["version"])
+                 for message in messages] for messages in self.batches]
+
+    def test_outside_atomic(self):
+        self.notify(1, 1, ["a"])
+        self.assertEqual(self.sent(), [[("a", 1, 1)]])
+
+    def test_commit(self):
+        with transaction.atomic():
+            self.notify(1, 1, ["a"])
+            self.notify(2, 1, ["a"])
+            self.assertEqual(self.sent(), [])
+        self.assertEqual(self.sent(), [[("a", 1, 1), ("a", 2, 1)]])
+
+    def test_rollback(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                self.notify(1, 1, ["a"])
+                raise ValueError()
+        self.assertEqual(self.sent(), [])
+
+        # The next transaction starts a new batch
+        with transaction.atomic():
+            self.notify(2, 1, ["a"])
+        self.assertEqual(self.sent(), [[("a", 2, 1)]])
+
+    def test_saves_collapse(self):
+        with transaction.atomic():
+            self.notify(1, 1, ["a", "b"])
+            self.notify(2, 1, ["a"])
+            self.notify(1, 2, ["c", "a"])
+        # Ordered by the last save, with the snapshot of the last save
+        self.assertEqual(self.sent(), [[("a", 2, 1), ("a", 1, 2), ("b", 1, 2),
+                                        ("c", 1, 2)]])
+        self.assertEqual(self.batches[0][1]["snapshot"], {"v": 2})
+
+    def test_savepoints(self):
+        with transaction.atomic():
+            self.notify(1, 1, ["a"])
+            with transaction.atomic():
+                self.notify(2, 1, ["a"])
+            with self.assertRaises(ValueError):
+                with transaction.atomic():
+                    self.notify(3, 1, ["a"])
+                    raise ValueError()
+            self.notify(4, 1, ["a"])
+            self.assertEqual(self.sent(), [])
+        self.assertEqual(
+            sorted(
+                message for messages in self.sent() for message in messages),
+            [("a", 1, 1), ("a", 2, 1), ("a", 4, 1)])
+
+
+class ChangeLogTestCase(TestCase):
+    '''
+    Missed events are replayed from the change log, unless some of them
+    are no longer in it or there are too many.
+    '''
+
+    def log(self, *groups):
+        messages = [{
+            'type': 'model.changed',
+            'group': group,
+            'pk': 1,
+            'model': 'sui_hei.puzzle',
+            'version': str(i),
+            'snapshot': b'snapshot',
+        } for i, group in enumerate(groups)]
+        log_changes(messages)
+        return [message['seq'] for message in messages]
+
+    def missed(self, groups, last_seq):
+        messages = missed_changes(groups, last_seq)
+        return messages and [message['seq'] for message in messages]
+
+    def test_empty_log(self):
+        self.assertIsNone(self.missed(["a"], 0))
+
+    def test_gap(self):
+        seqs = self.log("a", "b", "b", "a", "c", "a")
+        self.assertEqual(self.missed(["a"], seqs[0]), [seqs[3], seqs[5]])
+        self.assertEqual(
+            self.missed(["a", "c"], seqs[0]), [seqs[3], seqs[4], seqs[5]])
+        # From before the first entry
+        self.assertEqual(
+            self.missed(["a"], seqs[0] - 1), [seqs[0], seqs[3], seqs[5]])
+        self.assertEqual(
+            missed_changes(["a"], seqs[4])[0]['snapshot'], b'snapshot')
+
+    def test_trimmed(self):
+        with mock.patch.object(changelog, "CHANGE_LOG_SIZE", 3):
+            seqs = self.log("a", "a", "a", "a", "a")
+        self.assertIsNone(self.missed(["a"], seqs[0]))
+        self.assertEqual(self.missed(["a"], seqs[1]), seqs[2:])
+
+    def test_replay_limit(self):
+        seqs = self.log("a", "a", "a", "b")
+        with mock.patch.object(changelog, "CHANGE_LOG_REPLAY_LIMIT", 2):
+            self.assertIsNone(self.missed(["a"], seqs[0] - 1))
+            self.assertEqual(self.missed(["a"], seqs[0]), seqs[1:3])
+
+    def test_beyond_last(self):
+        seqs = self.log("a", "a")
+        self.assertEqual(self.missed(["a"], seqs[-1]), [])
+        self.assertIsNone(self.missed(["a"], seqs[-1] + 1))
+
+
+class DeliverTestCase(TestCase):
+    '''
+    Live frames are held back while their subscription is replayed, and
+    dropped if the replay already sent them.
+    '''
+
+    def setUp(self):
+        self.consumer = GraphqlSubcriptionConsumer({"type": "websocket"})
+        self.consumer.loop = mock.Mock()
+        self.consumer.send = lambda message: message['text']
+        self.consumer.replays = {}
+        self.consumer.watermarks = {}
+
+    def sent(self):
+        return [
+            args[0]
+            for args, kwargs in self.consumer.loop.create_task.call_args_list
+        ]
+
+    def test_held_back_while_replaying(self):
+        self.consumer.replays["1"] = []
+        self.consumer._deliver("1", 5, "five")
+        self.assertEqual(self.consumer.replays["1"], [(5, "five")])
+        self.assertEqual(self.sent(), [])
+
+    def test_watermark(self):
+        self.consumer.watermarks["1"] = 5
+        for seq, text in [(4, "four"), (5, "five"), (6, "six"), (None,
+                                                                 "no seq")]:
+            self.consumer._deliver("1", seq, text)
+        self.consumer._deliver("2", 3, "other")
+        self.assertEqual(self.sent(), ["six", "no seq", "other"])
+
+
+class SharedCacheCheckTestCase(TestCase):
+    '''
+    A default cache local to each process is reported out of DEBUG.
+    '''
+
+    def caches(self, backend):
+        return {"default": {"BACKEND": backend}}
+
+    def test_local_memory(self):
+        locmem = self.caches("django.core.cache.backends.locmem.LocMemCache")
+        with override_settings(DEBUG=False, CACHES=locmem):
+            self.assertEqual(
+                [warning.id for warning in check_shared_cache(None)],
+                ["sui_hei.W001"])
+        with override_settings(DEBUG=True, CACHES=locmem):
+            self.assertEqual(check_shared_cache(None), [])
+
+    def test_shared(self):
+        shared = self.caches("django.core.cache.backends.db.DatabaseCache")
+        with override_settings(DEBUG=False, CACHES=shared):
+            self.assertEqual(check_shared_cache(None), [])
@@ -4,9 +4,9 @@ from django.conf.urls import include
 from django.urls import path, re_path
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import RedirectView, TemplateView
-from graphene_django.views import GraphQLView
 
 from . import views
+from .graphql_view import SuiheiGraphQLView
 
 app_name = "sui_hei"
 
@@ -26,8 +26,11 @@ urlpatterns = [
 ] # yapf: disable
 
 # GraphQL
+urlpatterns.append(path("graphql/stats", views.graphql_stats))
+urlpatterns.append(path("graphql/metrics", views.graphql_metrics))
 if settings.DEBUG:
     urlpatterns.append(
-        path("graphql", csrf_exempt(GraphQLView.as_view(graphiql=True))))
+        path("graphql",
+             csrf_exempt(SuiheiGraphQLView.as_view(graphiql=True))))
 else:
-    urlpatterns.append(path("graphql", GraphQLView.as_view(batch=True)))
+    urlpatterns.append(path("graphql", SuiheiGraphQLView.as_view(batch=True)))
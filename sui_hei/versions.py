@@ -0,0 +1,74 @@
+"""
+versions.py
+
+Versions of cached data, kept in the default Django cache.
+
+Cached entries embed or record the versions of what they were computed
+from, and changes bump those versions, so that entries of every process
+sharing the cache are invalidated at once. The default cache must then be
+shared (see CACHES in cindy/security.py.template).
+
+Versions only move forward: a version missing from the cache, e.g. after
+being culled, restarts from the current time in microseconds instead of
+0, which is after every version handed out before.
+
+`check_shared_cache` is a system check warning about a default cache
+local to the process when DEBUG is off.
+
+Usage:
+    versions = get_versions(["count-version:sui_hei_puzzle"])
+    bump_version("count-version:sui_hei_puzzle")
+"""
+
+import time
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils.module_loading import import_string
+
+
+def _initial_version():
+    return int(time.time() * 1000000)
+
+
+def get_versions(keys):
+    '''
+    Get the current versions of `keys`, initializing missing ones.
+
+    Returns
+    -------
+    dict of key -> version
+    '''
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # Another process may initialize it first
+            cache.add(key, _initial_version(), None)
+            versions[key] = cache.get(key) or _initial_version()
+    return versions
+
+
+def bump_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Initialized concurrently, maybe for an entry missing this change
+        if not cache.add(key, _initial_version(), None):
+            cache.incr(key)
+
+
+def check_shared_cache(app_configs, **kwargs):
+    backend = settings.CACHES["default"]["BACKEND"]
+    if settings.DEBUG or not issubclass(import_string(backend), LocMemCache):
+        return []
+    return [
+        checks.Warning(
+            "The default cache is local to each process, so cached counts "
+            "and responses are only invalidated in the process saving the "
+            "changes.",
+            hint="Configure a shared cache in CACHES, see "
+            "cindy/security.py.template.",
+            id="sui_hei.W001")
+    ]
@@ -1,10 +1,15 @@
 import re
 
 from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import Http404, JsonResponse
 from django.shortcuts import HttpResponse, redirect, render, render_to_response
 from django.views.decorators.csrf import ensure_csrf_cookie
 
+from sui_hei.documents import document_cache
+from sui_hei.metrics import field_metrics
 from sui_hei.models import *
+from sui_hei.response_cache import response_cache
 
 I18N_PATTERN_REGEX = re.compile(r'^/(en|ja)')
 DEBUG = settings.DEBUG
@@ -31,3 +36,20 @@ def event(request, eventId, *args, **kwargs):
         return HttpResponse(ev.page_src)
     else:
         return redirect('/')
+
+
+@staff_member_required
+def graphql_stats(request, *args, **kwargs):
+    return JsonResponse({
+        "documents": document_cache.stats(),
+        "responses": response_cache.stats(),
+    })
+
+
+def graphql_metrics(request, *args, **kwargs):
+    # Only for scrapers on this host, not through the reverse proxy
+    if request.META.get("REMOTE_ADDR") not in settings.INTERNAL_IPS or \
+            "HTTP_X_FORWARDED_FOR" in request.META:
+        raise Http404
+    return HttpResponse(
+        field_metrics.render(), content_type="text/plain; version=0.0.4")